@@ -0,0 +1,292 @@
+"""
+Benchmark harness for the API.
+
+Seeds a synthetic dataset (patients x encounters x line items) into the
+database named by the DEMO_DATABASE_* settings, replays a weighted mix of
+requests against the API and prints requests per second and p50/p95/p99
+latency per endpoint as JSON, so runs can be compared across commits.
+
+Requests go through the ASGI app in process (--target asgi, the default), or
+over real HTTP to a running server (--target http --url ...). --serve starts
+src/api/main.py with the same settings and benchmarks it over HTTP.
+
+Examples, from the repository root:
+
+    python bench/bench.py --patients 1000 --encounters 5 --line-items 10
+    python bench/bench.py --serve --concurrency 64 --duration 30 --output run.json
+    DEMO_DATABASE_DRIVER=postgresql DEMO_DATABASE_NAME=postgres ... python bench/bench.py --serve
+
+--workers 1,2,4 runs the benchmark against main.py once per worker count
+(DEMO_WORKERS) and adds a throughput scaling summary to the report.
+
+Without DEMO_DATABASE_* settings the benchmark uses a SQLite file in the
+system temp directory, since an in-memory database can't be shared with a
+server process.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+API_DIR = os.path.join(ROOT, "src", "api")
+
+# Request mix: name, weight, method, URL template and JSON body. URL templates
+# are filled in with a random seeded patient and one of its encounters.
+DEFAULT_MIX = [
+    ("GET /patients/", 5, "GET", "/patients/?limit=100", None),
+    ("GET /patients/{patient_id}", 20, "GET", "/patients/{patient_id}", None),
+    ("GET /patients/{patient_id}/encounters/", 20, "GET", "/patients/{patient_id}/encounters/", None),
+    ("GET /patients/{patient_id}/encounters/{encounter_id}", 15, "GET", "/patients/{patient_id}/encounters/{encounter_id}", None),
+    ("GET /patients/{patient_id}/encounters/{encounter_id}/line_items/", 25, "GET", "/patients/{patient_id}/encounters/{encounter_id}/line_items/", None),
+    ("POST /patients/{patient_id}/encounters/", 5, "POST", "/patients/{patient_id}/encounters/", {"date": "2024-01-01"}),
+    ("POST /patients/{patient_id}/encounters/{encounter_id}/line_items/", 10, "POST", "/patients/{patient_id}/encounters/{encounter_id}/line_items/", {"cpt_code": "99213", "units": 1}),
+]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Seed a dataset and benchmark the API")
+    parser.add_argument("--patients", type=int, default=200, help="patients to seed")
+    parser.add_argument("--encounters", type=int, default=5, help="encounters per patient")
+    parser.add_argument("--line-items", type=int, default=10, help="line items per encounter")
+    parser.add_argument("--no-seed", action="store_true", help="reuse the data already in the database")
+    parser.add_argument("--target", choices=["asgi", "http"], default="asgi", help="call the app in process or over HTTP")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="base URL for --target http")
+    parser.add_argument("--serve", action="store_true", help="start src/api/main.py and benchmark it over HTTP")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--requests", type=int, default=2000, help="total requests to send")
+    parser.add_argument("--duration", type=float, help="send requests for this many seconds instead of --requests")
+    parser.add_argument("--warmup", type=int, default=100, help="requests to send before measuring")
+    parser.add_argument("--mix", help="JSON file of [name, weight, method, url, body] entries replacing the default mix")
+    parser.add_argument("--random-seed", type=int, default=1, help="seed for the request sequence")
+    parser.add_argument("--workers", help="comma separated worker counts to benchmark main.py with, e.g. 1,2,4")
+    parser.add_argument("--output", help="write the JSON report to this file as well as stdout")
+    return parser.parse_args(argv)
+
+# Point the app at a file database unless DEMO_DATABASE_* settings say otherwise.
+# Must run before the app modules are imported.
+def configure_environment():
+    if "DEMO_DATABASE_DRIVER" not in os.environ:
+        os.environ["DEMO_DATABASE_DRIVER"] = "sqlite"
+        os.environ["DEMO_DATABASE_NAME"] = os.path.join(tempfile.gettempdir(), "demo-python-api-bench.db")
+    os.environ.setdefault("DEMO_CPT_CODES_CSV", os.path.join(ROOT, "data", "cpt_codes.csv"))
+    # keep the app's logs out of the JSON report on stdout
+    os.environ.setdefault("DEMO_LOG_STREAM", "stderr")
+    sys.path.insert(0, API_DIR)
+
+# Replace the patients, encounters and line items with a synthetic dataset
+def seed(patients: int, encounters: int, line_items: int):
+    from peewee import chunked
+    from db_config import db
+    from model import Patient, Encounter, LineItem, CPTCode
+
+    cpt_codes = [ id for id, in CPTCode.select(CPTCode.id).tuples() ]
+    start = time.perf_counter()
+    with db.atomic():
+        LineItem.delete().execute()
+        Encounter.delete().execute()
+        Patient.delete().execute()
+        for batch in chunked(range(patients), 500):
+            patient_rows, encounter_rows, line_item_rows = [], [], []
+            for p in batch:
+                patient_id = uuid.uuid4()
+                patient_rows.append((patient_id, f"First{p}", f"Last{p}"))
+                for e in range(encounters):
+                    encounter_id = uuid.uuid4()
+                    encounter_rows.append((encounter_id, patient_id, f"2024-{e % 12 + 1:02d}-{e % 28 + 1:02d}"))
+                    for i in range(line_items):
+                        line_item_rows.append((encounter_id, cpt_codes[i % len(cpt_codes)], i))
+            Patient.insert_many(patient_rows, fields=[Patient.id, Patient.first_name, Patient.last_name]).execute()
+            for rows in chunked(encounter_rows, 300):
+                Encounter.insert_many(rows, fields=[Encounter.id, Encounter.patient, Encounter.date]).execute()
+            for rows in chunked(line_item_rows, 300):
+                LineItem.insert_many(rows, fields=[LineItem.encounter, LineItem.cpt_code, LineItem.units]).execute()
+    return time.perf_counter() - start
+
+# (patient ID, encounter ID) pairs to fill the URL templates with
+def sample_ids(limit: int = 10000):
+    from model import Encounter
+    query = Encounter.select(Encounter.patient, Encounter.id).limit(limit).tuples()
+    return [ (str(patient_id), str(encounter_id)) for patient_id, encounter_id in query ]
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+# Send requests from the mix with `concurrency` requests in flight. Returns
+# {name: [(latency, status), ...]} and the elapsed wall time.
+async def replay(client, mix, ids, concurrency, requests, duration, rng):
+    names = [ entry[0] for entry in mix ]
+    weights = [ entry[1] for entry in mix ]
+    by_name = { entry[0]: entry for entry in mix }
+    results = { name: [] for name in names }
+    sent = 0
+    deadline = time.perf_counter() + duration if duration else None
+
+    async def worker():
+        nonlocal sent
+        while True:
+            if deadline is not None:
+                if time.perf_counter() >= deadline:
+                    return
+            elif sent >= requests:
+                return
+            sent += 1
+            name = rng.choices(names, weights)[0]
+            _, _, method, url, body = by_name[name]
+            patient_id, encounter_id = rng.choice(ids)
+            url = url.format(patient_id=patient_id, encounter_id=encounter_id)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, json=body)
+                status = response.status_code
+            except Exception:
+                status = 0
+            results[name].append((time.perf_counter() - start, status))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[ worker() for _ in range(concurrency) ])
+    return results, time.perf_counter() - start
+
+def summarize(results, elapsed):
+    report = {}
+    for name, samples in results.items():
+        if not samples:
+            continue
+        latencies = sorted(latency for latency, _ in samples)
+        report[name] = {
+            "requests": len(samples),
+            "errors": sum(1 for _, status in samples if status == 0 or status >= 500),
+            "rps": round(len(samples) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        }
+    all_latencies = sorted(latency for samples in results.values() for latency, _ in samples)
+    total = {
+        "requests": len(all_latencies),
+        "rps": round(len(all_latencies) / elapsed, 1),
+        "p50_ms": round(percentile(all_latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(all_latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(all_latencies, 0.99) * 1000, 2),
+    }
+    return report, total
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Start main.py with the benchmark settings and wait until it is healthy
+def start_server(url: str, env: dict = None):
+    import httpx
+    port = url.rsplit(":", 1)[-1].split("/")[0]
+    env = { **os.environ, "DEMO_HOST": "127.0.0.1", "DEMO_PORT": port, **(env or {}) }
+    server = subprocess.Popen([sys.executable, os.path.join(API_DIR, "main.py")], cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            if httpx.get(url + "/health/").status_code == 200:
+                return server
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("server did not become healthy")
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+async def run(args, server_env: dict = None) -> dict:
+    import httpx
+    from cpt_cache import cpt_code_cache
+    from db_migrate import migrate
+
+    migrate()
+    seed_seconds = None
+    if not args.no_seed:
+        seed_seconds = seed(args.patients, args.encounters, args.line_items)
+    ids = sample_ids()
+    if not ids:
+        raise SystemExit("no encounters in the database, seed some first")
+
+    mix = DEFAULT_MIX
+    if args.mix:
+        with open(args.mix) as f:
+            mix = [ tuple(entry) for entry in json.load(f) ]
+
+    server = None
+    if args.serve:
+        args.target = "http"
+        server = start_server(args.url, server_env)
+    try:
+        if args.target == "asgi":
+            from api import app
+            cpt_code_cache.load()
+            client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+        else:
+            limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+            client = httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60)
+        async with client:
+            rng = random.Random(args.random_seed)
+            if args.warmup:
+                await replay(client, mix, ids, args.concurrency, args.warmup, None, rng)
+            results, elapsed = await replay(client, mix, ids, args.concurrency, args.requests, args.duration, rng)
+    finally:
+        if server:
+            stop_server(server)
+
+    endpoints, total = summarize(results, elapsed)
+    return {
+        "commit": git_commit(),
+        "target": args.target,
+        "database": os.environ["DEMO_DATABASE_DRIVER"],
+        "dataset": { "patients": args.patients, "encounters_per_patient": args.encounters,
+                     "line_items_per_encounter": args.line_items, "seed_seconds": seed_seconds },
+        "concurrency": args.concurrency,
+        "elapsed_seconds": round(elapsed, 3),
+        "total": total,
+        "endpoints": endpoints,
+    }
+
+# Benchmark main.py with each worker count, seeding once. Reports each run and
+# the throughput relative to one worker.
+async def run_workers(args) -> dict:
+    runs = {}
+    for workers in [ int(count) for count in args.workers.split(",") ]:
+        args.serve = True
+        runs[workers] = await run(args, server_env={"DEMO_WORKERS": str(workers)})
+        args.no_seed = True
+    baseline = next(iter(runs.values()))["total"]["rps"]
+    return {
+        "scaling": { workers: { "rps": run["total"]["rps"], "p99_ms": run["total"]["p99_ms"],
+                                "speedup": round(run["total"]["rps"] / baseline, 2) }
+                     for workers, run in runs.items() },
+        "runs": runs,
+    }
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_environment()
+    report = asyncio.run(run_workers(args) if args.workers else run(args))
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Benchmark of patient search.
+
+Seeds synthetic patients into the database named by the DEMO_DATABASE_*
+settings, migrates it so the search indexes exist, and times
+model.search_patients for a mix of name prefixes: short and long prefixes of
+last names, full first names and "first last-prefix" pairs. For comparison it
+also times the old way of finding a patient, paging through GET /patients/'s
+query and filtering client side, for a few lookups. Reports latency per kind
+of search as JSON.
+
+Examples, from the repository root:
+
+    python bench/patient_search.py --patients 1000000
+    python bench/patient_search.py --no-seed --lookups 5000 --output search.json
+    DEMO_DATABASE_DRIVER=postgresql DEMO_DATABASE_NAME=postgres ... python bench/patient_search.py
+
+Without DEMO_DATABASE_* settings it uses a SQLite file in the system temp
+directory, which --no-seed reuses.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+API_DIR = os.path.join(ROOT, "src", "api")
+
+FIRST_NAMES = [
+    "Aaron", "Abigail", "Adam", "Alice", "Amir", "Ana", "Ben", "Carla", "Chen", "Daniel", "Diego", "Elena",
+    "Emma", "Fatima", "Grace", "Hannah", "Ivan", "Jack", "James", "Jana", "Kai", "Laura", "Liam", "Maria",
+    "Mohammed", "Nina", "Noah", "Olivia", "Omar", "Pat", "Priya", "Rosa", "Sam", "Sofia", "Tom", "Yuki",
+]
+SYLLABLES = ["an", "ber", "cal", "dor", "el", "fen", "gar", "hol", "is", "jen", "kov", "lin", "mar", "ner",
+             "or", "pet", "quin", "ros", "sen", "tor", "ul", "vik", "wald", "yang"]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Seed patients and benchmark patient search")
+    parser.add_argument("--patients", type=int, default=1000000, help="patients to seed")
+    parser.add_argument("--no-seed", action="store_true", help="reuse the patients already in the database")
+    parser.add_argument("--lookups", type=int, default=2000, help="searches to time per kind")
+    parser.add_argument("--limit", type=int, default=20, help="results per search")
+    parser.add_argument("--baseline-lookups", type=int, default=3, help="client side filtered lookups to time (0 to skip)")
+    parser.add_argument("--random-seed", type=int, default=1, help="seed for the names and searches")
+    parser.add_argument("--output", help="write the JSON report to this file as well as stdout")
+    return parser.parse_args(argv)
+
+# Point the app at a file database unless DEMO_DATABASE_* settings say otherwise.
+# Must run before the app modules are imported.
+def configure_environment():
+    if "DEMO_DATABASE_DRIVER" not in os.environ:
+        os.environ["DEMO_DATABASE_DRIVER"] = "sqlite"
+        os.environ["DEMO_DATABASE_NAME"] = os.path.join(tempfile.gettempdir(), "demo-python-api-search.db")
+    os.environ.setdefault("DEMO_CPT_CODES_CSV", os.path.join(ROOT, "data", "cpt_codes.csv"))
+    # keep the app's logs out of the JSON report on stdout
+    os.environ.setdefault("DEMO_LOG_STREAM", "stderr")
+    sys.path.insert(0, API_DIR)
+
+def last_name(rng) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize()
+
+# Replace the patients with synthetic ones. Encounters and line items go too,
+# since they belong to the old patients.
+def seed(patients: int, rng) -> float:
+    from peewee import chunked
+    from db_config import db
+    from model import Patient, Encounter, LineItem
+
+    start = time.perf_counter()
+    with db.atomic():
+        LineItem.delete().execute()
+        Encounter.delete().execute()
+        Patient.delete().execute()
+        for batch in chunked(range(patients), 1000):
+            rows = [ (uuid.uuid4(), rng.choice(FIRST_NAMES), last_name(rng)) for _ in batch ]
+            for chunk in chunked(rows, 300):
+                Patient.insert_many(chunk, fields=[Patient.id, Patient.first_name, Patient.last_name]).execute()
+    return time.perf_counter() - start
+
+# Searches of each kind, built from names actually seeded
+def searches(names, lookups: int, rng) -> dict:
+    picks = [ rng.choice(names) for _ in range(lookups) ]
+    return {
+        "last_name_prefix_2": [ last[:2] for _, last in picks ],
+        "last_name_prefix_5": [ last[:5] for _, last in picks ],
+        "first_name": [ first for first, _ in picks ],
+        "first_and_last_prefix": [ f"{first} {last[:3]}" for first, last in picks ],
+    }
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def summarize(samples, results) -> dict:
+    return {
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        "mean_results": round(sum(results) / len(results), 1),
+    }
+
+def time_searches(queries, limit: int) -> dict:
+    from model import patient_search_terms, search_patients
+    samples, results = [], []
+    for q in queries:
+        start = time.perf_counter()
+        rows = search_patients(patient_search_terms(q), None, limit + 1)
+        samples.append(time.perf_counter() - start)
+        results.append(min(len(rows), limit))
+    return summarize(samples, results)
+
+# What clients did before search: page through every patient and filter
+def time_client_side_filter(queries, limit: int) -> dict:
+    from config import settings
+    from model import get_patients
+    page_size = int(settings.PAGE_MAX_LIMIT)
+    samples, results = [], []
+    for q in queries:
+        prefix = q.lower()
+        start = time.perf_counter()
+        found, after = [], None
+        while True:
+            rows = get_patients(after, page_size)
+            found += [ row for row in rows if row[2].lower().startswith(prefix) or row[1].lower().startswith(prefix) ]
+            if len(rows) < page_size:
+                break
+            after = [str(rows[-1][0])]
+        samples.append(time.perf_counter() - start)
+        results.append(min(len(found), limit))
+    return summarize(samples, results)
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_environment()
+    from config import settings
+    from db_migrate import migrate
+    from model import Patient
+
+    rng = random.Random(args.random_seed)
+    migrate()
+    report = { "driver": settings.DATABASE_DRIVER }
+    if not args.no_seed:
+        report["seed_seconds"] = round(seed(args.patients, rng), 3)
+    names = list(Patient.select(Patient.first_name, Patient.last_name).limit(100000).tuples())
+    if not names:
+        raise SystemExit("no patients to search, run without --no-seed")
+    report["patients"] = Patient.select().count()
+    kinds = searches(names, args.lookups, rng)
+    report["search"] = { kind: time_searches(queries, args.limit) for kind, queries in kinds.items() }
+    if args.baseline_lookups:
+        report["client_side_filter"] = time_client_side_filter(
+            kinds["last_name_prefix_5"][:args.baseline_lookups], args.limit)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
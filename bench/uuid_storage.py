@@ -0,0 +1,168 @@
+"""
+Benchmark of UUID key storage: text versus the compact storage the models
+use (16 byte blobs on SQLite, the native uuid type on Postgres).
+
+For each storage it fills a table shaped like the encounter table, a UUID
+primary key plus an indexed UUID reference to a parent, and reports the size
+of the table and both indexes and the latency of primary key lookups and of
+reference lookups, as JSON.
+
+Examples, from the repository root:
+
+    python bench/uuid_storage.py --rows 200000 --lookups 20000
+    DEMO_DATABASE_DRIVER=postgresql DEMO_DATABASE_NAME=postgres ... python bench/uuid_storage.py
+
+SQLite runs use a fresh file per storage in the system temp directory.
+Postgres runs use the database named by the DEMO_DATABASE_* settings and drop
+their tables afterwards.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+API_DIR = os.path.join(ROOT, "src", "api")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark text and compact UUID key storage")
+    parser.add_argument("--rows", type=int, default=100000, help="rows to insert")
+    parser.add_argument("--parents", type=int, default=20000, help="distinct referenced parent IDs")
+    parser.add_argument("--lookups", type=int, default=10000, help="lookups to time per kind")
+    parser.add_argument("--random-seed", type=int, default=1, help="seed for the IDs looked up")
+    parser.add_argument("--output", help="write the JSON report to this file as well as stdout")
+    return parser.parse_args(argv)
+
+# SQLite file per storage. Text is stored as peewee's UUIDField used to, 32
+# hex characters.
+class SqliteTarget:
+    storages = { "text": ("TEXT", lambda id: id.hex), "compact": ("BLOB", lambda id: id.bytes) }
+
+    def __init__(self, storage: str):
+        self.column_type, self.encode = self.storages[storage]
+        self.path = os.path.join(tempfile.gettempdir(), f"demo-python-api-uuid-{storage}.db")
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute(f'CREATE TABLE "item" ("id" {self.column_type} NOT NULL PRIMARY KEY, "parent_id" {self.column_type} NOT NULL)')
+        self.conn.execute('CREATE INDEX "item_parent_id" ON "item" ("parent_id")')
+
+    def insert(self, rows):
+        with self.conn:
+            self.conn.executemany('INSERT INTO "item" VALUES (?, ?)', rows)
+        self.conn.execute("VACUUM")
+
+    def sizes(self) -> dict:
+        try:
+            return dict(self.conn.execute(
+                'SELECT "name", SUM("pgsize") FROM "dbstat" WHERE "name" LIKE \'%item%\' GROUP BY "name"').fetchall())
+        except sqlite3.OperationalError:
+            # SQLite built without the dbstat table, fall back to the file
+            return { "file": os.path.getsize(self.path) }
+
+    def lookup(self, sql: str, value):
+        return self.conn.execute(sql.replace("%s", "?"), (value,)).fetchall()
+
+    def close(self):
+        self.conn.close()
+        os.remove(self.path)
+
+# Table per storage in the configured Postgres database
+class PostgresTarget:
+    storages = { "text": ("TEXT", str), "compact": ("UUID", str) }
+
+    def __init__(self, storage: str):
+        from db_config import db
+        self.db = db
+        self.column_type, self.encode = self.storages[storage]
+        db.execute_sql('DROP TABLE IF EXISTS "item"')
+        db.execute_sql(f'CREATE TABLE "item" ("id" {self.column_type} NOT NULL PRIMARY KEY, "parent_id" {self.column_type} NOT NULL)')
+        db.execute_sql('CREATE INDEX "item_parent_id" ON "item" ("parent_id")')
+
+    def insert(self, rows):
+        with self.db.atomic():
+            for batch in range(0, len(rows), 1000):
+                chunk = rows[batch:batch + 1000]
+                values = ", ".join(["(%s, %s)"] * len(chunk))
+                self.db.execute_sql(f'INSERT INTO "item" VALUES {values}', [ value for row in chunk for value in row ])
+        self.db.execute_sql('VACUUM ANALYZE "item"')
+
+    def sizes(self) -> dict:
+        sizes = { name: size for name, size in self.db.execute_sql(
+            "SELECT indexname, pg_relation_size(quote_ident(indexname)) FROM pg_indexes WHERE tablename = 'item'").fetchall() }
+        sizes["item"], = self.db.execute_sql("SELECT pg_relation_size('item')").fetchone()
+        return sizes
+
+    def lookup(self, sql: str, value):
+        return self.db.execute_sql(sql, (value,)).fetchall()
+
+    def close(self):
+        self.db.execute_sql('DROP TABLE "item"')
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def time_lookups(target, sql: str, values) -> dict:
+    samples = []
+    for value in values:
+        start = time.perf_counter()
+        target.lookup(sql, value)
+        samples.append(time.perf_counter() - start)
+    return {
+        "p50_us": round(percentile(samples, 0.50) * 1e6, 1),
+        "p99_us": round(percentile(samples, 0.99) * 1e6, 1),
+        "mean_us": round(sum(samples) / len(samples) * 1e6, 1),
+    }
+
+def run(args, target_class) -> dict:
+    random.seed(args.random_seed)
+    parents = [ uuid.UUID(int=random.getrandbits(128), version=4) for _ in range(args.parents) ]
+    ids = [ uuid.UUID(int=random.getrandbits(128), version=4) for _ in range(args.rows) ]
+    rows = [ (id, random.choice(parents)) for id in ids ]
+    report = {}
+    for storage in target_class.storages:
+        target = target_class(storage)
+        try:
+            start = time.perf_counter()
+            target.insert([ (target.encode(id), target.encode(parent)) for id, parent in rows ])
+            insert_seconds = time.perf_counter() - start
+            report[storage] = {
+                "insert_seconds": round(insert_seconds, 3),
+                "size_bytes": target.sizes(),
+                "id_lookup": time_lookups(target, 'SELECT "parent_id" FROM "item" WHERE "id" = %s',
+                    [ target.encode(id) for id in random.sample(ids, min(args.lookups, len(ids))) ]),
+                "parent_lookup": time_lookups(target, 'SELECT "id" FROM "item" WHERE "parent_id" = %s',
+                    [ target.encode(parent) for parent in random.sample(parents, min(args.lookups, len(parents))) ]),
+            }
+        finally:
+            target.close()
+    return report
+
+def main(argv=None):
+    args = parse_args(argv)
+    if os.environ.get("DEMO_DATABASE_DRIVER") == "postgresql":
+        sys.path.insert(0, API_DIR)
+        driver, target_class = "postgresql", PostgresTarget
+    else:
+        driver, target_class = "sqlite", SqliteTarget
+    report = {
+        "driver": driver,
+        "rows": args.rows,
+        "parents": args.parents,
+        "lookups": args.lookups,
+        "storage": run(args, target_class),
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 import os
 import pytest
 import sys
@@ -5,9 +6,41 @@ import sys
 # Add the root directory of your project to sys.path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), './src/api')))
 
+from cpt_cache import cpt_code_cache
+from db_config import db
 from db_migrate import migrate
+from response_cache import response_cache
 
 # set things up just like the app does
 @pytest.fixture(scope="session", autouse=True)
 def setup_database():
     migrate()
+    cpt_code_cache.load()
+
+# tests write rows straight through the models, which doesn't invalidate
+# cached responses, so start every test with an empty cache
+@pytest.fixture(autouse=True)
+def clear_response_cache():
+    response_cache.clear()
+
+# Assert how many SQL statements run inside a block so that extra round trips
+# fail the tests, e.g.
+#   with assert_num_queries(1):
+#       response = await ac.get(...)
+# The statements are collected in the list yielded by the block.
+@pytest.fixture
+def assert_num_queries():
+    @contextmanager
+    def check(expected):
+        queries = []
+        execute_sql = db.execute_sql
+        def counting_execute_sql(sql, params=None, *args, **kwargs):
+            queries.append(sql)
+            return execute_sql(sql, params, *args, **kwargs)
+        db.execute_sql = counting_execute_sql
+        try:
+            yield queries
+        finally:
+            del db.execute_sql
+        assert len(queries) == expected, f"expected {expected} queries, got {len(queries)}: {queries}"
+    return check
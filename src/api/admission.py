@@ -0,0 +1,217 @@
+import asyncio
+import collections
+import json
+import math
+import threading
+from starlette.routing import Match
+
+from config import log, settings
+from db_config import query_hooks
+
+# Admission control. When the database slows down, requests would otherwise
+# pile up on the worker without limit, every one of them slower than the last,
+# until even the health checks time out and the pod is restarted.
+#
+# Each route (method and path template) gets a concurrency limit, by default
+# ADMISSION_DEFAULT_LIMIT or the route's entry in ADMISSION_LIMITS. Requests
+# over the limit wait in the route's queue of at most ADMISSION_QUEUE_SIZE for
+# at most ADMISSION_QUEUE_TIMEOUT seconds. A request finding the queue full,
+# or still waiting at its deadline, gets a 503 with a Retry-After header right
+# away instead of a slow answer later.
+#
+# Limits adapt to database latency: every ADMISSION_ADJUST_SECONDS the mean
+# statement time since the last adjustment is compared with
+# ADMISSION_DB_LATENCY_TARGET. Over the target every limit is scaled down by a
+# quarter, down to a tenth of the configured limit (and at least 1); at or
+# under it they grow back a tenth at a time. A target of 0 keeps the limits
+# fixed.
+#
+# Health checks and metrics scrapes are never limited, nor are requests that
+# don't match a route. Requests the response cache answers are limited like
+# any other, since it looks up the patient's version in the database first.
+
+EXEMPT_PATHS = frozenset(["/health/", "/metrics"])
+
+# Concurrency limit and wait queue of one route
+class Limiter:
+    def __init__(self, limit: int, queue_size: int, queue_timeout: float):
+        self.base_limit = limit
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters = collections.deque()
+        self._counters = {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0}
+
+    # Wait for a slot, returning False if the queue is full or the wait ran out
+    async def acquire(self) -> bool:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self._counters["admitted"] += 1
+            return True
+        if len(self._waiters) >= self.queue_size:
+            self._counters["rejected"] += 1
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._counters["queued"] += 1
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._counters["timed_out"] += 1
+            return False
+        except asyncio.CancelledError:
+            # given the slot as the request was cancelled, hand it on
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        self._counters["admitted"] += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    # Hand free slots to waiting requests, oldest first
+    def wake(self):
+        while self._waiters and self.active < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    def scale(self, factor: float):
+        self.limit = max(1, math.floor(self.base_limit * factor))
+        self.wake()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": len(self._waiters),
+            **self._counters,
+        }
+
+# Scales limits by the database latency seen by a query hook, see above
+class LatencyController:
+    def __init__(self, target: float, min_scale: float = 0.1):
+        self.target = target
+        self.min_scale = min_scale
+        self.scale = 1.0
+        self.latency = 0.0
+        self._lock = threading.Lock()
+        self._seconds = 0.0
+        self._statements = 0
+
+    # query hook, run on the executor threads
+    def observe(self, sql: str, seconds: float):
+        with self._lock:
+            self._seconds += seconds
+            self._statements += 1
+
+    # New scale for the statements seen since the last call
+    def adjust(self) -> float:
+        with self._lock:
+            seconds, statements = self._seconds, self._statements
+            self._seconds, self._statements = 0.0, 0
+        if not self.target:
+            return self.scale
+        self.latency = seconds / statements if statements else 0.0
+        if self.latency > self.target:
+            scale = max(self.min_scale, self.scale * 0.75)
+            if scale < self.scale:
+                log.warning("database slow, lowering admission limits", latency=self.latency, scale=scale)
+        else:
+            scale = min(1.0, self.scale + 0.1)
+        self.scale = scale
+        return scale
+
+# Route limits, a dict of "METHOD /path/template" to limit
+def route_limits(config=settings) -> dict:
+    return dict(config.get("ADMISSION_LIMITS") or {})
+
+class Admission:
+    def __init__(self, default_limit: int = None, limits: dict = None, queue_size: int = None,
+                 queue_timeout: float = None, retry_after: int = None, latency_target: float = None):
+        self.default_limit = int(settings.ADMISSION_DEFAULT_LIMIT if default_limit is None else default_limit)
+        self.limits = route_limits() if limits is None else dict(limits)
+        self.queue_size = int(settings.ADMISSION_QUEUE_SIZE if queue_size is None else queue_size)
+        self.queue_timeout = float(settings.ADMISSION_QUEUE_TIMEOUT if queue_timeout is None else queue_timeout)
+        self.retry_after = int(settings.ADMISSION_RETRY_AFTER if retry_after is None else retry_after)
+        self.controller = LatencyController(float(settings.ADMISSION_DB_LATENCY_TARGET if latency_target is None else latency_target))
+        self.limiters = {}
+
+    def limiter(self, route: str) -> Limiter:
+        limiter = self.limiters.get(route)
+        if limiter is None:
+            limiter = Limiter(int(self.limits.get(route, self.default_limit)), self.queue_size, self.queue_timeout)
+            limiter.scale(self.controller.scale)
+            self.limiters[route] = limiter
+        return limiter
+
+    # Apply the controller's latest scale to every route
+    def adjust(self):
+        scale = self.controller.adjust()
+        for limiter in self.limiters.values():
+            limiter.scale(scale)
+
+    def stats(self) -> dict:
+        return {
+            "scale": self.controller.scale,
+            "db_latency": self.controller.latency,
+            "routes": { route: limiter.stats() for route, limiter in self.limiters.items() },
+        }
+
+admission = Admission()
+query_hooks.append(admission.controller.observe)
+
+# ASGI middleware admitting requests through their route's limiter. It
+# matches routes itself, since it runs before the router, and leaves the
+# matched route in the scope for MetricsMiddleware to label rejections with.
+class AdmissionMiddleware:
+    def __init__(self, app, routes: list, admission: Admission = admission):
+        self.app = app
+        self.routes = routes
+        self.admission = admission
+
+    def match(self, scope):
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route = self.match(scope)
+        if route is None or route.path in EXEMPT_PATHS:
+            return await self.app(scope, receive, send)
+        scope["route"] = route
+        limiter = self.admission.limiter(f"{scope['method']} {route.path}")
+        if not await limiter.acquire():
+            log.info("request shed", method=scope["method"], route=route.path)
+            return await self.reject(send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
+
+    async def reject(self, send):
+        body = json.dumps({ "detail": "server busy" }).encode()
+        await send({ "type": "http.response.start", "status": 503, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(self.admission.retry_after).encode()),
+        ] })
+        await send({ "type": "http.response.body", "body": body })
+
+# Background task adjusting the limits to database latency until cancelled
+async def adapt_admission_limits(admission: Admission = admission):
+    interval = float(settings.ADMISSION_ADJUST_SECONDS)
+    while True:
+        await asyncio.sleep(interval)
+        admission.adjust()
@@ -1,21 +1,93 @@
+# imported first to time the rest of the imports
+import startup
+
+import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 
-from config import log
-from db_migrate import migrate
+from admission import AdmissionMiddleware, adapt_admission_limits
+from config import log, log_pipeline, settings
+from cpt_cache import cpt_code_cache, refresh_cpt_code_cache
+from db_config import db, db_pooled
+from db_executor import run_db, shutdown_db_executor
+from db_middleware import DatabaseConnectionMiddleware, ReplicaRoutingMiddleware, monitor_replicas
+from db_migrate import migrate, startup_migration_mode, wait_for_schema
+from idempotency import cleanup_idempotency_keys
+from metrics import MetricsMiddleware, monitor_event_loop_lag
+from response_cache import ResponseCacheMiddleware
 from routers import routers
 
-# migrate the database on startup, including preload data
+# Bring the schema up to date on startup, or check that it is, depending on
+# MIGRATE_ON_STARTUP (see db_migrate), then load the CPT code cache. Each
+# phase is timed and reported once the app is ready.
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     log.info("starting up")
-    migrate()
+    with startup.phase("db_connect"):
+        db.connect(reuse_if_open=True)
+    match startup_migration_mode():
+        case "run":
+            with startup.phase("migrate"):
+                migrate()
+        case "verify":
+            # polls and sleeps on the executor, so the loop stays free
+            with startup.phase("verify_schema"):
+                await run_db(wait_for_schema)
+    with startup.phase("cpt_cache"):
+        cpt_code_cache.load()
+    # requests check out their own pooled connections
+    if db_pooled:
+        db.close()
+    startup.report()
+    cpt_refresh = asyncio.create_task(refresh_cpt_code_cache())
+    loop_lag = asyncio.create_task(monitor_event_loop_lag())
+    idempotency_cleanup = asyncio.create_task(cleanup_idempotency_keys())
+    replica_check = asyncio.create_task(monitor_replicas())
+    admission_limits = asyncio.create_task(adapt_admission_limits())
     yield
     log.info("shutting down")
+    cpt_refresh.cancel()
+    loop_lag.cancel()
+    idempotency_cleanup.cancel()
+    replica_check.cancel()
+    admission_limits.cancel()
+    shutdown_db_executor()
+    if db_pooled:
+        db.close_all()
+    # write out the logs still queued
+    log_pipeline.stop()
 
 # create the FastAPI app
 app = FastAPI(lifespan=lifespan)
 
+# answer reads under a patient from the cache and conditional GETs with 304
+if settings.RESPONSE_CACHE:
+    app.add_middleware(ResponseCacheMiddleware)
+
+# limit concurrent requests per route and shed the excess, in front of the
+# response cache since its version lookup is a database read too
+if settings.ADMISSION_CONTROL:
+    app.add_middleware(AdmissionMiddleware, routes=app.routes)
+
+# check pooled connections out per database call, 503 when the pool is exhausted
+if db_pooled:
+    app.add_middleware(DatabaseConnectionMiddleware)
+
+# read from the replicas in GET requests, including the response cache's
+# version lookups
+if db.replicas is not None:
+    app.add_middleware(ReplicaRoutingMiddleware)
+
+# profile requests that ask for it, only when enabled
+if settings.PROFILING:
+    from profiling import ProfilingMiddleware
+    app.add_middleware(ProfilingMiddleware)
+
+# time every request, including the connection checkout
+app.add_middleware(MetricsMiddleware)
+
 # add the routers to the app
 for router in routers:
     app.include_router(router)
+
+startup.mark("import")
@@ -1,6 +1,9 @@
+import atexit
 from dynaconf import Dynaconf
 import structlog
 
+from log_pipeline import LogPipeline, configure as configure_logging
+
 # Load settings from a .env file if present, otherwise get them from the environment.
 # Expected environment variables:
 # - DEMO_DATABASE_DRIVER: sqlite or postgresql
@@ -9,29 +12,131 @@ import structlog
 # - DEMO_DATABASE_PASSWORD: database password (only for postgresql)
 # - DEMO_DATABASE_HOST: database host (only for postgresql)
 # - DEMO_DATABASE_PORT: database port (only for postgresql)
+# - DEMO_DATABASE_REPLICA_HOSTS: read replica hosts, or database files for sqlite, that GET requests read from
+# - DEMO_DATABASE_REPLICA_MAX_LAG: seconds of replication lag after which a replica isn't read from
+# - DEMO_DATABASE_REPLICA_RETRY_SECONDS: seconds a failed replica isn't read from
+# - DEMO_DATABASE_REPLICA_CHECK_SECONDS: how often replica lag is measured
+# - DEMO_DATABASE_POOL: true to check pooled connections out per request (postgresql or sqlite file)
+# - DEMO_DATABASE_POOL_MAX_CONNECTIONS: maximum pooled connections per worker
+# - DEMO_DATABASE_POOL_IDLE_TIMEOUT: seconds an unused pooled connection is kept open
+# - DEMO_DATABASE_POOL_STALE_TIMEOUT: seconds after which a pooled connection is recycled
+# - DEMO_DATABASE_POOL_WAIT_TIMEOUT: seconds to wait for a free pooled connection (0 waits forever)
+# - DEMO_CPT_IMPORT_CHUNK_SIZE: rows per INSERT when bulk loading CPT codes
+# - DEMO_CPT_CACHE_REFRESH_SECONDS: how often each replica checks the CPT code table for changes
+# - DEMO_PAGE_DEFAULT_LIMIT: items per page of list endpoints when no limit is given
+# - DEMO_PAGE_MAX_LIMIT: largest allowed page size
+# - DEMO_STREAM_BATCH_SIZE: rows fetched per query when streaming NDJSON
+# - DEMO_BATCH_MAX_ITEMS: most items accepted by one batch request
+# - DEMO_BATCH_CHUNK_SIZE: items resolved and inserted per transaction in batch requests
+# - DEMO_DB_EXECUTOR: thread (run queries in a bounded thread pool) or inline (run on the event loop)
+# - DEMO_DB_EXECUTOR_THREADS: maximum number of threads running database calls
+# - DEMO_METRICS_LOOP_LAG_INTERVAL: seconds between event loop lag samples
+# - DEMO_PROFILING: true to profile requests sent with an X-Profile header
+# - DEMO_PROFILING_INTERVAL: seconds between profiler stack samples
+# - DEMO_PROFILING_DIR: writable directory stored profiles are written to
+# - DEMO_RESPONSE_CACHE: true to cache GET responses under a patient and answer If-None-Match
+# - DEMO_RESPONSE_CACHE_MAX_ENTRIES: most responses kept in each worker's cache
+# - DEMO_RESPONSE_CACHE_TTL: most seconds a cached response is kept for
+# - DEMO_RESPONSE_CACHE_BACKEND: optional shared cache backend, "memory" or "module:factory"
+# - DEMO_HOST: address the server listens on
+# - DEMO_PORT: port the server listens on
+# - DEMO_WORKERS: number of server worker processes (0 for one per CPU)
+# - DEMO_SHUTDOWN_TIMEOUT: seconds to let in-flight requests finish after SIGTERM
+# - DEMO_MIGRATE_ON_STARTUP: run, verify or skip schema migrations when the app starts (see db_migrate)
+# - DEMO_MIGRATE_VERIFY_TIMEOUT: seconds to wait for the schema to be migrated in verify mode
+# - DEMO_EXPORT_BATCH_SIZE: rows read per query and written per row group by line item exports
+# - DEMO_LOG_ASYNC: true to write logs from a background thread (see log_pipeline), false to write them inline
+# - DEMO_LOG_QUEUE_SIZE: most log records waiting to be written before new ones are dropped
+# - DEMO_LOG_BATCH_SIZE: most log records written at once
+# - DEMO_LOG_SAMPLE_RATES: fraction of info events to keep by event name, e.g. '@json {"patient not found": 0.1}'
+# - DEMO_LOG_STREAM: stdout or stderr
+# - DEMO_IDEMPOTENCY_KEY_TTL: seconds the response to a POST with an Idempotency-Key header is kept for retries
+# - DEMO_IDEMPOTENCY_CLEANUP_SECONDS: how often expired idempotency keys are deleted
+# - DEMO_ADMISSION_CONTROL: true to limit concurrent requests per route and shed load with 503s (see admission)
+# - DEMO_ADMISSION_DEFAULT_LIMIT: concurrent requests per route, per worker
+# - DEMO_ADMISSION_LIMITS: limits for particular routes, e.g. '@json {"GET /export/line_items": 2}'
+# - DEMO_ADMISSION_QUEUE_SIZE: most requests waiting per route before new ones are rejected
+# - DEMO_ADMISSION_QUEUE_TIMEOUT: seconds a request waits for its route before it's rejected
+# - DEMO_ADMISSION_RETRY_AFTER: Retry-After seconds sent with rejections
+# - DEMO_ADMISSION_DB_LATENCY_TARGET: mean database statement seconds over which limits are lowered (0 keeps them fixed)
+# - DEMO_ADMISSION_ADJUST_SECONDS: how often limits are adjusted to database latency
 
-settings = Dynaconf(
-    default_settings={
-        'CPT_CODES_CSV': 'cpt_codes.csv',
+# Defaults for settings not given in the environment. Dynaconf takes these as
+# uppercase keyword arguments.
+default_settings = {
+    'CPT_CODES_CSV': 'cpt_codes.csv',
+    'DATABASE_POOL': False,
+    'DATABASE_POOL_MAX_CONNECTIONS': 20,
+    'DATABASE_POOL_IDLE_TIMEOUT': 300,
+    'DATABASE_POOL_STALE_TIMEOUT': 3600,
+    'DATABASE_POOL_WAIT_TIMEOUT': 10,
+    'DATABASE_REPLICA_HOSTS': [],
+    'DATABASE_REPLICA_MAX_LAG': 5,
+    'DATABASE_REPLICA_RETRY_SECONDS': 30,
+    'DATABASE_REPLICA_CHECK_SECONDS': 5,
+    'CPT_IMPORT_CHUNK_SIZE': 1000,
+    'CPT_CACHE_REFRESH_SECONDS': 60,
+    'PAGE_DEFAULT_LIMIT': 100,
+    'PAGE_MAX_LIMIT': 1000,
+    'STREAM_BATCH_SIZE': 1000,
+    'BATCH_MAX_ITEMS': 50000,
+    'BATCH_CHUNK_SIZE': 500,
+    'DB_EXECUTOR': 'thread',
+    'DB_EXECUTOR_THREADS': 8,
+    'METRICS_LOOP_LAG_INTERVAL': 0.5,
+    'PROFILING': False,
+    'PROFILING_INTERVAL': 0.001,
+    'PROFILING_DIR': '/tmp/profiles',
+    'RESPONSE_CACHE': True,
+    'RESPONSE_CACHE_MAX_ENTRIES': 10000,
+    'RESPONSE_CACHE_TTL': 5,
+    'RESPONSE_CACHE_BACKEND': '',
+    'HOST': '127.0.0.1',
+    'PORT': 8080,
+    'WORKERS': 1,
+    'SHUTDOWN_TIMEOUT': 20,
+    'MIGRATE_ON_STARTUP': 'run',
+    'MIGRATE_VERIFY_TIMEOUT': 60,
+    'EXPORT_BATCH_SIZE': 10000,
+    'LOG_ASYNC': True,
+    'LOG_QUEUE_SIZE': 10000,
+    'LOG_BATCH_SIZE': 500,
+    'LOG_SAMPLE_RATES': {},
+    'LOG_STREAM': 'stdout',
+    'IDEMPOTENCY_KEY_TTL': 86400,
+    'IDEMPOTENCY_CLEANUP_SECONDS': 300,
+    'ADMISSION_CONTROL': True,
+    'ADMISSION_DEFAULT_LIMIT': 64,
+    'ADMISSION_LIMITS': {
+        'GET /export/line_items': 2,
+        'POST /batch/patients/': 4,
+        'POST /batch/encounters/': 4,
+        'POST /batch/line_items/': 4,
     },
+    'ADMISSION_QUEUE_SIZE': 128,
+    'ADMISSION_QUEUE_TIMEOUT': 2,
+    'ADMISSION_RETRY_AFTER': 1,
+    'ADMISSION_DB_LATENCY_TARGET': 0.1,
+    'ADMISSION_ADJUST_SECONDS': 1,
+}
+
+settings = Dynaconf(
+    **default_settings,
     envvar_prefix="DEMO",
     settings_files=['.env'],
     environments=True,
     load_dotenv=True,
 )
 
-# Setup JSON structure logging
+# Setup JSON structure logging, written off the request path (see log_pipeline)
 
-structlog.configure(
-    processors=[
-        structlog.stdlib.add_log_level,
-        structlog.processors.TimeStamper(fmt="iso"),
-        structlog.processors.JSONRenderer()
-    ],
-    context_class=dict,
-    logger_factory=structlog.PrintLoggerFactory(),
-    wrapper_class=structlog.BoundLogger,
-    cache_logger_on_first_use=True,
+log_pipeline = LogPipeline(
+    queue_size=int(settings.LOG_QUEUE_SIZE),
+    batch_size=int(settings.LOG_BATCH_SIZE),
+    sample_rates={ event: float(rate) for event, rate in settings.LOG_SAMPLE_RATES.items() },
+    stream=settings.LOG_STREAM,
 )
+configure_logging(log_pipeline, asynchronous=bool(settings.LOG_ASYNC))
+atexit.register(log_pipeline.stop)
 
 log = structlog.get_logger()
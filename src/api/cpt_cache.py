@@ -0,0 +1,98 @@
+import asyncio
+import hashlib
+import time
+from peewee import fn
+from typing import Dict, Optional, Tuple
+
+from config import log, settings
+from db_config import background_connection
+from db_executor import run_db
+from model import CPTCode, DataImport, CPT_CODES_IMPORT
+
+# In-process cache of the CPT code table, mapping code to (id, description).
+# The table is small and rarely changes, so it is loaded whole at startup and
+# line item requests look codes up here instead of querying for them.
+#
+# Each replica checks a cheap version stamp of the table every
+# CPT_CACHE_REFRESH_SECONDS and reloads when it changes, so updated codes
+# reach every replica without a restart. Codes missing from the cache are
+# read through from the database by the caller and added with put().
+class CPTCodeCache:
+    def __init__(self):
+        self._codes: Dict[str, Tuple[int, str]] = {}
+        self.version = None
+        # short form of the version for ETags, see response_cache
+        self.stamp = "0"
+        self.loaded_at = None
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    # Version stamp of the CPT code table: the checksum of the last bulk
+    # import, which changes when descriptions are updated, plus the row count
+    # and max id, which change when codes are added outside the importer
+    def _current_version(self) -> str:
+        checksum = DataImport.select(DataImport.checksum).where(DataImport.name == CPT_CODES_IMPORT)
+        count, max_id, checksum = (CPTCode
+            .select(fn.COUNT(CPTCode.id), fn.MAX(CPTCode.id), checksum)
+            .tuples()
+            .get())
+        return f"{checksum}:{count}:{max_id}"
+
+    # Load the whole table, replacing the cached codes
+    def load(self):
+        version = self._current_version()
+        self._codes = {
+            code: (id, description)
+            for id, code, description in CPTCode.select(CPTCode.id, CPTCode.code, CPTCode.description).tuples()
+        }
+        self.version = version
+        self.stamp = hashlib.blake2b(version.encode(), digest_size=4).hexdigest()
+        self.loaded_at = time.time()
+        self.reloads += 1
+        log.info("loaded CPT code cache", cpt_codes=len(self._codes), version=version)
+
+    # Reload if the table changed since the last load. Returns True on reload.
+    def refresh(self) -> bool:
+        if self._current_version() == self.version:
+            return False
+        self.load()
+        return True
+
+    # Look a code up in memory. Returns (id, description), or None on a miss.
+    def get(self, code: str) -> Optional[Tuple[int, str]]:
+        entry = self._codes.get(code)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    # Remember a code read through from the database after a miss
+    def put(self, code: str, id: int, description: str):
+        self._codes[code] = (id, description)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._codes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+        }
+
+cpt_code_cache = CPTCodeCache()
+
+# Background task refreshing the cache until cancelled
+async def refresh_cpt_code_cache(cache: CPTCodeCache = cpt_code_cache):
+    interval = float(settings.CPT_CACHE_REFRESH_SECONDS)
+    def refresh():
+        with background_connection():
+            return cache.refresh()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_db(refresh)
+        except Exception as e:
+            log.error("failure refreshing CPT code cache", error=str(e))
@@ -1,24 +1,431 @@
+import contextlib
+import heapq
+import itertools
 import os
-from peewee import SqliteDatabase, PostgresqlDatabase
-from config import settings
+import threading
+import time
+from contextvars import ContextVar
+from peewee import SqliteDatabase, PostgresqlDatabase, OperationalError, InterfaceError, _ConnectionState
+from playhouse.pool import PooledSqliteDatabase, PooledPostgresqlDatabase, MaxConnectionsExceeded
+from playhouse.shortcuts import ReconnectMixin
 
-# Initialize the database connection based on driver type
-db = None
-db_driver = settings.DATABASE_DRIVER
-match db_driver:
-    # SQLite database from file
-    case 'sqlite':
-        db = SqliteDatabase(settings.DATABASE_NAME)
-    # PostgreSQL database connection
-    case 'postgresql':
-        db = PostgresqlDatabase(
-            settings.DATABASE_NAME,
-            user=settings.DATABASE_USER,
-            password=settings.DATABASE_PASSWORD,
-            host=settings.DATABASE_HOST,
-            port=settings.DATABASE_PORT,
+from config import log, settings
+
+# Connection state kept in a ContextVar instead of a thread local. Executor
+# threads run with a copy of the caller's context, so every query made while
+# handling one request uses the same connection no matter which thread runs
+# it. Code outside a request (startup, tests) shares a default state, except
+# background tasks, which get their own from background_connection().
+class ContextConnectionState(_ConnectionState):
+    def __init__(self):
+        object.__setattr__(self, "_default", {})
+        object.__setattr__(self, "_var", ContextVar("db_state", default=None))
+        super().__init__()
+
+    def _current(self) -> dict:
+        state = self._var.get()
+        return self._default if state is None else state
+
+    def __getattr__(self, name):
+        try:
+            return self._current()[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._current()[name] = value
+
+    # Start a fresh, closed connection state for the current context
+    def begin(self):
+        token = self._var.set({})
+        self.reset()
+        return token
+
+    def end(self, token):
+        self._var.reset(token)
+
+# Pooled databases whose connections run_db() returns to the pool after each
+# call, set for a request by DatabaseConnectionMiddleware. A connection is
+# then only held while a call runs, or across calls if one leaves a
+# transaction open, never while the request awaits something else.
+pooled_request_databases = ContextVar("pooled_request_databases", default=())
+
+# Return the connections of the current context's pooled databases, except
+# ones in a transaction
+def release_pooled_connections(databases):
+    for database in databases:
+        if not database.is_closed() and not database.in_transaction():
+            database.close()
+
+# Functions called as hook(sql, seconds) after every statement, e.g. to count
+# and time queries for metrics. Hooks run on the thread that ran the statement
+# and should be cheap. The time covers executing the statement, not fetching
+# the rows from the cursor afterwards.
+query_hooks = []
+
+class QueryHookMixin:
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        if not query_hooks:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            for hook in query_hooks:
+                hook(sql, seconds)
+
+# Read replicas of the primary database. While replica_reads() is active,
+# e.g. for a GET request (see db_middleware), SELECT statements run on the
+# replicas in turn instead of the primary. Reads go to the primary instead:
+#   - after the primary was written to in the same context, so a request
+#     reads its own writes
+#   - inside a transaction on the primary
+#   - when a replica fails, for retry_seconds, trying the next one first
+#   - when a replica's last measured lag (see check()) is over max_lag
+#   - when no replica is available at all
+class ReplicaSet:
+    def __init__(self, databases, max_lag: float = 5.0, retry_seconds: float = 30.0):
+        self.databases = list(databases)
+        self.max_lag = max_lag
+        self.retry_seconds = retry_seconds
+        self._lag = [0.0] * len(self.databases)
+        self._down_until = [0.0] * len(self.databases)
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self._counters = {"replica_reads": 0, "primary_reads": 0, "failures": 0}
+
+    # Indexes of the replicas reads can go to now, starting with the next one
+    # in turn
+    def available(self) -> list:
+        now = time.monotonic()
+        with self._lock:
+            start = next(self._turn)
+        count = len(self.databases)
+        indexes = [ (start + offset) % count for offset in range(count) ]
+        return [ i for i in indexes if self._down_until[i] <= now and self._lag[i] <= self.max_lag ]
+
+    # Run a read on an available replica and return the cursor, or None to
+    # run it on the primary
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        for i in self.available():
+            try:
+                cursor = self.databases[i].execute_sql(sql, params, *args, **kwargs)
+            except (OperationalError, InterfaceError) as e:
+                self.failed(i, e)
+                continue
+            self._count("replica_reads")
+            return cursor
+        self._count("primary_reads")
+        return None
+
+    # Reads run on several executor threads at once
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    # Skip a replica for retry_seconds and drop its connection
+    def failed(self, index: int, error: Exception):
+        with self._lock:
+            self._counters["failures"] += 1
+            self._down_until[index] = time.monotonic() + self.retry_seconds
+        log.warning("read replica failed", replica=index, error=str(error))
+        database = self.databases[index]
+        try:
+            if isinstance(database, PoolMixin):
+                database.manual_close()
+            else:
+                database.close()
+        except Exception:
+            pass
+
+    # Replication lag of a replica in seconds. A Postgres standby that has
+    # replayed everything it received isn't lagging, however long ago the
+    # last write was. SQLite stand-ins don't replicate.
+    def measure_lag(self, database) -> float:
+        if not isinstance(database, PostgresqlDatabase):
+            return 0.0
+        lag, = database.execute_sql(
+            "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END").fetchone()
+        return float(lag)
+
+    # Measure the lag of every replica, bringing failed replicas back once
+    # they answer again
+    def check(self):
+        for i, database in enumerate(self.databases):
+            try:
+                with background_connection(database):
+                    self._lag[i] = self.measure_lag(database)
+            except Exception as e:
+                self.failed(i, e)
+                continue
+            self._down_until[i] = 0.0
+            if self._lag[i] > self.max_lag:
+                log.warning("read replica lagging", replica=i, lag=self._lag[i])
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            "replicas": len(self.databases),
+            "available": sum(1 for i in range(len(self.databases)) if self._down_until[i] <= now and self._lag[i] <= self.max_lag),
+            "lag": list(self._lag),
+            **counters,
+        }
+
+# Set while reads go to the replicas, holding whether the primary was written
+# to. It's a mutable dict so writes made on executor threads, which run with a
+# copy of the context, are seen by the rest of the request.
+_replica_reads = ContextVar("replica_reads", default=None)
+
+@contextlib.contextmanager
+def replica_reads():
+    token = _replica_reads.set({"wrote": False})
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+def _is_read(sql: str) -> bool:
+    return sql.lstrip()[:6].upper() == "SELECT"
+
+# Routes reads to the database's replicas, when it has them (see ReplicaSet).
+# Comes before QueryHookMixin so a routed statement is only hooked once, by
+# the replica.
+class ReplicaRoutingMixin:
+    replicas: "ReplicaSet | None" = None
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        routing = _replica_reads.get()
+        if routing is not None and self.replicas is not None:
+            if not _is_read(sql):
+                routing["wrote"] = True
+            elif not routing["wrote"] and not self.in_transaction():
+                cursor = self.replicas.execute_sql(sql, params, *args, **kwargs)
+                if cursor is not None:
+                    return cursor
+        return super().execute_sql(sql, params, *args, **kwargs)
+
+class Sqlite(ReplicaRoutingMixin, QueryHookMixin, SqliteDatabase):
+    pass
+
+class Postgresql(ReplicaRoutingMixin, QueryHookMixin, PostgresqlDatabase):
+    pass
+
+# Pool behavior shared by the SQLite and Postgres pools: connections idle for
+# longer than idle_timeout are closed instead of being reused, and counters
+# are kept so pool_stats() can show when the pool saturates.
+class PoolMixin:
+    def __init__(self, *args, idle_timeout=None, **kwargs):
+        self._idle_timeout = idle_timeout
+        self._returned_at = {}
+        self._counters = {"checkouts": 0, "created": 0, "recycled": 0, "exhausted": 0}
+        super().__init__(*args, **kwargs)
+        self._state = ContextConnectionState()
+
+    # Count a checkout that gave up waiting once, here rather than in
+    # _connect(), which the pool retries every 0.1 seconds while it waits
+    def connect(self, reuse_if_open=False):
+        try:
+            return super().connect(reuse_if_open)
+        except MaxConnectionsExceeded:
+            with self._pool_lock:
+                self._counters["exhausted"] += 1
+            raise
+
+    def _connect(self):
+        with self._pool_lock:
+            self._close_idle_expired()
+            idle = { self.conn_key(c) for _, _, c in self._connections }
+            conn = super()._connect()
+            key = self.conn_key(conn)
+            self._counters["checkouts"] += 1
+            if key not in idle:
+                self._counters["created"] += 1
+            self._returned_at.pop(key, None)
+            return conn
+
+    def _close(self, conn, close_conn=False):
+        with self._pool_lock:
+            key = self.conn_key(conn)
+            super()._close(conn, close_conn)
+            if any(c is conn for _, _, c in self._connections):
+                self._returned_at[key] = time.monotonic()
+            else:
+                self._returned_at.pop(key, None)
+
+    # Close available connections that have sat unused past the idle timeout
+    def _close_idle_expired(self):
+        if not self._idle_timeout:
+            return
+        cutoff = time.monotonic() - self._idle_timeout
+        keep = []
+        for entry in self._connections:
+            conn = entry[2]
+            if self._returned_at.get(self.conn_key(conn), cutoff) < cutoff:
+                self._returned_at.pop(self.conn_key(conn), None)
+                super()._close(conn, close_conn=True)
+                self._counters["recycled"] += 1
+            else:
+                keep.append(entry)
+        heapq.heapify(keep)
+        self._connections = keep
+
+    def pool_stats(self) -> dict:
+        with self._pool_lock:
+            return {
+                "max_connections": self._max_connections,
+                "in_use": len(self._in_use),
+                "idle": len(self._connections),
+                **self._counters,
+            }
+
+class PooledSqlite(ReplicaRoutingMixin, QueryHookMixin, PoolMixin, PooledSqliteDatabase):
+    pass
+
+# Reconnect when a pooled connection turns out to be dead, e.g. after a
+# Postgres restart. ReconnectMixin never retries inside a transaction.
+class PooledPostgresql(ReplicaRoutingMixin, QueryHookMixin, PoolMixin, ReconnectMixin, PooledPostgresqlDatabase):
+    reconnect_errors = (
+        (OperationalError, 'terminat'),
+        (OperationalError, 'server closed the connection'),
+        (OperationalError, 'could not receive data'),
+        (InterfaceError, 'connection already closed'),
+    )
+
+# SQLite column types overriding peewee's defaults: UUIDs are stored as 16 byte
+# blobs (see model.CompactUUIDField) rather than text. Postgres has a native
+# uuid type already.
+SQLITE_FIELD_TYPES = {'UUID': 'BLOB'}
+
+# Replica hosts from settings, a list or a comma separated string. For SQLite
+# they're database file names.
+def replica_hosts(config=settings) -> list:
+    hosts = config.get('DATABASE_REPLICA_HOSTS') or []
+    if isinstance(hosts, str):
+        hosts = hosts.split(",")
+    return [ host.strip() for host in hosts if host.strip() ]
+
+# Build the database from settings, with its read replicas when
+# DATABASE_REPLICA_HOSTS names any. Pooled databases check connections out
+# per request (see DatabaseConnectionMiddleware) instead of holding one open.
+def create_database(config=settings):
+    database = _create_database(config)
+    hosts = replica_hosts(config)
+    if hosts:
+        database.replicas = ReplicaSet(
+            [ _create_database(config, host) for host in hosts ],
+            max_lag=float(config.get('DATABASE_REPLICA_MAX_LAG', 5)),
+            retry_seconds=float(config.get('DATABASE_REPLICA_RETRY_SECONDS', 30)),
+        )
+    return database
+
+# Build the primary database, or a replica on another host (another file for
+# SQLite) with the same settings otherwise
+def _create_database(config, host=None):
+    driver = config.get('DATABASE_DRIVER')
+    name = config.get('DATABASE_NAME')
+    if host and driver == 'sqlite':
+        name = host
+    pool_options = {}
+    if config.get('DATABASE_POOL'):
+        pool_options = dict(
+            max_connections=int(config.get('DATABASE_POOL_MAX_CONNECTIONS')),
+            stale_timeout=int(config.get('DATABASE_POOL_STALE_TIMEOUT')),
+            idle_timeout=int(config.get('DATABASE_POOL_IDLE_TIMEOUT')),
+            timeout=int(config.get('DATABASE_POOL_WAIT_TIMEOUT')),
         )
-    case _:
-        raise ValueError(f"unsupported database driver: {db_driver}")
+    match driver:
+        # SQLite database from file
+        case 'sqlite':
+            if name == ':memory:':
+                # An in-memory database only exists on the connection that
+                # created it, so share one connection across threads instead
+                # of letting each executor thread open its own empty database.
+                # This also means it can't be pooled.
+                return Sqlite(name, thread_safe=False, check_same_thread=False, field_types=SQLITE_FIELD_TYPES)
+            if pool_options:
+                return PooledSqlite(name, check_same_thread=False, field_types=SQLITE_FIELD_TYPES, **pool_options)
+            return Sqlite(name, field_types=SQLITE_FIELD_TYPES)
+        # PostgreSQL database connection
+        case 'postgresql':
+            connect_params = dict(
+                user=config.get('DATABASE_USER'),
+                password=config.get('DATABASE_PASSWORD'),
+                host=host or config.get('DATABASE_HOST'),
+                port=config.get('DATABASE_PORT'),
+            )
+            if pool_options:
+                return PooledPostgresql(name, **pool_options, **connect_params)
+            return Postgresql(name, **connect_params)
+        case _:
+            raise ValueError(f"unsupported database driver: {driver}")
+
+# Pool statistics for a database, or None if it isn't pooled
+def pool_stats(database=None) -> dict | None:
+    database = db if database is None else database
+    if isinstance(database, PoolMixin):
+        return database.pool_stats()
+    return None
+
+# Replica statistics for a database, or None if it has no replicas
+def replica_stats(database=None) -> dict | None:
+    database = db if database is None else database
+    if database.replicas is None:
+        return None
+    return database.replicas.stats()
+
+# Transaction for work that reads before it writes. On SQLite it takes the
+# write lock up front: a deferred transaction that has read can't upgrade to a
+# write while another connection writes, and fails at once with "database is
+# locked" instead of waiting out the busy timeout.
+def write_transaction(database=None):
+    database = db if database is None else database
+    if isinstance(database, SqliteDatabase):
+        return database.atomic("IMMEDIATE")
+    return database.atomic()
+
+# Connection handling for background work outside a request. With pooling
+# each call gets its own connection state, so background tasks running at
+# the same time on different threads don't share a connection, and the
+# connection goes back to the pool afterwards. Otherwise the long-lived
+# connection is left open.
+@contextlib.contextmanager
+def background_connection(database=None):
+    database = db if database is None else database
+    if not isinstance(database, PoolMixin):
+        yield
+        return
+    token = database._state.begin()
+    try:
+        with database.connection_context():
+            yield
+    finally:
+        database._state.end(token)
+
+# A process forked from one that has connections open, e.g. a pre-forking
+# server, must not use them: the socket is shared with the parent. Forget them
+# in the child without closing them, which would close them for the parent
+# too. The next query opens a fresh connection.
+def reset_after_fork(database=None):
+    database = db if database is None else database
+    database._state.reset()
+    if isinstance(database, PoolMixin):
+        database._connections = []
+        database._in_use = {}
+        database._returned_at = {}
+    if database.replicas is not None:
+        for replica in database.replicas.databases:
+            reset_after_fork(replica)
+
+# Set up the database based on settings. Nothing connects until the first
+# query or the app startup, so importing this module stays cheap.
+db = create_database()
+db_driver = settings.DATABASE_DRIVER
+# Whether every thread shares a single connection (in-memory SQLite)
+db_shared_connection = not db.thread_safe
+db_pooled = isinstance(db, PoolMixin)
 
-db.connect()
+os.register_at_fork(after_in_child=reset_after_fork)
@@ -0,0 +1,73 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+from config import settings
+from db_config import db_shared_connection, pooled_request_databases, release_pooled_connections
+
+T = TypeVar("T")
+
+# Peewee is synchronous, so calling it straight from an async handler blocks the
+# event loop for the whole round trip and stalls every other request on the
+# worker. Routers hand their database work to run_db() instead, which runs it on
+# a bounded thread pool sized by DB_EXECUTOR_THREADS. Setting DB_EXECUTOR to
+# inline keeps the old behavior of running queries on the event loop.
+#
+# With pooling, a call's connection goes back to the pool when it returns, so
+# calls must return their rows rather than a cursor or lazy query.
+
+executor_mode = settings.DB_EXECUTOR
+if executor_mode not in ('thread', 'inline'):
+    raise ValueError(f"unsupported database executor: {executor_mode}")
+
+# A shared connection can only run one statement at a time, so there is no
+# point in more than one thread.
+executor_threads = 1 if db_shared_connection else int(settings.DB_EXECUTOR_THREADS)
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=executor_threads, thread_name_prefix="db")
+    return _executor
+
+# Run func, then return the pooled connections it checked out
+def _call(databases, func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        release_pooled_connections(databases)
+
+# Run a blocking database call without blocking the event loop.
+# The caller's context variables are copied into the worker thread.
+async def run_db(func: Callable[..., T], /, *args: Any, **kwargs: Any) -> T:
+    databases = pooled_request_databases.get()
+    if executor_mode == 'inline':
+        return _call(databases, func, args, kwargs)
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_get_executor(), functools.partial(ctx.run, _call, databases, func, args, kwargs))
+
+# Threads don't survive a fork, so a forked child starts a new executor
+def _reset_after_fork():
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+# Wait for queued database calls to finish and stop the worker threads.
+def shutdown_db_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
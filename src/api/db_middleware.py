@@ -0,0 +1,81 @@
+import asyncio
+from playhouse.pool import MaxConnectionsExceeded
+
+from config import log, settings
+from db_config import db, pooled_request_databases, replica_reads
+from db_executor import run_db
+
+# ASGI middleware managing pooled connections for each HTTP request, to the
+# database and each read replica. Each request gets its own connection state,
+# and run_db() checks a connection out for each call and returns it when the
+# call ends (see db_config.pooled_request_databases). A request waiting on
+# something else holds no connection, so requests can't stall the pool by
+# holding connections while others wait for one on the executor threads.
+#
+# When no connection frees up within DATABASE_POOL_WAIT_TIMEOUT, the request
+# gets a 503 with Retry-After rather than a 500.
+class DatabaseConnectionMiddleware:
+    def __init__(self, app, database=db):
+        self.app = app
+        self.database = database
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        databases = [self.database]
+        if self.database.replicas is not None:
+            databases += self.database.replicas.databases
+        tokens = [ database._state.begin() for database in databases ]
+        databases_token = pooled_request_databases.set(tuple(databases))
+        started = False
+        async def send_started(message):
+            nonlocal started
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+        try:
+            await self.app(scope, receive, send_started)
+        except MaxConnectionsExceeded:
+            log.warning("database pool exhausted", path=scope["path"])
+            if started:
+                raise
+            await self.unavailable(send)
+        finally:
+            pooled_request_databases.reset(databases_token)
+            for database, token in zip(databases, tokens):
+                if not database.is_closed():
+                    await run_db(database.close)
+                database._state.end(token)
+
+    async def unavailable(self, send):
+        body = b'{"detail":"database busy"}'
+        await send({ "type": "http.response.start", "status": 503, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", b"1"),
+        ] })
+        await send({ "type": "http.response.body", "body": body })
+
+# ASGI middleware sending the reads of GET and HEAD requests to the read
+# replicas (see db_config.ReplicaSet). Writes and everything else stay on the
+# primary.
+class ReplicaRoutingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            return await self.app(scope, receive, send)
+        with replica_reads():
+            await self.app(scope, receive, send)
+
+# Background task measuring replica lag until cancelled
+async def monitor_replicas(database=db):
+    if database.replicas is None:
+        return
+    interval = float(settings.DATABASE_REPLICA_CHECK_SECONDS)
+    while True:
+        try:
+            await run_db(database.replicas.check)
+        except Exception as e:
+            log.error("failure checking read replicas", error=str(e))
+        await asyncio.sleep(interval)
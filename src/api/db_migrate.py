@@ -1,35 +1,292 @@
+import argparse
+import contextlib
 import csv
+import datetime
+import hashlib
+import time
+import uuid
+from peewee import chunked, PostgresqlDatabase
 
 from config import log, settings
 from db_config import db
-from model import Patient, CPTCode, Encounter, LineItem
+from model import Patient, CPTCode, DataImport, Encounter, IdempotencyKey, LineItem, SchemaMigration, CPT_CODES_IMPORT
+
+# SHA-256 of a file, read in blocks so large files aren't loaded whole
+def file_checksum(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
 """
-Preload CPT codes from cpt_codes.csv. Again, this is not something you'd want to
-do like this in production. In production, we'd probably have some kind of
-external process that would read them from an object in a bucket or something
-and add them to the database. We'd also have to deal with updates and deletions
-and how that affects related data in other tables. For the purposes of a demo,
-this is fine.
+Bulk load CPT codes from cpt_codes.csv. The file is streamed in chunks of
+CPT_IMPORT_CHUNK_SIZE rows, each written with one multi-row INSERT that
+updates the description of codes already present, and the whole load runs in
+one transaction. The file's checksum is recorded after a successful load and
+an unchanged file is skipped, so restarts don't pay for the import again.
+
+In production we'd probably have some kind of external process that would
+read them from an object in a bucket or something. We'd also have to deal
+with deletions and how that affects related data in other tables. For the
+purposes of a demo, this is fine. Returns the number of rows loaded, or None
+if the load was skipped.
 """
-def preload_cpt_codes():
-    with open(settings.CPT_CODES_CSV, newline='') as f:
+def preload_cpt_codes(path: str = None, force: bool = False) -> int | None:
+    path = path or settings.CPT_CODES_CSV
+    checksum = file_checksum(path)
+    last_import = DataImport.get_or_none(DataImport.name == CPT_CODES_IMPORT)
+    if last_import and last_import.checksum == checksum and not force:
+        log.info("CPT codes unchanged, skipping preload", checksum=checksum)
+        return None
+
+    rows = 0
+    with open(path, newline='') as f, db.atomic():
         reader = csv.reader(f, delimiter=',', quotechar='"')
-        for row in reader:
-            code, description = row
-            CPTCode.get_or_create(code=code, description=description)
-    num_cpt_codes = CPTCode.select().count()
-    log.info(f"preloaded {num_cpt_codes} CPT codes")
+        for chunk in chunked(reader, int(settings.CPT_IMPORT_CHUNK_SIZE)):
+            (CPTCode
+                .insert_many(chunk, fields=[CPTCode.code, CPTCode.description])
+                .on_conflict(conflict_target=[CPTCode.code], preserve=[CPTCode.description])
+                .execute())
+            rows += len(chunk)
+        (DataImport
+            .insert(name=CPT_CODES_IMPORT, checksum=checksum, rows=rows, imported_at=datetime.datetime.now())
+            .on_conflict(conflict_target=[DataImport.name], preserve=[DataImport.checksum, DataImport.rows, DataImport.imported_at])
+            .execute())
+    log.info(f"preloaded {rows} CPT codes", checksum=checksum)
+    return rows
 
 """
-For now, create the tables if they don't exist.
-In production we'd use a migration tool but this is fine for a demo.
-See above for CPT code preload notes.
+Versioned schema migrations. Each migration is a function registered with
+@migration(version, name); migrate() runs the ones not yet recorded in the
+SchemaMigration table in version order, each in its own transaction along
+with its record, so running it again is a no-op. Migrations are never edited
+once released; schema changes get a new migration instead.
+"""
+MIGRATIONS = []
+
+def migration(version: int, name: str):
+    def register(func):
+        MIGRATIONS.append((version, name, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return register
+
+@migration(1, "create tables")
+def create_tables():
+    db.create_tables([Patient, CPTCode, DataImport, Encounter, LineItem])
+
+# The hot list queries filter on the parent ID and page in (date, id) or id
+# order, so these composite indexes serve both the filter and the ordering.
+# They make the single-column foreign key indexes redundant.
+@migration(2, "index encounters by patient and date")
+def index_encounters_by_patient_date():
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "encounter_patient_id_date_id" ON "encounter" ("patient_id", "date", "id")')
+    db.execute_sql('DROP INDEX IF EXISTS "encounter_patient_id"')
+
+@migration(3, "index line items by encounter")
+def index_line_items_by_encounter():
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "lineitem_encounter_id_id" ON "lineitem" ("encounter_id", "id")')
+    db.execute_sql('DROP INDEX IF EXISTS "lineitem_encounter_id"')
+
+# Version bumped by writes under a patient, for response ETags. Fresh
+# databases already get the column from migration 1.
+@migration(4, "add patient version")
+def add_patient_version():
+    if "version" not in { column.name for column in db.get_columns("patient") }:
+        db.execute_sql('ALTER TABLE "patient" ADD COLUMN "version" INTEGER NOT NULL DEFAULT 0')
+
+# Billing totals across all patients filter encounters by date
+@migration(5, "index encounters by date")
+def index_encounters_by_date():
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "encounter_date_id" ON "encounter" ("date", "id")')
+
+# UUID columns of tables created before UUIDs were stored compactly
+UUID_COLUMNS = [("patient", "id"), ("encounter", "id"), ("encounter", "patient_id"), ("lineitem", "encounter_id")]
+
+# Store UUIDs on SQLite as 16 byte blobs instead of text, see
+# model.CompactUUIDField. SQLite can't change a column's declared type, but a
+# TEXT column keeps blobs as blobs, so the values are rewritten in place and
+# compare and index the same as in new tables. Postgres tables already use
+# the native uuid type.
+@migration(6, "store UUIDs as binary")
+def store_uuids_as_binary():
+    if isinstance(db, PostgresqlDatabase):
+        return
+    db.connection().create_function("uuid_blob", 1, lambda value: uuid.UUID(value).bytes, deterministic=True)
+    db.execute_sql("PRAGMA defer_foreign_keys = ON")
+    for table, column in UUID_COLUMNS:
+        db.execute_sql(f'UPDATE "{table}" SET "{column}" = uuid_blob("{column}") WHERE typeof("{column}") = \'text\'')
+
+# Responses of POSTs made with an Idempotency-Key header, see idempotency
+@migration(7, "create idempotency keys")
+def create_idempotency_keys():
+    db.create_tables([IdempotencyKey])
+
+# Index patient names for search, see model.search_patients. Postgres gets
+# lower() indexes for prefix LIKE matches and trigram indexes on the same
+# expressions, which also serve longer prefixes and keep fuzzy matching open.
+#
+# SQLite gets an FTS5 table holding a copy of each patient's names and their
+# ID, in an unindexed column the search joins on. It doesn't fold diacritics,
+# which lower() on Postgres doesn't either. The patient table has no integer
+# primary key, so its rowids can change on VACUUM and the FTS rows are keyed
+# by patient_search_key instead, whose integer IDs are stable and which finds
+# a patient's row by ID for the triggers keeping the index up to date.
+@migration(8, "index patient names for search")
+def index_patient_names():
+    if isinstance(db, PostgresqlDatabase):
+        db.execute_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for column in ("first_name", "last_name"):
+            db.execute_sql(f'CREATE INDEX IF NOT EXISTS "patient_{column}_lower" ON "patient" (lower("{column}") text_pattern_ops)')
+            db.execute_sql(f'CREATE INDEX IF NOT EXISTS "patient_{column}_trgm" ON "patient" USING gin (lower("{column}") gin_trgm_ops)')
+        return
+    db.execute_sql('CREATE TABLE IF NOT EXISTS "patient_search_key" ("id" INTEGER PRIMARY KEY, "patient_id" BLOB NOT NULL UNIQUE)')
+    db.execute_sql(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS "patient_search" USING fts5('
+        '"patient_id" UNINDEXED, "first_name", "last_name", tokenize="unicode61 remove_diacritics 0")')
+    insert = ('INSERT INTO "patient_search_key"("patient_id") VALUES (new."id"); '
+              'INSERT INTO "patient_search"("rowid", "patient_id", "first_name", "last_name") VALUES ('
+              '(SELECT "id" FROM "patient_search_key" WHERE "patient_id" = new."id"), new."id", new."first_name", new."last_name");')
+    delete = ('DELETE FROM "patient_search" WHERE "rowid" = (SELECT "id" FROM "patient_search_key" WHERE "patient_id" = old."id"); '
+              'DELETE FROM "patient_search_key" WHERE "patient_id" = old."id";')
+    db.execute_sql(f'CREATE TRIGGER IF NOT EXISTS "patient_search_insert" AFTER INSERT ON "patient" BEGIN {insert} END')
+    db.execute_sql(f'CREATE TRIGGER IF NOT EXISTS "patient_search_delete" AFTER DELETE ON "patient" BEGIN {delete} END')
+    db.execute_sql(
+        'CREATE TRIGGER IF NOT EXISTS "patient_search_update" AFTER UPDATE OF "id", "first_name", "last_name" ON "patient" '
+        f'BEGIN {delete} {insert} END')
+    db.execute_sql('INSERT INTO "patient_search_key"("patient_id") SELECT "id" FROM "patient"')
+    db.execute_sql(
+        'INSERT INTO "patient_search"("rowid", "patient_id", "first_name", "last_name") '
+        'SELECT "patient_search_key"."id", "patient"."id", "first_name", "last_name" '
+        'FROM "patient" JOIN "patient_search_key" ON "patient_search_key"."patient_id" = "patient"."id"')
+
+# Latest migration version
+def latest_schema_version() -> int:
+    return MIGRATIONS[-1][0]
+
+# Versions of the migrations applied to the database
+def applied_migrations() -> set:
+    if not db.table_exists(SchemaMigration._meta.table_name):
+        return set()
+    return { version for version, in SchemaMigration.select(SchemaMigration.version).tuples() }
+
+# Versions of the migrations not yet applied to the database
+def pending_migrations() -> list:
+    applied = applied_migrations()
+    return [ version for version, _, _ in MIGRATIONS if version not in applied ]
+
+# Run the pending migrations. Returns the versions that were applied.
+def run_migrations() -> list:
+    db.create_tables([SchemaMigration])
+    applied = applied_migrations()
+    ran = []
+    for version, name, func in MIGRATIONS:
+        if version in applied:
+            continue
+        log.info("applying migration", version=version, name=name)
+        with db.atomic():
+            func()
+            SchemaMigration.create(version=version, name=name)
+        ran.append(version)
+    log.info("schema up to date", version=latest_schema_version(), applied=ran)
+    return ran
+
+# Arbitrary key of the Postgres advisory lock held while migrating
+MIGRATION_LOCK_ID = 7_311_501
+
+"""
+Hold a Postgres advisory lock for the duration of a migration so that replicas
+starting at the same time migrate one after another: the first one to get the
+lock does the work and the others find nothing left to do. The lock belongs
+to the session, so it is released if the process dies. SQLite databases are
+local to one host and aren't locked.
+"""
+@contextlib.contextmanager
+def migration_lock():
+    if not isinstance(db, PostgresqlDatabase):
+        yield
+        return
+    log.info("waiting for migration lock")
+    db.execute_sql("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+    try:
+        yield
+    finally:
+        db.execute_sql("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+
+"""
+Bring the schema up to date and preload data. See above for CPT code preload
+notes.
 """
 def migrate():
-    log.info("creating tables")
-    db.create_tables([Patient, CPTCode, Encounter, LineItem])
-    log.info("tables created")
-    log.info("preloading CPT codes")
-    preload_cpt_codes()
-    log.info("CPT codes preloaded")
+    with migration_lock():
+        log.info("migrating schema")
+        run_migrations()
+        log.info("preloading CPT codes")
+        preload_cpt_codes()
+        log.info("CPT codes preloaded")
+
+"""
+What the app does with the schema when it starts, from MIGRATE_ON_STARTUP:
+  run     apply pending migrations and load CPT codes (the default)
+  verify  wait for the schema to be brought up to date by someone else, e.g.
+          the migration job, failing after MIGRATE_VERIFY_TIMEOUT seconds
+  skip    do nothing
+true and false are accepted for run and skip.
+"""
+def startup_migration_mode(value=None) -> str:
+    value = settings.MIGRATE_ON_STARTUP if value is None else value
+    if isinstance(value, bool):
+        return "run" if value else "skip"
+    mode = str(value).lower()
+    if mode not in ("run", "verify", "skip"):
+        raise ValueError(f"unsupported migration mode: {value}")
+    return mode
+
+# Wait until every migration is applied. Raises RuntimeError on timeout.
+def wait_for_schema(timeout: float = None, interval: float = 2.0):
+    timeout = float(settings.MIGRATE_VERIFY_TIMEOUT) if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    while pending := pending_migrations():
+        if time.monotonic() >= deadline:
+            log.error("schema not up to date", pending=pending)
+            raise RuntimeError(f"schema migrations not applied: {pending}")
+        log.info("waiting for schema migrations", pending=pending)
+        time.sleep(interval)
+    log.info("schema up to date", version=latest_schema_version())
+
+# Command line entry point for running the migration or the CPT code load
+# outside the API, e.g. as a Kubernetes job:
+#   python db_migrate.py migrate
+#   python db_migrate.py status
+#   python db_migrate.py verify --timeout 60
+#   python db_migrate.py load-cpt-codes --csv cpt_codes.csv --force
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Database migration and data loading")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate", help="apply pending schema migrations and preload CPT codes")
+    commands.add_parser("status", help="list applied and pending schema migrations")
+    verify = commands.add_parser("verify", help="wait until all schema migrations are applied")
+    verify.add_argument("--timeout", type=float, default=0, help="seconds to wait (default: fail at once)")
+    load = commands.add_parser("load-cpt-codes", help="bulk load CPT codes from a CSV file")
+    load.add_argument("--csv", help="CSV file of code,description rows (default: DEMO_CPT_CODES_CSV)")
+    load.add_argument("--force", action="store_true", help="load even if the file is unchanged")
+    args = parser.parse_args(argv)
+
+    match args.command:
+        case "migrate":
+            migrate()
+        case "verify":
+            try:
+                wait_for_schema(args.timeout)
+            except RuntimeError as e:
+                raise SystemExit(str(e))
+        case "status":
+            applied = applied_migrations()
+            for version, name, _ in MIGRATIONS:
+                print(f"{version:4d} {'applied' if version in applied else 'pending':8s} {name}")
+        case "load-cpt-codes":
+            preload_cpt_codes(args.csv, force=args.force)
+
+if __name__ == "__main__":
+    main()
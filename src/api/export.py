@@ -0,0 +1,195 @@
+import argparse
+import csv
+import gzip
+import io
+import sys
+from typing import Iterator, List, Tuple
+
+from config import log, settings
+from model import Encounter, LineItem, CPTCode
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Bulk export of line items for analytics, with their encounter, patient and
+# CPT code, as a file or streamed response instead of through the JSON API.
+#
+# Rows are read in keyset batches of EXPORT_BATCH_SIZE ordered by line item
+# ID. Each batch is a short query of its own, so the export holds no
+# transaction or cursor open between batches and works the same on Postgres
+# and SQLite. Each batch is written on to the output as soon as it's read, so
+# memory stays bounded by the batch size whatever the table size.
+#
+# Formats:
+#   parquet  one row group per batch (needs pyarrow)
+#   arrow    Arrow IPC stream, one record batch per batch (needs pyarrow)
+#   csv      gzip compressed CSV with a header row, the fallback without
+#            pyarrow
+
+COLUMNS = ("line_item_id", "patient_id", "encounter_id", "date", "cpt_code", "cpt_code_description", "units")
+
+FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "csv": ("application/gzip", "csv.gz"),
+}
+
+# Formats that can be written here, the first being the default
+def available_formats() -> List[str]:
+    return ["parquet", "arrow", "csv"] if pyarrow is not None else ["csv"]
+
+# One batch of line item rows, in COLUMNS order, filtered to encounter dates
+# between `start` and `end` inclusive and to one patient, starting after the
+# line item ID `after`
+def get_line_item_batch(after: int = 0, limit: int = None, start=None, end=None, patient_id=None) -> List[Tuple]:
+    query = (LineItem
+        .select(LineItem.id, Encounter.patient, Encounter.id, Encounter.date, CPTCode.code, CPTCode.description, LineItem.units)
+        .join(Encounter)
+        .switch(LineItem)
+        .join(CPTCode)
+        .where(LineItem.id > after))
+    if start:
+        query = query.where(Encounter.date >= start)
+    if end:
+        query = query.where(Encounter.date <= end)
+    if patient_id:
+        query = query.where(Encounter.patient == patient_id)
+    return list(query.order_by(LineItem.id).limit(limit).tuples())
+
+# Batches of line item rows until the filtered rows run out
+def line_item_batches(batch_size: int = None, **filters) -> Iterator[List[Tuple]]:
+    batch_size = batch_size or int(settings.EXPORT_BATCH_SIZE)
+    after = 0
+    while True:
+        rows = get_line_item_batch(after, batch_size, **filters)
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        after = rows[-1][0]
+
+# Write-only file object whose written bytes are taken out after each batch,
+# for streaming a writer's output without keeping it
+class ChunkBuffer(io.RawIOBase):
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+# Writes batches of rows to a binary file object in one of FORMATS
+class ExportWriter:
+    def __init__(self, out, format: str):
+        if format not in available_formats():
+            raise ValueError(f"unsupported export format: {format}")
+        self.format = format
+        self.out = out
+        self.rows = 0
+        self._writer = None
+        if format == "csv":
+            self._gzip = gzip.GzipFile(fileobj=out, mode="wb")
+            self._text = io.TextIOWrapper(self._gzip, encoding="utf-8", newline="")
+            self._writer = csv.writer(self._text)
+            self._writer.writerow(COLUMNS)
+        else:
+            self._schema = pyarrow.schema([
+                ("line_item_id", pyarrow.int64()),
+                ("patient_id", pyarrow.string()),
+                ("encounter_id", pyarrow.string()),
+                ("date", pyarrow.date32()),
+                ("cpt_code", pyarrow.string()),
+                ("cpt_code_description", pyarrow.string()),
+                ("units", pyarrow.int32()),
+            ])
+
+    def write(self, rows: List[Tuple]):
+        self.rows += len(rows)
+        if self.format == "csv":
+            self._writer.writerows(rows)
+            self._text.flush()
+            return
+        columns = list(zip(*rows))
+        for index in (1, 2):
+            columns[index] = [ str(value) for value in columns[index] ]
+        batch = pyarrow.record_batch(columns, schema=self._schema)
+        if self._writer is None:
+            self._open()
+        if self.format == "parquet":
+            self._writer.write_batch(batch, row_group_size=len(rows))
+        else:
+            self._writer.write_batch(batch)
+
+    def close(self):
+        if self.format == "csv":
+            self._text.flush()
+            self._text.detach()
+            self._gzip.close()
+            return
+        if self._writer is None:
+            # no rows, write an empty file with the schema
+            self._open()
+        self._writer.close()
+
+    def _open(self):
+        if self.format == "parquet":
+            self._writer = pyarrow.parquet.ParquetWriter(self.out, self._schema, compression="zstd")
+        else:
+            self._writer = pyarrow.ipc.new_stream(self.out, self._schema)
+
+# Export line items to a binary file object. Returns the number of rows.
+def export_line_items(out, format: str = None, batch_size: int = None, **filters) -> int:
+    writer = ExportWriter(out, format or available_formats()[0])
+    for rows in line_item_batches(batch_size, **filters):
+        writer.write(rows)
+    writer.close()
+    return writer.rows
+
+# Command line interface, run from src/api:
+#   python export.py line-items --output line_items.parquet
+#   python export.py line-items --format csv --start 2024-01-01 --end 2024-12-31 > line_items.csv.gz
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk data export")
+    commands = parser.add_subparsers(dest="command", required=True)
+    line_items = commands.add_parser("line-items", help="export line items with their encounter and CPT code")
+    line_items.add_argument("--output", help="file to write (default: standard output)")
+    line_items.add_argument("--format", choices=list(FORMATS), help=f"output format (default: {available_formats()[0]})")
+    line_items.add_argument("--start", help="first encounter date to include, YYYY-MM-DD")
+    line_items.add_argument("--end", help="last encounter date to include, YYYY-MM-DD")
+    line_items.add_argument("--patient-id", help="only export this patient's line items")
+    line_items.add_argument("--batch-size", type=int, help="rows per query (default: DEMO_EXPORT_BATCH_SIZE)")
+    args = parser.parse_args(argv)
+
+    filters = { "start": args.start, "end": args.end, "patient_id": args.patient_id }
+    try:
+        if args.output:
+            with open(args.output, "wb") as out:
+                rows = export_line_items(out, args.format, args.batch_size, **filters)
+        else:
+            # logs go to standard output too, so don't log after the data
+            export_line_items(sys.stdout.buffer, args.format, args.batch_size, **filters)
+            return
+    except ValueError as e:
+        raise SystemExit(str(e))
+    log.info("exported line items", rows=rows, output=args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+from fastapi import HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+from typing import Any, Callable
+
+from config import log, settings
+from db_config import background_connection, write_transaction
+from db_executor import run_db
+import model
+from routers.api_output import dump_json
+
+# Write transactions and idempotency keys for the POST endpoints.
+#
+# run_write() runs a handler's check-and-insert in one transaction on the
+# database executor, so a failed check or insert leaves nothing behind.
+#
+# A POST sent with an "Idempotency-Key" header stores its response under the
+# key, in the same transaction as its writes. A retry with the same key, e.g.
+# after a client timeout, gets the stored response back with an
+# "Idempotent-Replayed: true" header instead of writing again. Keys are scoped
+# to the method and path, and reusing one with a different body is rejected.
+# Only successful responses are stored, so a request that failed can be
+# retried with the same key. Keys expire after IDEMPOTENCY_KEY_TTL seconds and
+# expired keys are deleted in the background.
+#
+# Two requests racing with the same key both run their writes, but only one
+# can store the key: the other's transaction is rolled back and it replays
+# the stored response.
+#
+# Batch endpoints commit chunk by chunk, so a key can't cover a whole batch
+# atomically and they don't take one.
+
+HEADER = "idempotency-key"
+MAX_KEY_LENGTH = 255
+
+# Raised inside the write transaction when another request stored the key
+# first, to roll the transaction back
+class KeyTaken(Exception):
+    pass
+
+def _digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def _transaction(write: Callable[[], Any]) -> Any:
+    with write_transaction():
+        return write()
+
+# Run write() in a transaction and return its result, or with an
+# Idempotency-Key header, a JSON response stored under the key (see above)
+async def run_write(request: Request, write: Callable[[], Any]) -> Any:
+    key = request.headers.get(HEADER)
+    if key is None:
+        return await run_db(_transaction, write)
+    if not key or len(key) > MAX_KEY_LENGTH:
+        log.info("invalid idempotency key")
+        raise HTTPException(status_code=400, detail="invalid idempotency key")
+
+    key = _digest(f"{request.method} {request.url.path} {key}".encode())
+    fingerprint = _digest(await request.body())
+    ttl = int(settings.IDEMPOTENCY_KEY_TTL)
+
+    def write_once():
+        with write_transaction():
+            stored = model.find_idempotency_key(key)
+            if stored is not None:
+                return stored, True
+            response = dump_json(jsonable_encoder(write()))
+            if not model.store_idempotency_key(key, fingerprint, 200, response, ttl):
+                raise KeyTaken()
+            return (fingerprint, 200, response), False
+
+    try:
+        stored, replayed = await run_db(write_once)
+    except KeyTaken:
+        stored, replayed = await run_db(model.find_idempotency_key, key), True
+        if stored is None:
+            # taken and expired in between, which a sane TTL rules out
+            raise HTTPException(status_code=409, detail="idempotency key conflict")
+    stored_fingerprint, status, response = stored
+    if stored_fingerprint != fingerprint:
+        log.info("idempotency key reused", path=request.url.path)
+        raise HTTPException(status_code=422, detail="idempotency key reused with a different request")
+    headers = {"Idempotent-Replayed": "true"} if replayed else {}
+    return Response(response, status_code=status, media_type="application/json", headers=headers)
+
+# Background task deleting expired idempotency keys until cancelled
+async def cleanup_idempotency_keys():
+    interval = float(settings.IDEMPOTENCY_CLEANUP_SECONDS)
+    def cleanup():
+        with background_connection():
+            return model.delete_expired_idempotency_keys()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            deleted = await run_db(cleanup)
+            if deleted:
+                log.info("deleted expired idempotency keys", keys=deleted)
+        except Exception as e:
+            log.error("failure deleting expired idempotency keys", error=str(e))
@@ -0,0 +1,197 @@
+import datetime
+import json
+import os
+import queue
+import random
+import sys
+import threading
+
+import structlog
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Logging off the request path. structlog's processors only add the level and
+# the time and hand the event dict to a bounded queue; a background
+# thread takes records off in batches, renders them as JSON lines (with orjson
+# when installed) and writes each batch with one write and flush. Logging
+# never blocks the event loop: when the queue is full the record is dropped
+# and counted instead.
+#
+# High-volume info events, e.g. "patient not found" under 404-heavy traffic,
+# can be sampled by event name with LOG_SAMPLE_RATES, keeping that fraction of
+# them. Warnings and errors are never sampled. Counts of written, dropped and
+# sampled out records are shown by GET /stats/ and the metrics.
+#
+# The app stops the pipeline at the end of lifespan shutdown, which writes
+# everything still queued; it's also stopped at exit for command line tools.
+
+_STOP = object()
+
+class LogPipeline:
+    def __init__(self, queue_size: int = 10000, batch_size: int = 500, sample_rates: dict = None, stream: str = "stdout"):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.sample_rates = dict(sample_rates or {})
+        self.stream = stream
+        self.queue = queue.Queue(queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.batches = 0
+        self._thread = None
+        self._stopped = False
+
+    # File written to, looked up on every batch so a replaced sys.stdout
+    # (e.g. under pytest) is honored
+    def file(self):
+        return sys.stderr if self.stream == "stderr" else sys.stdout
+
+    # structlog processor dropping a share of the info events named in
+    # sample_rates
+    def sample(self, logger, method_name, event_dict):
+        rate = self.sample_rates.get(event_dict.get("event"))
+        if rate is not None and method_name == "info" and random.random() >= rate:
+            self.sampled_out += 1
+            raise structlog.DropEvent
+        return event_dict
+
+    def put(self, event_dict: dict):
+        if self._stopped:
+            # logged during or after shutdown, write it straight away
+            return self.write([event_dict])
+        try:
+            self.queue.put_nowait(event_dict)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._thread.start()
+
+    # Write everything queued so far and stop the writer thread. Records
+    # logged from here on are written straight away rather than queued behind
+    # the stop. If the writer can't take the stop in time, whatever it left
+    # in the queue is written here.
+    def stop(self, timeout: float = 5.0):
+        if self._thread is None:
+            return
+        self._stopped = True
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        else:
+            self._thread.join(timeout)
+        self._thread = None
+        self._drain()
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                event_dict = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if event_dict is not _STOP:
+                batch.append(event_dict)
+        if batch:
+            self.write(batch)
+
+    # A forked child gets neither the writer thread nor a usable queue lock
+    def after_fork(self):
+        running = self._thread is not None
+        self.queue = queue.Queue(self.queue_size)
+        self._thread = None
+        if running:
+            self.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            if batch:
+                self.write(batch)
+            if stop:
+                return
+
+    def write(self, batch: list):
+        lines = "".join(render(event_dict) + "\n" for event_dict in batch)
+        file = self.file()
+        try:
+            file.write(lines)
+            file.flush()
+        except (OSError, ValueError):
+            # closed or broken output, nothing better to do with the records
+            self.dropped += len(batch)
+            return
+        self.written += len(batch)
+        self.batches += 1
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "batches": self.batches,
+        }
+
+# structlog processor adding the time, formatted by render() on the writer
+# thread
+def add_timestamp(logger, method_name, event_dict):
+    event_dict["timestamp"] = datetime.datetime.now(datetime.timezone.utc)
+    return event_dict
+
+# One JSON log line, with the timestamp in the same ISO format as structlog's
+# TimeStamper
+def render(event_dict: dict) -> str:
+    timestamp = event_dict.get("timestamp")
+    if isinstance(timestamp, datetime.datetime):
+        event_dict["timestamp"] = timestamp.replace(tzinfo=None).isoformat() + "Z"
+    if orjson is not None:
+        return orjson.dumps(event_dict, default=str).decode()
+    return json.dumps(event_dict, default=str)
+
+# structlog logger whose methods all queue the event dict they're given as
+# keyword arguments, which is what structlog passes when the last processor
+# returns a dict
+class QueueLogger:
+    def __init__(self, pipeline: LogPipeline):
+        self._pipeline = pipeline
+
+    def msg(self, **event_dict):
+        self._pipeline.put(event_dict)
+
+    debug = info = warning = warn = error = critical = exception = fatal = log = msg
+
+# Configure structlog to log through the pipeline's queue, or synchronously
+# straight to its stream with the same sampling when not asynchronous
+def configure(pipeline: LogPipeline, asynchronous: bool = True):
+    processors = [pipeline.sample, structlog.stdlib.add_log_level]
+    if asynchronous:
+        processors.append(add_timestamp)
+        logger_factory = lambda *args: QueueLogger(pipeline)
+    else:
+        processors += [structlog.processors.TimeStamper(fmt="iso"), structlog.processors.JSONRenderer()]
+        logger_factory = structlog.PrintLoggerFactory(pipeline.file())
+    structlog.configure(
+        processors=processors,
+        context_class=dict,
+        logger_factory=logger_factory,
+        wrapper_class=structlog.BoundLogger,
+        cache_logger_on_first_use=True,
+    )
+    if asynchronous:
+        pipeline.start()
+        os.register_at_fork(after_in_child=pipeline.after_fork)
@@ -1,10 +1,45 @@
+# imported first so the startup timing covers loading the settings too
+import startup
+
 import os
 import sys
 import uvicorn
 
-from api import app
 from config import log, settings
 
+# Number of worker processes to run, one per CPU if WORKERS is 0
+def worker_count() -> int:
+    workers = int(settings.WORKERS)
+    return workers if workers > 0 else os.cpu_count() or 1
+
+# Run the API with uvicorn. On SIGTERM uvicorn stops accepting connections and
+# gives in-flight requests SHUTDOWN_TIMEOUT seconds to finish before shutting
+# the app down.
+#
+# With more than one worker, uvicorn spawns that many processes and each
+# imports the app itself, so every worker sets up its own database connection
+# or pool and nothing is shared between them. Migrations run once here before
+# the workers start rather than in every worker at the same time.
+def main():
+    workers = worker_count()
+    options = dict(host=settings.HOST, port=int(settings.PORT), timeout_graceful_shutdown=int(settings.SHUTDOWN_TIMEOUT))
+    if workers == 1:
+        from api import app
+        log.info("starting uvicorn")
+        uvicorn.run(app, **options)
+        return
+
+    if settings.DATABASE_DRIVER == 'sqlite' and settings.DATABASE_NAME == ':memory:':
+        sys.exit("an in-memory database can't be shared by multiple workers")
+    from db_migrate import startup_migration_mode
+    if startup_migration_mode() == "run":
+        from db_config import db
+        from db_migrate import migrate
+        migrate()
+        db.close()
+        os.environ["DEMO_MIGRATE_ON_STARTUP"] = "skip"
+    log.info("starting uvicorn", workers=workers)
+    uvicorn.run("api:app", workers=workers, **options)
+
 if __name__ == "__main__":
-    log.info("starting uvicorn")
-    uvicorn.run(app, host=settings.HOST, port=settings.PORT)
+    main()
@@ -0,0 +1,240 @@
+import asyncio
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Tuple
+
+from config import log, settings
+from db_config import query_hooks
+
+# Prometheus metrics in the text exposition format, served by GET /metrics.
+#
+# MetricsMiddleware times every HTTP request and counts the database
+# statements it runs, labeled by method, route template and status code. Route
+# templates rather than raw paths keep the number of series bounded, and
+# recording a sample is a dict lookup and a few additions, so this stays on in
+# production. Pool and CPT code cache gauges are read when /metrics is scraped.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250, 1000)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [ f'{name}="{_escape(str(value))}"' for name, value in zip(names, values) ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Base for metrics with one value per label set. Samples can be recorded from
+# executor threads, so updates take a lock.
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def get(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> List[str]:
+        return [ f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+                 for labels, value in sorted(self._values.items()) ]
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    # Copy a total that is counted elsewhere, e.g. by the pool
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self._histograms: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(labels)
+            if histogram is None:
+                # counts per bucket plus +Inf, then sum
+                histogram = self._histograms[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += value
+
+    # Number of observations for a label set
+    def count(self, *labels) -> int:
+        histogram = self._histograms.get(labels)
+        return sum(histogram[:-1]) if histogram else 0
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            histograms = sorted((labels, list(histogram)) for labels, histogram in self._histograms.items())
+        for labels, histogram in histograms:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), histogram):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                bucket_labels = _labels(self.labelnames, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(histogram[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+registry: List[Metric] = []
+
+# All metrics in the Prometheus text format
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines += metric.samples()
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+request_duration = Histogram("http_request_duration_seconds", "HTTP request latency, including streamed bodies",
+    ("method", "route", "status"))
+requests_in_flight = Gauge("http_requests_in_flight", "HTTP requests being handled")
+request_queries = Histogram("http_request_db_queries", "Database statements run per HTTP request",
+    ("method", "route"), buckets=QUERY_COUNT_BUCKETS)
+request_query_time = Histogram("http_request_db_seconds", "Time spent executing database statements per HTTP request",
+    ("method", "route"))
+query_duration = Histogram("db_query_duration_seconds", "Database statement execution time")
+event_loop_lag = Histogram("event_loop_lag_seconds", "How late the event loop ran a timer callback",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+pool_connections = Gauge("db_pool_connections", "Pooled database connections by state", ("state",))
+pool_max_connections = Gauge("db_pool_max_connections", "Maximum pooled database connections")
+pool_events = Counter("db_pool_events_total", "Pooled connection checkouts, creations, recycles and exhaustions", ("event",))
+cpt_cache_size = Gauge("cpt_code_cache_size", "CPT codes in the in-process cache")
+cpt_cache_lookups = Counter("cpt_code_cache_lookups_total", "CPT code cache lookups", ("result",))
+cpt_cache_reloads = Counter("cpt_code_cache_reloads_total", "CPT code cache reloads")
+response_cache_size = Gauge("response_cache_size", "Responses in the in-process response cache")
+response_cache_lookups = Counter("response_cache_lookups_total", "Response cache lookups", ("result",))
+log_records = Counter("log_records_total", "Log records written, dropped because the queue was full, or sampled out", ("result",))
+log_queue_size = Gauge("log_queue_size", "Log records waiting to be written")
+admission_requests = Counter("admission_requests_total", "Requests admitted, queued, rejected with a full queue or timed out waiting, by route", ("route", "result"))
+admission_limit = Gauge("admission_limit", "Current concurrency limit by route", ("route",))
+admission_limit_scale = Gauge("admission_limit_scale", "Fraction of the configured limits in force after adapting to database latency")
+
+# Copy pool, cache, log and admission statistics into their metrics before a
+# scrape
+def collect(pool: dict | None, cache: dict, responses: dict = None, logs: dict = None, admission: dict = None):
+    if pool:
+        pool_connections.set(pool["in_use"], "in_use")
+        pool_connections.set(pool["idle"], "idle")
+        pool_max_connections.set(pool["max_connections"])
+        for event in ("checkouts", "created", "recycled", "exhausted"):
+            pool_events.set(pool[event], event)
+    cpt_cache_size.set(cache["size"])
+    cpt_cache_lookups.set(cache["hits"], "hit")
+    cpt_cache_lookups.set(cache["misses"], "miss")
+    cpt_cache_reloads.set(cache["reloads"])
+    if responses:
+        response_cache_size.set(responses["size"])
+        for result in ("hits", "misses", "not_modified"):
+            response_cache_lookups.set(responses[result], result)
+    if logs:
+        log_queue_size.set(logs["queued"])
+        for result in ("written", "dropped", "sampled_out"):
+            log_records.set(logs[result], result)
+    if admission:
+        admission_limit_scale.set(admission["scale"])
+        for route, limiter in admission["routes"].items():
+            admission_limit.set(limiter["limit"], route)
+            for result in ("admitted", "queued", "rejected", "timed_out"):
+                admission_requests.set(limiter[result], route, result)
+
+# [statements, seconds] for the request being handled. Executor threads run
+# with a copy of the request's context, which refers to the same list.
+_request_db = ContextVar("request_db", default=None)
+
+def record_query(sql: str, seconds: float):
+    query_duration.observe(seconds)
+    stats = _request_db.get()
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += seconds
+
+query_hooks.append(record_query)
+
+# ASGI middleware recording latency and database work per request. The route
+# label is the matched route's path template, or "unmatched" for 404s that
+# didn't match any route.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = [0, 0.0]
+        token = _request_db.set(stats)
+        requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            seconds = time.perf_counter() - start
+            requests_in_flight.dec()
+            _request_db.reset(token)
+            route = scope.get("route")
+            route = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            request_duration.observe(seconds, method, route, str(status))
+            request_queries.observe(stats[0], method, route)
+            request_query_time.observe(stats[1], method, route)
+
+# Background task measuring event loop lag until cancelled: how much later
+# than asked a sleep wakes up. Lag means something is blocking the loop.
+async def monitor_event_loop_lag(interval: float = None):
+    interval = float(settings.METRICS_LOOP_LAG_INTERVAL) if interval is None else interval
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        event_loop_lag.observe(lag)
+        if lag > 0.1:
+            log.warning("event loop lagging", lag=lag)
@@ -1,14 +1,41 @@
-from peewee import Model, CharField, ForeignKeyField, DateField, IntegerField, UUIDField
-from typing import List
+from peewee import Model, BlobField, CharField, ForeignKeyField, DateField, DateTimeField, IntegerField, SmallIntegerField, UUIDField, SqliteDatabase, JOIN, Case, SQL, fn
+from typing import List, Optional, Tuple
+import datetime
+import re
+import time
 import uuid
 
 from db_config import db
 
-# Patient data model
+# UUID stored compactly: in a native uuid column on Postgres, and as a 16 byte
+# blob on SQLite (db_config maps the UUID column type to BLOB there) instead
+# of 36 characters of text. IDs read back as uuid.UUID either way, and text
+# values written before migration 6 still read. Comparing with a malformed ID
+# raises ValueError, so validate IDs from requests first.
+class CompactUUIDField(UUIDField):
+    def db_value(self, value):
+        if value is None:
+            return None
+        if not isinstance(value, uuid.UUID):
+            value = uuid.UUID(str(value))
+        if isinstance(self.model._meta.database, SqliteDatabase):
+            return value.bytes
+        return value.hex
+
+    def python_value(self, value):
+        if value is None or isinstance(value, uuid.UUID):
+            return value
+        if isinstance(value, (bytes, memoryview)):
+            return uuid.UUID(bytes=bytes(value))
+        return uuid.UUID(value)
+
+# Patient data model. The version is bumped by every write to the patient's
+# encounters and line items and is used for response ETags.
 class Patient(Model):
-    id = UUIDField(primary_key=True, default=uuid.uuid4)
+    id = CompactUUIDField(primary_key=True, default=uuid.uuid4)
     first_name = CharField()
     last_name = CharField()
+    version = IntegerField(default=0)
 
     class Meta:
         database = db
@@ -21,9 +48,46 @@ class CPTCode(Model):
     class Meta:
         database = db
 
+# Record of the last bulk import of a data file, e.g. the CPT code CSV,
+# used to skip re-importing a file that hasn't changed
+class DataImport(Model):
+    name = CharField(primary_key=True)
+    checksum = CharField()
+    rows = IntegerField()
+    imported_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        database = db
+
+# Schema migrations that have been applied to the database, see db_migrate
+class SchemaMigration(Model):
+    version = IntegerField(primary_key=True)
+    name = CharField()
+    applied_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        database = db
+
+# Stored response of a POST made with an Idempotency-Key header, see
+# idempotency. The key and the request fingerprint are 16 byte digests, and
+# the response is the JSON body.
+class IdempotencyKey(Model):
+    key = BlobField(primary_key=True)
+    fingerprint = BlobField()
+    status = SmallIntegerField()
+    response = BlobField()
+    expires_at = IntegerField(index=True)
+
+    class Meta:
+        database = db
+        table_name = "idempotency_key"
+
+# DataImport name of the CPT code CSV load
+CPT_CODES_IMPORT = "cpt_codes"
+
 # Encounter data model
 class Encounter(Model):
-    id = UUIDField(primary_key=True, default=uuid.uuid4)
+    id = CompactUUIDField(primary_key=True, default=uuid.uuid4)
     patient = ForeignKeyField(Patient, backref='encounters')
     date = DateField()
 
@@ -39,14 +103,302 @@ class LineItem(Model):
     class Meta:
         database = db
 
-# Get extended line items for an encounter
-# This is probably a bit inefficient because an encounter might have
-# many line items, AND we're joining it with the CPT table to get code
-# descriptions. This might be a good candidate for a more efficient query.
-# For the demo, we'll keep it simple.
-def get_line_items_for_encounter(encounter: Encounter) -> List[LineItem]:
-    return (LineItem
-        .select()
+# Get a page of patients as (id, first name, last name) tuples ordered by ID,
+# starting after the patient ID in `after`, a keyset cursor.
+def get_patients(after=None, limit=None) -> List[Tuple]:
+    query = Patient.select(Patient.id, Patient.first_name, Patient.last_name)
+    if after:
+        query = query.where(Patient.id > after[0])
+    return list(query.order_by(Patient.id).limit(limit).tuples())
+
+# Most words a patient search matches on
+MAX_SEARCH_TERMS = 4
+
+# Words of a patient search, lowercased. Only letters and digits are kept, so
+# terms never carry LIKE wildcards or full-text query syntax.
+def patient_search_terms(q: str) -> List[str]:
+    return re.findall(r"[^\W_]+", q.lower())[:MAX_SEARCH_TERMS]
+
+# Search patients whose first or last name starts with each of the terms,
+# ignoring case, as (id, first name, last name, score, lowercased last name,
+# lowercased first name) tuples. Patients matching more of the terms exactly
+# score higher and come first, then they're in name order. `after` is a
+# keyset cursor of (score, lowercased last name, lowercased first name, id).
+#
+# Matching is backed by the index built for the database by migration 8: the
+# patient_search FTS5 table on SQLite, where "^" anchors each term to
+# the first word of a name, and lower() and trigram indexes on Postgres.
+def search_patients(terms: List[str], after=None, limit=None) -> List[Tuple]:
+    first_name, last_name = fn.lower(Patient.first_name), fn.lower(Patient.last_name)
+    score = sum(Case(None, [(((first_name == term) | (last_name == term)), 1)], 0) for term in terms)
+    query = Patient.select(Patient.id, Patient.first_name, Patient.last_name, score, last_name, first_name)
+    if isinstance(db, SqliteDatabase):
+        match = " AND ".join(f'{{first_name last_name}} : ^"{term}"*' for term in terms)
+        query = query.where(Patient.id.in_(
+            SQL('(SELECT "patient_id" FROM "patient_search" WHERE "patient_search" MATCH ?)', [match])))
+    else:
+        for term in terms:
+            query = query.where((first_name % f"{term}%") | (last_name % f"{term}%"))
+    if after:
+        after_score, after_last_name, after_first_name, after_id = after
+        after_score = int(after_score)
+        query = query.where(
+            (score < after_score) |
+            ((score == after_score) & (
+                (last_name > after_last_name) |
+                ((last_name == after_last_name) & (first_name > after_first_name)) |
+                ((last_name == after_last_name) & (first_name == after_first_name) & (Patient.id > after_id)))))
+    return list(query.order_by(score.desc(), last_name, first_name, Patient.id).limit(limit).tuples())
+
+# Get extended line items for an encounter as (id, CPT code, CPT code
+# description, units) tuples, in the order they were added, starting after
+# the line item ID in `after`, a keyset cursor. The CPT code columns are
+# selected in the same query, so there's no per-row lookup and no model
+# instances get built.
+def get_line_items_for_encounter(encounter_id, after=None, limit=None) -> List[Tuple[int, str, str, int]]:
+    query = (LineItem
+        .select(LineItem.id, CPTCode.code, CPTCode.description, LineItem.units)
+        .join(CPTCode)
+        .where(LineItem.encounter == encounter_id))
+    if after:
+        query = query.where(LineItem.id > int(after[0]))
+    return list(query.order_by(LineItem.id).limit(limit).tuples())
+
+# Check that a patient exists and, optionally, that an encounter belongs to
+# them, in one query. Returns None if the patient doesn't exist, otherwise an
+# (encounter id, encounter date) tuple that is (None, None) if the encounter
+# doesn't exist for that patient.
+def find_patient_encounter(patient_id, encounter_id) -> Optional[Tuple]:
+    row = (Patient
+        .select(Patient.id, Encounter.id, Encounter.date)
+        .join(Encounter, JOIN.LEFT_OUTER, on=(
+            (Encounter.patient == Patient.id) & (Encounter.id == encounter_id)))
+        .where(Patient.id == patient_id)
+        .tuples()
+        .first())
+    return None if row is None else row[1:]
+
+# Same as find_patient_encounter, also looking up a CPT code by its code.
+# Returns None if the patient doesn't exist, otherwise an (encounter id,
+# CPT code id, CPT code description) tuple with None for missing rows.
+def find_patient_encounter_cpt_code(patient_id, encounter_id, code) -> Optional[Tuple]:
+    row = (Patient
+        .select(Patient.id, Encounter.id, CPTCode.id, CPTCode.description)
+        .join(Encounter, JOIN.LEFT_OUTER, on=(
+            (Encounter.patient == Patient.id) & (Encounter.id == encounter_id)))
+        .switch(Patient)
+        .join(CPTCode, JOIN.LEFT_OUTER, on=(CPTCode.code == code))
+        .where(Patient.id == patient_id)
+        .tuples()
+        .first())
+    return None if row is None else row[1:]
+
+# Get a page of a patient's encounters in one query, ordered by date and ID
+# and starting after the (date, ID) in `after`, a keyset cursor. Returns None
+# if the patient doesn't exist, otherwise a possibly empty list of (id, date)
+# tuples.
+def get_encounters_for_patient(patient_id, after=None, limit=None) -> Optional[List[Tuple]]:
+    on = (Encounter.patient == Patient.id)
+    if after:
+        date, id = after
+        on &= (Encounter.date > date) | ((Encounter.date == date) & (Encounter.id > id))
+    rows = list(Patient
+        .select(Patient.id, Encounter.id, Encounter.date)
+        .join(Encounter, JOIN.LEFT_OUTER, on=on)
+        .where(Patient.id == patient_id)
+        .order_by(Encounter.date, Encounter.id)
+        .limit(limit)
+        .tuples())
+    if not rows:
+        return None
+    return [ row[1:] for row in rows if row[1] is not None ]
+
+# A patient's whole record in one query: the patient outer joined with its
+# encounters, their line items and CPT codes, ordered by encounter date and ID
+# and then by line item. `depth` leaves out line items (1) or encounters too
+# (0). Returns None if the patient doesn't exist, otherwise rows of (id, first
+# name, last name[, encounter ID, date[, code, description, units]]), with
+# None in place of a missing encounter or line item.
+def get_patient_record(patient_id, depth: int = 2) -> Optional[List[Tuple]]:
+    columns = [Patient.id, Patient.first_name, Patient.last_name]
+    if depth > 0:
+        columns += [Encounter.id, Encounter.date]
+    if depth > 1:
+        columns += [CPTCode.code, CPTCode.description, LineItem.units]
+    query = Patient.select(*columns).where(Patient.id == patient_id)
+    if depth > 0:
+        query = (query
+            .join(Encounter, JOIN.LEFT_OUTER, on=(Encounter.patient == Patient.id))
+            .order_by(Encounter.date, Encounter.id))
+    if depth > 1:
+        query = (query
+            .join(LineItem, JOIN.LEFT_OUTER, on=(LineItem.encounter == Encounter.id))
+            .join(CPTCode, JOIN.LEFT_OUTER, on=(LineItem.cpt_code == CPTCode.id))
+            .order_by(Encounter.date, Encounter.id, LineItem.id))
+    return list(query.tuples()) or None
+
+# Create an encounter for a patient if the patient exists, checking in the
+# same query, and bump the patient's version. Returns the new encounter ID, or
+# None if the patient doesn't exist.
+def create_encounter_for_patient(patient_id, date) -> Optional[uuid.UUID]:
+    encounter_id = uuid.uuid4()
+    patients = (Patient
+        .select(Encounter.id.to_value(encounter_id), Patient.id, Encounter.date.to_value(date))
+        .where(Patient.id == patient_id))
+    inserted = (Encounter
+        .insert_from(patients, [Encounter.id, Encounter.patient, Encounter.date])
+        .as_rowcount()
+        .execute())
+    if not inserted:
+        return None
+    bump_patient_versions([patient_id])
+    return encounter_id
+
+# Add a line item to an encounter and bump the patient's version
+def create_line_item(patient_id, encounter_id, cpt_code_id, units: int):
+    LineItem.insert(encounter=encounter_id, cpt_code=cpt_code_id, units=units).execute()
+    bump_patient_versions([patient_id])
+
+# Current version of a patient, or None if the patient doesn't exist
+def get_patient_version(patient_id) -> Optional[int]:
+    row = Patient.select(Patient.version).where(Patient.id == patient_id).tuples().first()
+    return None if row is None else row[0]
+
+# Bump the versions of patients whose records changed, in one query
+def bump_patient_versions(patient_ids) -> int:
+    if not patient_ids:
+        return 0
+    return (Patient
+        .update(version=Patient.version + 1)
+        .where(Patient.id.in_(list(patient_ids)))
+        .execute())
+
+# Set-based lookups for batch ingestion, one query per set of keys
+
+# IDs of the patients that exist among `patient_ids`
+def existing_patient_ids(patient_ids) -> set:
+    if not patient_ids:
+        return set()
+    return { id for id, in Patient.select(Patient.id).where(Patient.id.in_(list(patient_ids))).tuples() }
+
+# Map each existing encounter among `encounter_ids` to its patient's ID
+def encounter_patient_ids(encounter_ids) -> dict:
+    if not encounter_ids:
+        return {}
+    query = (Encounter
+        .select(Encounter.id, Encounter.patient)
+        .where(Encounter.id.in_(list(encounter_ids)))
+        .tuples())
+    return dict(query)
+
+# Map each existing CPT code among `codes` to its (id, description)
+def cpt_codes_by_code(codes) -> dict:
+    if not codes:
+        return {}
+    query = (CPTCode
+        .select(CPTCode.code, CPTCode.id, CPTCode.description)
+        .where(CPTCode.code.in_(list(codes)))
+        .tuples())
+    return { code: (id, description) for code, id, description in query }
+
+# Billing aggregates, totalled in the database with GROUP BY. Rows are
+# (code, description, units, line items) per CPT code, or (date, code,
+# description, units, line items) per encounter date and CPT code. Dates are
+# filtered to between `start` and `end`, inclusive, and rows are ordered by
+# their group key and start after the key in `after`, a keyset cursor.
+
+def _encounter_dates(condition, start, end):
+    if start:
+        condition &= (Encounter.date >= start)
+    if end:
+        condition &= (Encounter.date <= end)
+    return condition
+
+def _billing_totals():
+    return (fn.SUM(LineItem.units), fn.COUNT(LineItem.id))
+
+# Totals per CPT code across all patients
+def get_cpt_code_totals(start=None, end=None, after=None, limit=None) -> List[Tuple]:
+    query = (LineItem
+        .select(CPTCode.code, CPTCode.description, *_billing_totals())
+        .join(Encounter)
+        .switch(LineItem)
         .join(CPTCode)
-        .where(LineItem.encounter == encounter)
+        .where(_encounter_dates(True, start, end)))
+    if after:
+        query = query.where(CPTCode.code > after[0])
+    return list(query
+        .group_by(CPTCode.code, CPTCode.description)
+        .order_by(CPTCode.code)
+        .limit(limit)
+        .tuples())
+
+# Totals per encounter date and CPT code across all patients
+def get_daily_cpt_code_totals(start=None, end=None, after=None, limit=None) -> List[Tuple]:
+    query = (LineItem
+        .select(Encounter.date, CPTCode.code, CPTCode.description, *_billing_totals())
+        .join(Encounter)
+        .switch(LineItem)
+        .join(CPTCode)
+        .where(_encounter_dates(True, start, end)))
+    if after:
+        date, code = after
+        query = query.where((Encounter.date > date) | ((Encounter.date == date) & (CPTCode.code > code)))
+    return list(query
+        .group_by(Encounter.date, CPTCode.code, CPTCode.description)
+        .order_by(Encounter.date, CPTCode.code)
+        .limit(limit)
+        .tuples())
+
+# Totals per CPT code for one patient, checking that the patient exists in
+# the same query. Returns None if the patient doesn't exist. The outer joins
+# put encounters and line items that are filtered out into a single group
+# with no code, which is dropped, so one extra row is fetched for it.
+def get_patient_cpt_code_totals(patient_id, start=None, end=None, after=None, limit=None) -> Optional[List[Tuple]]:
+    on = (LineItem.cpt_code == CPTCode.id)
+    if after:
+        on &= (CPTCode.code > after[0])
+    rows = list(Patient
+        .select(CPTCode.code, CPTCode.description, *_billing_totals())
+        .join(Encounter, JOIN.LEFT_OUTER, on=_encounter_dates(Encounter.patient == Patient.id, start, end))
+        .join(LineItem, JOIN.LEFT_OUTER, on=(LineItem.encounter == Encounter.id))
+        .join(CPTCode, JOIN.LEFT_OUTER, on=on)
+        .where(Patient.id == patient_id)
+        .group_by(CPTCode.code, CPTCode.description)
+        .order_by(CPTCode.code)
+        .limit(limit + 1 if limit else None)
+        .tuples())
+    if not rows:
+        return None
+    return [ row for row in rows if row[0] is not None ]
+
+# Stored (fingerprint, status, response) of an idempotency key that hasn't
+# expired, or None
+def find_idempotency_key(key: bytes) -> Optional[Tuple[bytes, int, bytes]]:
+    row = (IdempotencyKey
+        .select(IdempotencyKey.fingerprint, IdempotencyKey.status, IdempotencyKey.response)
+        .where((IdempotencyKey.key == key) & (IdempotencyKey.expires_at > int(time.time())))
+        .tuples()
+        .first())
+    if row is None:
+        return None
+    fingerprint, status, response = row
+    return bytes(fingerprint), status, bytes(response)
+
+# Store the response for an idempotency key, replacing an expired entry that
+# hasn't been cleaned up yet. Returns False if the key is already taken.
+def store_idempotency_key(key: bytes, fingerprint: bytes, status: int, response: bytes, ttl: int) -> bool:
+    now = int(time.time())
+    stored = (IdempotencyKey
+        .insert(key=key, fingerprint=fingerprint, status=status, response=response, expires_at=now + ttl)
+        .on_conflict(
+            conflict_target=[IdempotencyKey.key],
+            preserve=[IdempotencyKey.fingerprint, IdempotencyKey.status, IdempotencyKey.response, IdempotencyKey.expires_at],
+            where=(IdempotencyKey.expires_at <= now))
+        .as_rowcount()
         .execute())
+    return stored > 0
+
+# Delete expired idempotency keys. Returns how many were deleted.
+def delete_expired_idempotency_keys() -> int:
+    return IdempotencyKey.delete().where(IdempotencyKey.expires_at <= int(time.time())).execute()
@@ -0,0 +1,158 @@
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+import uuid
+
+from config import log, settings
+
+# Opt-in request profiling. With PROFILING enabled, a request sent with an
+# "X-Profile" header runs under a sampling profiler that records the stacks of
+# the event loop thread and the database executor threads every
+# PROFILING_INTERVAL seconds. Frames are named module.function, so the time
+# spent in the router function, in peewee and in api_output serialization is
+# visible directly, and statements being executed show up as "SQL: ..." frames
+# under execute_sql.
+#
+# The profile is written in the folded stack format that flamegraph.pl and
+# speedscope read:
+#   X-Profile: store   writes it to PROFILING_DIR and names the file in the
+#                      X-Profile-File response header (the default)
+#   X-Profile: inline  returns it as the response body instead of the normal
+#                      response, whose status goes in X-Profile-Status
+#
+# Profiled requests run one at a time per worker. Other requests running at
+# the same time show up in the samples too, so profile on a quiet replica.
+# With PROFILING disabled the middleware isn't installed, so there's no cost.
+
+PROFILE_HEADER = "x-profile"
+SQL_LABEL_LENGTH = 120
+
+# Label for a frame in a folded stack
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}.{code.co_qualname}"
+
+# Whether a thread is waiting for work rather than running any
+def _idle(frame) -> bool:
+    name = frame.f_code.co_name
+    return name in ("select", "_worker") or (name == "wait" and frame.f_code.co_filename.endswith("threading.py"))
+
+# Samples the stacks of the event loop and database threads on a background
+# thread until stopped, counting identical stacks
+class SamplingProfiler:
+    def __init__(self, interval: float = None, loop_thread: int = None):
+        self.interval = float(settings.PROFILING_INTERVAL) if interval is None else interval
+        self.loop_thread = loop_thread or threading.get_ident()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started_at
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def _thread_names(self) -> dict:
+        names = { self.loop_thread: "event-loop" }
+        for thread in threading.enumerate():
+            if thread.name.startswith("db"):
+                names[thread.ident] = thread.name
+        return names
+
+    def sample(self):
+        self.samples += 1
+        names = self._thread_names()
+        for ident, frame in sys._current_frames().items():
+            name = names.get(ident)
+            if name is None or _idle(frame):
+                continue
+            stack = []
+            while frame is not None:
+                label = _frame_label(frame)
+                if frame.f_code.co_name == "execute_sql":
+                    sql = frame.f_locals.get("sql")
+                    if isinstance(sql, str):
+                        label += ";SQL: " + " ".join(sql.split())[:SQL_LABEL_LENGTH]
+                stack.append(label)
+                frame = frame.f_back
+            stack.append(name)
+            self.stacks[";".join(reversed(stack))] += 1
+
+    # Profile in the folded stack format, one "frame;frame;... count" per line
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+# Write a profile to PROFILING_DIR, creating it if needed. Returns the path.
+def store_profile(name: str, profile: str, directory: str = None) -> str:
+    directory = directory or settings.PROFILING_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        f.write(profile)
+    return path
+
+# ASGI middleware profiling requests that ask for it, see above
+class ProfilingMiddleware:
+    def __init__(self, app, directory: str = None):
+        self.app = app
+        self.directory = directory
+        self._lock = asyncio.Lock()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        mode = None
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER.encode():
+                mode = value.decode().strip().lower() or "store"
+        if mode is None:
+            return await self.app(scope, receive, send)
+        if mode not in ("store", "inline"):
+            mode = "store"
+
+        filename = f"{time.strftime('%Y%m%dT%H%M%S')}-{scope['method'].lower()}-{uuid.uuid4().hex[:8]}.folded"
+        status = 500
+        async def send_profiled(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if mode == "store":
+                    message = { **message, "headers": [ *message.get("headers", []), (b"x-profile-file", filename.encode()) ] }
+            if mode == "store":
+                await send(message)
+
+        async with self._lock:
+            profiler = SamplingProfiler()
+            profiler.start()
+            try:
+                await self.app(scope, receive, send_profiled)
+            finally:
+                profiler.stop()
+        profile = profiler.folded()
+        log.info("profiled request", method=scope["method"], path=scope["path"], samples=profiler.samples,
+            seconds=profiler.elapsed)
+
+        if mode == "store":
+            # file IO, so on the default executor rather than the event loop
+            # or the database threads
+            await asyncio.to_thread(store_profile, filename, profile, self.directory)
+            return
+        await send({ "type": "http.response.start", "status": 200, "headers": [
+            (b"content-type", b"text/plain; charset=utf-8"),
+            (b"x-profile-status", str(status).encode()),
+            (b"x-profile-samples", str(profiler.samples).encode()),
+        ] })
+        await send({ "type": "http.response.body", "body": profile.encode() })
@@ -0,0 +1,238 @@
+import collections
+import importlib
+import re
+import time
+import uuid
+from typing import Optional, Tuple
+
+from config import settings
+from cpt_cache import cpt_code_cache
+from db_executor import run_db
+import model
+
+# HTTP caching for the read endpoints under a patient: the patient itself, its
+# whole record, its encounters and their line items.
+#
+# Every write to a patient, its encounters or their line items bumps the
+# patient's version column, and responses carry an ETag made of the patient
+# ID and version, and the CPT code cache's version stamp, since line items and
+# records show CPT code descriptions. A reload of the codes retires the ETags
+# once this worker's cache refreshes. A request whose If-None-Match matches gets a 304 without the
+# handler running or anything being serialized.
+#
+# Successful responses are also kept in a bounded in-process LRU for up to
+# RESPONSE_CACHE_TTL seconds, along with their ETag. Every request still looks
+# up the patient's version, one primary key read, and an entry is only served
+# while its ETag is current, so a write through any worker or replica retires
+# it. POST handlers drop the entries of the patient they wrote to right away
+# to free the space. An optional shared backend (RESPONSE_CACHE_BACKEND) is
+# checked after the local cache, keyed by version in the same way.
+
+CACHED_PATH = re.compile(r"^/patients/(?P<patient_id>[^/]+)(?P<rest>(?:/record|/encounters/(?:(?P<encounter_id>[^/]+)(?:/line_items/)?)?)?)$")
+MAX_BODY_SIZE = 1 << 20
+NDJSON = "application/x-ndjson"
+
+# Response as kept in the cache: (status, headers, body)
+CachedResponse = Tuple[int, list, bytes]
+
+# Shared backend stand-in keeping entries in process, for tests and single
+# replica setups. A shared backend has the same get/set methods; values are
+# CachedResponse tuples, which a networked backend would pickle.
+class MemoryBackend:
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        return entry[1]
+
+    def set(self, key: str, value: CachedResponse, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+
+# Backend named by a setting: empty for none, "memory", or "module:factory"
+def load_backend(name: str):
+    if not name:
+        return None
+    if name == "memory":
+        return MemoryBackend()
+    module, _, factory = name.partition(":")
+    return getattr(importlib.import_module(module), factory)()
+
+# Bounded LRU of responses with a TTL, indexed by patient for invalidation
+class ResponseCache:
+    def __init__(self, max_entries: int, ttl: float, backend=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        # key -> (expires, patient ID, ETag, response), least recently used first
+        self._entries = collections.OrderedDict()
+        self._keys = collections.defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.invalidations = 0
+
+    # Cached response for the key, if it was stored under the current ETag
+    def get(self, key: str, etag: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic() or entry[2] != etag:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[3]
+
+    def put(self, key: str, patient_id: str, etag: str, response: CachedResponse):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, patient_id, etag, response)
+        self._keys[patient_id].add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        _, patient_id, _, _ = self._entries.pop(key)
+        keys = self._keys[patient_id]
+        keys.discard(key)
+        if not keys:
+            del self._keys[patient_id]
+
+    # Drop the cached responses of patients that were written to
+    def invalidate(self, *patient_ids):
+        for patient_id in patient_ids:
+            self.invalidations += 1
+            for key in self._keys.pop(normalize_id(patient_id), ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._keys.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "invalidations": self.invalidations,
+        }
+
+response_cache = ResponseCache(int(settings.RESPONSE_CACHE_MAX_ENTRIES), float(settings.RESPONSE_CACHE_TTL),
+    load_backend(settings.RESPONSE_CACHE_BACKEND))
+
+# Canonical form of a patient ID, or None if it isn't a UUID
+def normalize_id(patient_id) -> Optional[str]:
+    try:
+        return str(uuid.UUID(str(patient_id)))
+    except ValueError:
+        return None
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def _header(scope, name: bytes) -> str:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return ""
+
+# ASGI middleware answering cacheable GET requests from the cache, see above.
+# It runs inside DatabaseConnectionMiddleware so the version lookup can check
+# out a pooled connection. Requests served without reaching the router get the
+# route learned from earlier requests of the same kind, for metrics labels.
+class ResponseCacheMiddleware:
+    def __init__(self, app, cache: ResponseCache = response_cache):
+        self.app = app
+        self.cache = cache
+        self._routes = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return await self.app(scope, receive, send)
+        match = CACHED_PATH.match(scope["path"])
+        patient_id = normalize_id(match["patient_id"]) if match else None
+        if patient_id is None or NDJSON in _header(scope, b"accept"):
+            return await self.app(scope, receive, send)
+        # a malformed encounter ID is a 404 from the handler without a query,
+        # so don't spend one on the version
+        if match["encounter_id"] is not None and normalize_id(match["encounter_id"]) is None:
+            return await self.app(scope, receive, send)
+
+        kind = re.sub(r"/encounters/[^/]+", "/encounters/{id}", match["rest"])
+        key = scope["path"] + "?" + scope["query_string"].decode("latin-1")
+        version = await run_db(model.get_patient_version, patient_id)
+        if version is None:
+            # unknown patient, let the handler produce its 404
+            return await self.app(scope, receive, send)
+        etag = f'"{patient_id}.{version}.{cpt_code_cache.stamp}"'
+        if_none_match = _header(scope, b"if-none-match")
+        if if_none_match and etag_matches(if_none_match, etag):
+            self.cache.not_modified += 1
+            if kind in self._routes:
+                scope["route"] = self._routes[kind]
+            return await self._send_not_modified(send, etag)
+        cached = self.cache.get(key, etag)
+        if cached is not None:
+            self.cache.hits += 1
+            if kind in self._routes:
+                scope["route"] = self._routes[kind]
+            return await self._send_cached(send, etag, cached, b"hit")
+
+        if self.cache.backend is not None:
+            shared = self.cache.backend.get(etag + key)
+            if shared is not None:
+                self.cache.hits += 1
+                self.cache.put(key, patient_id, etag, shared)
+                return await self._send_cached(send, etag, shared, b"shared")
+        self.cache.misses += 1
+
+        # keep a copy of the body to cache, unless the response isn't a 200
+        # or grows past MAX_BODY_SIZE
+        status, headers, body, size = None, [], [], 0
+        async def send_tagged(message):
+            nonlocal status, headers, body, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                message = { **message, "headers": headers + self._cache_headers(etag, b"miss") }
+                if status != 200:
+                    body = None
+            elif message["type"] == "http.response.body" and body is not None:
+                chunk = message.get("body", b"")
+                size += len(chunk)
+                if size > MAX_BODY_SIZE:
+                    body = None
+                else:
+                    body.append(chunk)
+            await send(message)
+        await self.app(scope, receive, send_tagged)
+
+        if "route" in scope:
+            self._routes[kind] = scope["route"]
+        if status == 200 and body is not None:
+            response = (status, headers, b"".join(body))
+            self.cache.put(key, patient_id, etag, response)
+            if self.cache.backend is not None:
+                self.cache.backend.set(etag + key, response, self.cache.ttl)
+
+    @staticmethod
+    def _cache_headers(etag: str, source: bytes) -> list:
+        return [(b"etag", etag.encode()), (b"cache-control", b"no-cache"), (b"x-cache", source)]
+
+    async def _send_cached(self, send, etag: str, response: CachedResponse, source: bytes):
+        status, headers, body = response
+        await send({ "type": "http.response.start", "status": status,
+                     "headers": headers + self._cache_headers(etag, source) })
+        await send({ "type": "http.response.body", "body": body })
+
+    async def _send_not_modified(self, send, etag: str):
+        await send({ "type": "http.response.start", "status": 304,
+                     "headers": [(b"etag", etag.encode()), (b"cache-control", b"no-cache")] })
+        await send({ "type": "http.response.body", "body": b"" })
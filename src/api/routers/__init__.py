@@ -1,7 +1,11 @@
 from . import patients
 from . import encounters
 from . import line_items
+from . import batch
+from . import billing
+from . import export
 from . import health
+from . import stats
 from .routers import routers
 
 __all__ = ["routers"]
@@ -1,4 +1,30 @@
+import uuid
+from fastapi import Depends, HTTPException
 from pydantic import BaseModel
+from typing import Annotated
+
+from config import log
+
+# UUID path parameters. A malformed ID can't match any row, so it gets the
+# same 404 as a missing one without reaching the database. The ID is passed on
+# in canonical form. These are async so FastAPI calls them on the event loop
+# rather than hopping to its threadpool.
+async def patient_id_path(patient_id: str) -> str:
+    try:
+        return str(uuid.UUID(patient_id))
+    except ValueError:
+        log.info("patient not found", patient_id=patient_id)
+        raise HTTPException(status_code=404, detail="patient not found")
+
+async def encounter_id_path(encounter_id: str) -> str:
+    try:
+        return str(uuid.UUID(encounter_id))
+    except ValueError:
+        log.info("encounter not found", encounter_id=encounter_id)
+        raise HTTPException(status_code=404, detail="encounter not found")
+
+PatientId = Annotated[str, Depends(patient_id_path)]
+EncounterId = Annotated[str, Depends(encounter_id_path)]
 
 # input body for POST /patients
 class PatientInput(BaseModel):
@@ -13,3 +39,12 @@ class EncounterInput(BaseModel):
 class LineItemInput(BaseModel):
     cpt_code: str
     units: int
+
+# input item for POST /batch/encounters
+class EncounterBatchInput(EncounterInput):
+    patient_id: str
+
+# input item for POST /batch/line_items
+class LineItemBatchInput(LineItemInput):
+    patient_id: str
+    encounter_id: str
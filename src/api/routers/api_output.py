@@ -1,5 +1,27 @@
+import json
 from model import Patient, Encounter, CPTCode, LineItem
 from pydantic import BaseModel
+from typing import Any, ClassVar, Iterable, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Encode output straight to JSON bytes, skipping the validation and
+# jsonable_encoder pass FastAPI makes over returned values. orjson is used when
+# installed and handles UUIDs and dates natively; the standard library encoder
+# is the fallback.
+def dump_json(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), default=str).encode()
+
+# Encode items as newline-delimited JSON
+def dump_ndjson(items: Iterable[Any]) -> bytes:
+    if orjson is not None:
+        return b"".join(orjson.dumps(item, option=orjson.OPT_APPEND_NEWLINE) for item in items)
+    return b"".join(dump_json(item) + b"\n" for item in items)
 
 # Data output classes
 class PatientOutput(BaseModel):
@@ -15,6 +37,15 @@ class PatientOutput(BaseModel):
             last_name=patient.last_name,
         )
 
+    # Build output dicts straight from (id, first name, last name) rows, for
+    # dump_json() to encode
+    @staticmethod
+    def from_rows(rows: Iterable[Tuple]) -> List[dict]:
+        return [
+            { "id": id, "first_name": first_name, "last_name": last_name }
+            for id, first_name, last_name in rows
+        ]
+
 class EncounterOutput(BaseModel):
     id: str
     date: str
@@ -26,6 +57,12 @@ class EncounterOutput(BaseModel):
             date=str(encounter.date),
         )
 
+    # Build output dicts straight from (id, date) rows, for dump_json() to
+    # encode
+    @staticmethod
+    def from_rows(rows: Iterable[Tuple]) -> List[dict]:
+        return [ { "id": id, "date": date } for id, date in rows ]
+
 class LineItemOutput(BaseModel):
     cpt_code: str
     cpt_code_description: str
@@ -38,3 +75,131 @@ class LineItemOutput(BaseModel):
             cpt_code_description=line_item.cpt_code.description,
             units=line_item.units,
         )
+
+    # Build output dicts straight from (id, code, description, units) rows,
+    # for dump_json() to encode
+    @staticmethod
+    def from_rows(rows: Iterable[Tuple[int, str, str, int]]) -> List[dict]:
+        return [
+            { "cpt_code": code, "cpt_code_description": description, "units": units }
+            for _, code, description, units in rows
+        ]
+
+# A patient's whole record: the patient with its encounters and their line
+# items. Clients can pick fields with dotted names, e.g.
+# "id,encounters.date,encounters.line_items.units"; naming an encounter or line
+# item field includes its parents, and naming a list without fields includes
+# all of them.
+class EncounterRecordOutput(EncounterOutput):
+    line_items: List[LineItemOutput]
+
+class PatientRecordOutput(PatientOutput):
+    encounters: List[EncounterRecordOutput]
+
+    FIELDS: ClassVar[dict] = {
+        "id": None, "first_name": None, "last_name": None,
+        "encounters": {
+            "id": None, "date": None,
+            "line_items": { "cpt_code": None, "cpt_code_description": None, "units": None },
+        },
+    }
+
+    # Tree of selected fields, in the shape of FIELDS. Raises ValueError for
+    # unknown fields.
+    @classmethod
+    def select_fields(cls, names: Optional[str]) -> dict:
+        if not names:
+            return cls.FIELDS
+        selected = {}
+        for name in names.split(","):
+            fields, tree = cls.FIELDS, selected
+            parts = name.strip().split(".")
+            for part in parts[:-1]:
+                if not isinstance(fields.get(part), dict):
+                    raise ValueError(name)
+                fields = fields[part]
+                tree = tree.setdefault(part, {})
+            if parts[-1] not in fields:
+                raise ValueError(name)
+            if isinstance(fields[parts[-1]], dict):
+                tree[parts[-1]] = fields[parts[-1]]
+            else:
+                tree.setdefault(parts[-1], None)
+        return selected
+
+    # Record depth that the selected fields need, see model.get_patient_record()
+    @staticmethod
+    def depth(fields: dict) -> int:
+        if "encounters" not in fields:
+            return 0
+        return 2 if "line_items" in fields["encounters"] else 1
+
+    # Build the output dict from get_patient_record() rows, keeping only the
+    # selected fields, for dump_json() to encode
+    @staticmethod
+    def from_rows(rows: List[Tuple], fields: dict) -> dict:
+        id, first_name, last_name = rows[0][:3]
+        patient = { "id": id, "first_name": first_name, "last_name": last_name }
+        record = { name: patient[name] for name in fields if name in patient }
+        encounter_fields = fields.get("encounters")
+        if encounter_fields is None:
+            return record
+        line_item_fields = encounter_fields.get("line_items")
+        encounters = record["encounters"] = []
+        last_id = None
+        for row in rows:
+            if row[3] is None:
+                continue
+            if row[3] != last_id:
+                last_id = row[3]
+                encounter = { "id": row[3], "date": row[4] }
+                encounter = { name: encounter[name] for name in encounter_fields if name in encounter }
+                if line_item_fields is not None:
+                    line_items = encounter["line_items"] = []
+                encounters.append(encounter)
+            if line_item_fields is not None and row[5] is not None:
+                line_item = { "cpt_code": row[5], "cpt_code_description": row[6], "units": row[7] }
+                line_items.append({ name: line_item[name] for name in line_item_fields })
+        return record
+
+# Billing totals of a CPT code
+class CPTCodeTotalOutput(BaseModel):
+    cpt_code: str
+    cpt_code_description: str
+    units: int
+    line_items: int
+
+    # Build output dicts straight from (code, description, units, line items)
+    # rows, for dump_json() to encode
+    @staticmethod
+    def from_rows(rows: Iterable[Tuple]) -> List[dict]:
+        return [
+            { "cpt_code": code, "cpt_code_description": description, "units": units, "line_items": line_items }
+            for code, description, units, line_items in rows
+        ]
+
+# Billing totals of a CPT code on one encounter date
+class DailyCPTCodeTotalOutput(CPTCodeTotalOutput):
+    date: str
+
+    # Build output dicts straight from (date, code, description, units, line
+    # items) rows, for dump_json() to encode
+    @staticmethod
+    def from_rows(rows: Iterable[Tuple]) -> List[dict]:
+        return [
+            { "date": date, "cpt_code": code, "cpt_code_description": description, "units": units, "line_items": line_items }
+            for date, code, description, units, line_items in rows
+        ]
+
+# Outcome of one item of a batch request: the status code and either the new
+# record's ID or the error detail the single-record endpoint would return
+class BatchItemOutput(BaseModel):
+    index: int
+    status: int
+    id: Optional[str] = None
+    detail: Optional[str] = None
+
+class BatchOutput(BaseModel):
+    succeeded: int
+    failed: int
+    results: List[BatchItemOutput]
@@ -0,0 +1,186 @@
+from datetime import datetime
+import json
+import uuid
+from fastapi import APIRouter, HTTPException, Request
+from peewee import IntegrityError, chunked
+from pydantic import BaseModel, ValidationError
+from typing import Callable, List, Optional, Tuple, Type
+
+from .api_input import PatientInput, EncounterBatchInput, LineItemBatchInput
+from .api_output import BatchItemOutput, BatchOutput
+from config import log, settings
+from cpt_cache import cpt_code_cache
+from db_config import write_transaction
+from db_executor import run_db
+import model
+from model import Patient, Encounter, LineItem
+from .pagination import NDJSON
+from response_cache import response_cache
+from .routers import routers
+
+router = APIRouter()
+
+# Batch ingestion API endpoints
+#
+# Each endpoint takes a JSON array, or NDJSON with one item per line, of the
+# input the single-record POST takes plus the IDs from its URL. Items are
+# validated up front, then handled in chunks of BATCH_CHUNK_SIZE: every chunk
+# resolves its patients, encounters and CPT codes with one query per kind and
+# inserts its rows with one multi-row INSERT, then bumps the versions of the
+# patients it wrote to with one UPDATE, all in one transaction. The
+# response reports the outcome of each item with the status code and detail
+# the single-record endpoint would have returned.
+
+max_items = int(settings.BATCH_MAX_ITEMS)
+chunk_size = int(settings.BATCH_CHUNK_SIZE)
+
+# OpenAPI request body for a batch of input_model items
+def batch_request_body(input_model: Type[BaseModel]) -> dict:
+    schema = input_model.model_json_schema()
+    return {"requestBody": {"required": True, "content": {
+        "application/json": {"schema": {"type": "array", "items": schema}},
+        NDJSON: {"schema": schema},
+    }}}
+
+# Parse a batch request body and validate each item. Returns the valid items
+# as (index, item) tuples and the results for the invalid ones.
+async def read_batch(request: Request, input_model: Type[BaseModel]) -> Tuple[list, List[BatchItemOutput]]:
+    body = await request.body()
+    try:
+        if NDJSON in request.headers.get("content-type", ""):
+            data = [ json.loads(line) for line in body.splitlines() if line.strip() ]
+        else:
+            data = json.loads(body)
+    except ValueError:
+        log.info("invalid batch body")
+        raise HTTPException(status_code=400, detail="invalid JSON")
+    if not isinstance(data, list):
+        log.info("batch body is not a list")
+        raise HTTPException(status_code=400, detail="expected a list of items")
+    if len(data) > max_items:
+        log.info("batch too large", items=len(data))
+        raise HTTPException(status_code=413, detail=f"at most {max_items} items per batch")
+
+    items, errors = [], []
+    for index, item in enumerate(data):
+        try:
+            items.append((index, input_model.model_validate(item)))
+        except ValidationError as e:
+            error = e.errors()[0]
+            location = ".".join(str(part) for part in error["loc"]) or "item"
+            errors.append(BatchItemOutput(index=index, status=422, detail=f"{location}: {error['msg']}"))
+    return items, errors
+
+# Parse a UUID from an item, or None if it isn't one
+def parse_uuid(value: str) -> Optional[uuid.UUID]:
+    try:
+        return uuid.UUID(value)
+    except ValueError:
+        return None
+
+# Resolve and insert one chunk of items in a transaction. resolve(chunk)
+# returns the chunk's results, the rows to insert for the items that passed
+# and the IDs of the patients they belong to; if the insert fails, those
+# items are reported as failed instead. Returns the results and the IDs of
+# the patients written to.
+def write_chunk(resolve: Callable, table, fields: list, failure: str, chunk: list) -> Tuple[List[BatchItemOutput], set]:
+    with write_transaction() as transaction:
+        results, rows, patient_ids = resolve(chunk)
+        try:
+            if rows:
+                table.insert_many(rows, fields=fields).execute()
+                model.bump_patient_versions(patient_ids)
+        except IntegrityError:
+            transaction.rollback()
+            log.error(failure, items=len(rows))
+            for result in results:
+                if result.status == 200:
+                    result.status, result.id, result.detail = 400, None, failure
+            patient_ids = set()
+    return results, patient_ids
+
+# Validate, resolve and insert a whole batch
+async def run_batch(request: Request, input_model: Type[BaseModel], resolve: Callable, table, fields: list, failure: str) -> BatchOutput:
+    items, results = await read_batch(request, input_model)
+    for chunk in chunked(items, chunk_size):
+        chunk_results, patient_ids = await run_db(write_chunk, resolve, table, fields, failure, chunk)
+        results += chunk_results
+        response_cache.invalidate(*patient_ids)
+    results.sort(key=lambda result: result.index)
+    succeeded = sum(1 for result in results if result.status == 200)
+    log.info("batch processed", table=table._meta.table_name, succeeded=succeeded, failed=len(results) - succeeded)
+    return BatchOutput(succeeded=succeeded, failed=len(results) - succeeded, results=results)
+
+def resolve_patients(chunk):
+    results, rows = [], []
+    for index, patient in chunk:
+        id = uuid.uuid4()
+        rows.append((id, patient.first_name, patient.last_name))
+        results.append(BatchItemOutput(index=index, status=200, id=str(id)))
+    return results, rows, set()
+
+def resolve_encounters(chunk):
+    patient_ids = { parse_uuid(encounter.patient_id) for _, encounter in chunk } - {None}
+    existing = model.existing_patient_ids(patient_ids)
+    results, rows = [], []
+    for index, encounter in chunk:
+        patient_id = parse_uuid(encounter.patient_id)
+        try:
+            datetime.strptime(encounter.date, "%Y-%m-%d")
+        except ValueError:
+            results.append(BatchItemOutput(index=index, status=400, detail="invalid date format"))
+            continue
+        if patient_id not in existing:
+            results.append(BatchItemOutput(index=index, status=404, detail="patient not found"))
+            continue
+        id = uuid.uuid4()
+        rows.append((id, patient_id, encounter.date))
+        results.append(BatchItemOutput(index=index, status=200, id=str(id)))
+    return results, rows, { row[1] for row in rows }
+
+def resolve_line_items(chunk):
+    patient_ids = { parse_uuid(line_item.patient_id) for _, line_item in chunk } - {None}
+    encounter_ids = { parse_uuid(line_item.encounter_id) for _, line_item in chunk } - {None}
+    existing = model.existing_patient_ids(patient_ids)
+    encounter_patients = model.encounter_patient_ids(encounter_ids)
+
+    # CPT codes come from the cache, reading any misses through in one query
+    cpt_codes = { line_item.cpt_code: cpt_code_cache.get(line_item.cpt_code) for _, line_item in chunk }
+    missing = { code for code, cpt in cpt_codes.items() if cpt is None }
+    for code, cpt in model.cpt_codes_by_code(missing).items():
+        cpt_code_cache.put(code, *cpt)
+        cpt_codes[code] = cpt
+
+    results, rows, written = [], [], set()
+    for index, line_item in chunk:
+        patient_id = parse_uuid(line_item.patient_id)
+        encounter_id = parse_uuid(line_item.encounter_id)
+        cpt = cpt_codes[line_item.cpt_code]
+        if patient_id not in existing:
+            results.append(BatchItemOutput(index=index, status=404, detail="patient not found"))
+        elif encounter_patients.get(encounter_id) != patient_id:
+            results.append(BatchItemOutput(index=index, status=404, detail="encounter not found"))
+        elif cpt is None:
+            results.append(BatchItemOutput(index=index, status=404, detail="CPT code not found"))
+        else:
+            rows.append((encounter_id, cpt[0], line_item.units))
+            results.append(BatchItemOutput(index=index, status=200))
+            written.add(patient_id)
+    return results, rows, written
+
+@router.post("/batch/patients/", openapi_extra=batch_request_body(PatientInput))
+async def add_patients(request: Request) -> BatchOutput:
+    return await run_batch(request, PatientInput, resolve_patients,
+        Patient, [Patient.id, Patient.first_name, Patient.last_name], "failure creating patient")
+
+@router.post("/batch/encounters/", openapi_extra=batch_request_body(EncounterBatchInput))
+async def add_encounters(request: Request) -> BatchOutput:
+    return await run_batch(request, EncounterBatchInput, resolve_encounters,
+        Encounter, [Encounter.id, Encounter.patient, Encounter.date], "failure creating encounter")
+
+@router.post("/batch/line_items/", openapi_extra=batch_request_body(LineItemBatchInput))
+async def add_line_items(request: Request) -> BatchOutput:
+    return await run_batch(request, LineItemBatchInput, resolve_line_items,
+        LineItem, [LineItem.encounter, LineItem.cpt_code, LineItem.units], "failure creating line item")
+
+routers.append(router)
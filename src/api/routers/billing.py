@@ -0,0 +1,71 @@
+from datetime import date
+from fastapi import APIRouter, Depends, HTTPException, Query
+from peewee import IntegrityError
+from typing import List, Optional
+
+from .api_input import PatientId
+from .api_output import CPTCodeTotalOutput, DailyCPTCodeTotalOutput
+from .pagination import Page
+from config import log
+from db_executor import run_db
+import model
+from .routers import routers
+
+router = APIRouter()
+
+# Billing summary API endpoints
+#
+# Units and line item counts per CPT code are totalled in the database with
+# GROUP BY, for one patient or across all patients, optionally per encounter
+# date. Results are paged by their group key like the list endpoints, and
+# "Accept: application/x-ndjson" streams a whole date range.
+
+# Encounter date range query parameters, inclusive
+class DateRange:
+    def __init__(
+        self,
+        start: Optional[date] = Query(None, description="first encounter date to include"),
+        end: Optional[date] = Query(None, description="last encounter date to include"),
+    ):
+        if start and end and start > end:
+            log.info("invalid date range", start=start, end=end)
+            raise HTTPException(status_code=400, detail="start is after end")
+        self.start = start
+        self.end = end
+
+@router.get("/patients/{patient_id}/billing/", response_model=List[CPTCodeTotalOutput])
+async def get_patient_billing(patient_id: PatientId, dates: DateRange = Depends(), page: Page = Depends()):
+    # Cursors hold the last CPT code
+    after = page.cursor(str)
+    try:
+        # Total a page of CPT codes, checking that the patient exists in the same query
+        def fetch(after, limit):
+            return model.get_patient_cpt_code_totals(patient_id, dates.start, dates.end, after, limit)
+        totals = await run_db(fetch, after, page.fetch_size)
+        if totals is None:
+            log.info("patient not found", patient_id=patient_id)
+            raise HTTPException(status_code=404, detail="patient not found")
+        return page.respond(totals,
+            key=lambda row: (row[0],), serialize=CPTCodeTotalOutput.from_rows, fetch=fetch)
+    except IntegrityError:
+        log.error("failure retrieving billing totals", patient_id=patient_id)
+        raise HTTPException(status_code=400, detail="failure retrieving billing totals")
+
+@router.get("/billing/cpt_codes/", response_model=List[CPTCodeTotalOutput])
+async def get_cpt_code_billing(dates: DateRange = Depends(), page: Page = Depends()):
+    def fetch(after, limit):
+        return model.get_cpt_code_totals(dates.start, dates.end, after, limit)
+    totals = await run_db(fetch, page.cursor(str), page.fetch_size)
+    return page.respond(totals,
+        key=lambda row: (row[0],), serialize=CPTCodeTotalOutput.from_rows, fetch=fetch)
+
+@router.get("/billing/daily/", response_model=List[DailyCPTCodeTotalOutput])
+async def get_daily_billing(dates: DateRange = Depends(), page: Page = Depends()):
+    def fetch(after, limit):
+        return model.get_daily_cpt_code_totals(dates.start, dates.end, after, limit)
+    # Cursors hold the last encounter date and CPT code
+    totals = await run_db(fetch, page.cursor(date.fromisoformat, str), page.fetch_size)
+    return page.respond(totals,
+        key=lambda row: (row[0], row[1]), serialize=DailyCPTCodeTotalOutput.from_rows, fetch=fetch)
+
+routers.append(router)
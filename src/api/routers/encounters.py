@@ -1,11 +1,17 @@
-from datetime import datetime
-from fastapi import APIRouter, HTTPException
+from datetime import date, datetime
+from fastapi import APIRouter, Depends, HTTPException, Request
 from peewee import IntegrityError
+from typing import List
+import uuid
 
-from .api_input import EncounterInput
+from .api_input import EncounterInput, PatientId, EncounterId
 from .api_output import EncounterOutput
+from .pagination import Page
 from config import log
-from model import Patient, Encounter
+from db_executor import run_db
+import idempotency
+import model
+from response_cache import response_cache
 from .routers import routers
 
 router = APIRouter()
@@ -13,7 +19,7 @@ router = APIRouter()
 # Patient encounters API endpoints
 
 @router.post("/patients/{patient_id}/encounters/")
-async def add_patient_encounter(patient_id: str, encounter: EncounterInput):
+async def add_patient_encounter(request: Request, patient_id: PatientId, encounter: EncounterInput):
     try:
         # Check the date format first
         try:
@@ -21,53 +27,54 @@ async def add_patient_encounter(patient_id: str, encounter: EncounterInput):
         except ValueError:
             log.info("invalid encounter date format", patient_id=patient_id, date=encounter.date)
             raise HTTPException(status_code=400, detail="invalid date format")
-        # Check if the patient exists and retrieve
-        patient = Patient.get_or_none(Patient.id == patient_id)
-        if not patient:
-            log.info("patient not found", patient_id=patient_id)
-            raise HTTPException(status_code=404, detail="patient not found")
-        # Create the new patient encounter
-        encounter = Encounter.create(patient=patient, date=encounter.date)
-        return EncounterOutput.from_encounter(encounter)
+        # Create the new patient encounter if the patient exists
+        def write():
+            encounter_id = model.create_encounter_for_patient(patient_id, encounter.date)
+            if not encounter_id:
+                log.info("patient not found", patient_id=patient_id)
+                raise HTTPException(status_code=404, detail="patient not found")
+            return EncounterOutput(id=str(encounter_id), date=encounter.date)
+        output = await idempotency.run_write(request, write)
+        response_cache.invalidate(patient_id)
+        return output
 
     except IntegrityError:
         log.error("failure creating encounter", patient_id=patient_id, date=encounter.date)
         raise HTTPException(status_code=400, detail="failure creating encounter")
 
-@router.get("/patients/{patient_id}/encounters/")
-async def get_patient_encounters(patient_id: str):
+@router.get("/patients/{patient_id}/encounters/", response_model=List[EncounterOutput])
+async def get_patient_encounters(patient_id: PatientId, page: Page = Depends()):
+    # Encounter cursors hold the date and ID of the last encounter
+    after = page.cursor(date.fromisoformat, uuid.UUID)
     try:
-        # Check if the patient exists and retrieve
-        patient = Patient.get_or_none(Patient.id == patient_id)
-        if not patient:
+        # Retrieve a page of encounters, checking that the patient exists in the same query
+        def fetch(after, limit):
+            return model.get_encounters_for_patient(patient_id, after, limit)
+        encounters = await run_db(fetch, after, page.fetch_size)
+        if encounters is None:
             log.info("patient not found", patient_id=patient_id)
             raise HTTPException(status_code=404, detail="patient not found")
-
-        # Retrieve encounters
-        # This might be a bit inefficient as it retrieves all encounters for the patient
-        # but for this demo, we'll let it go.
-        patient.encounters.dicts().execute()
-        return [ EncounterOutput.from_encounter(encounter) for encounter in patient.encounters ]
+        return page.respond(encounters,
+            key=lambda row: (row[1], row[0]), serialize=EncounterOutput.from_rows, fetch=fetch)
     except IntegrityError:
         log.error("failure retrieving encounters", patient_id=patient_id)
         raise HTTPException(status_code=400, detail="failure retrieving encounters")
 
 @router.get("/patients/{patient_id}/encounters/{encounter_id}")
-async def get_patient_encounter(patient_id: str, encounter_id: str):
+async def get_patient_encounter(patient_id: PatientId, encounter_id: EncounterId):
     try:
-        # Check if the patient exists and retrieve
-        patient = Patient.get_or_none(Patient.id == patient_id)
-        if not patient:
+        # Check that the patient and encounter exist and retrieve
+        found = await run_db(model.find_patient_encounter, patient_id, encounter_id)
+        if not found:
             log.info("patient not found", patient_id=patient_id, encounter_id=encounter_id)
             raise HTTPException(status_code=404, detail="patient not found")
 
-        # Check if the encounter exists and retrieve
-        encounter = Encounter.get_or_none(Encounter.id == encounter_id, Encounter.patient == patient_id)
-        if not encounter:
+        id, date = found
+        if not id:
             log.info("patient encounter not found", patient_id=patient_id, encounter_id=encounter_id)
             raise HTTPException(status_code=404, detail="encounter not found")
 
-        return EncounterOutput.from_encounter(encounter)
+        return EncounterOutput(id=str(id), date=str(date))
 
     except IntegrityError:
         log.error("failure retrieving encounter", patient_id=patient_id, encounter_id=encounter_id)
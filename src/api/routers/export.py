@@ -0,0 +1,60 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from typing import Optional
+import uuid
+
+from .billing import DateRange
+from config import log
+from db_executor import run_db
+import export
+from .routers import routers
+
+router = APIRouter()
+
+# Bulk export API endpoints
+#
+# Exports are streamed batch by batch, see export.py. Reading a batch and
+# encoding it both run on the database executor, so a large export doesn't
+# hold up the event loop.
+
+@router.get("/export/line_items")
+async def export_line_items(
+    format: Optional[str] = Query(None, description="parquet, arrow or csv (gzip compressed)"),
+    patient_id: Optional[uuid.UUID] = Query(None, description="only export this patient's line items"),
+    dates: DateRange = Depends(),
+):
+    format = format or export.available_formats()[0]
+    if format not in export.FORMATS:
+        log.info("invalid export format", format=format)
+        raise HTTPException(status_code=400, detail="invalid export format")
+    if format not in export.available_formats():
+        log.info("unavailable export format", format=format)
+        raise HTTPException(status_code=400, detail="export format not available")
+
+    buffer = export.ChunkBuffer()
+    writer = export.ExportWriter(buffer, format)
+    batches = export.line_item_batches(start=dates.start, end=dates.end, patient_id=patient_id)
+
+    # Read and encode the next batch, closing the writer after the last one.
+    # Returns the encoded bytes and whether the export is done.
+    def next_chunk():
+        rows = next(batches, None)
+        if rows is None:
+            writer.close()
+        else:
+            writer.write(rows)
+        return buffer.take(), rows is None
+
+    async def chunks():
+        done = False
+        while not done:
+            chunk, done = await run_db(next_chunk)
+            if chunk:
+                yield chunk
+        log.info("exported line items", format=format, rows=writer.rows)
+
+    media_type, extension = export.FORMATS[format]
+    return StreamingResponse(chunks(), media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="line_items.{extension}"'})
+
+routers.append(router)
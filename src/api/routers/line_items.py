@@ -1,11 +1,16 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from peewee import IntegrityError
+from typing import List
 
-from .api_input import LineItemInput
+from .api_input import LineItemInput, PatientId, EncounterId
 from .api_output import LineItemOutput
+from .pagination import Page
 from config import log
+from cpt_cache import cpt_code_cache
+from db_executor import run_db
+import idempotency
 import model
-from model import Patient, CPTCode, Encounter, LineItem
+from response_cache import response_cache
 from .routers import routers
 
 router = APIRouter()
@@ -13,56 +18,76 @@ router = APIRouter()
 # Patient encounter line items API endpoints
 
 @router.post("/patients/{patient_id}/encounters/{encounter_id}/line_items/")
-async def add_patient_encounter_line_item(patient_id: str, encounter_id: str, line_item: LineItemInput):
-    try:
-        # Check if the patient exists and retrieve
-        patient = Patient.get_or_none(Patient.id == patient_id)
-        if not patient:
+async def add_patient_encounter_line_item(request: Request, patient_id: PatientId, encounter_id: EncounterId, line_item: LineItemInput):
+    # Check the patient and encounter and create the line item in one
+    # transaction
+    def write():
+        # Look the CPT code up in the cache. On a miss, read it through from
+        # the database in the same query that checks the patient and encounter.
+        cpt = cpt_code_cache.get(line_item.cpt_code)
+        if cpt:
+            found = model.find_patient_encounter(patient_id, encounter_id)
+        else:
+            found = model.find_patient_encounter_cpt_code(patient_id, encounter_id, line_item.cpt_code)
+        if not found:
             log.info("patient not found", patient_id=patient_id, encounter_id=encounter_id)
             raise HTTPException(status_code=404, detail="patient not found")
-        
-        # Check if the encounter exists and retrieve
-        encounter = Encounter.get_or_none(Encounter.id == encounter_id, Encounter.patient == patient_id)
-        if not encounter:
+
+        found_encounter_id = found[0]
+        if not found_encounter_id:
             log.info("encounter not found", patient_id=patient_id, encounter_id=encounter_id)
             raise HTTPException(status_code=404, detail="encounter not found")
-        
-        # Check if the CPT code exists
-        cpt = CPTCode.get_or_none(CPTCode.code == line_item.cpt_code)
+
         if not cpt:
-            log.info("CPT code not found", cpt_code=line_item.cpt_code)
-            raise HTTPException(status_code=404, detail="CPT code not found")
-        
+            _, cpt_code_id, cpt_code_description = found
+            if not cpt_code_id:
+                log.info("CPT code not found", cpt_code=line_item.cpt_code)
+                raise HTTPException(status_code=404, detail="CPT code not found")
+            cpt = (cpt_code_id, cpt_code_description)
+            cpt_code_cache.put(line_item.cpt_code, *cpt)
+        cpt_code_id, cpt_code_description = cpt
+
         # Create the line item
-        line_item = LineItem.create(encounter=encounter, cpt_code=cpt, units=line_item.units)
+        model.create_line_item(patient_id, found_encounter_id, cpt_code_id, line_item.units)
 
         # Return the line item output data
-        return LineItemOutput.from_line_item(line_item)
+        return LineItemOutput(
+            cpt_code=line_item.cpt_code,
+            cpt_code_description=cpt_code_description,
+            units=line_item.units,
+        )
+
+    try:
+        output = await idempotency.run_write(request, write)
+        response_cache.invalidate(patient_id)
+        return output
 
     except IntegrityError:
         log.error("failure creating line item", patient_id=patient_id, encounter_id=encounter_id)
         raise HTTPException(status_code=400, detail="failure creating line item")
 
-@router.get("/patients/{patient_id}/encounters/{encounter_id}/line_items/")
-async def get_patient_encounter_line_items(patient_id: str, encounter_id: str):
+@router.get("/patients/{patient_id}/encounters/{encounter_id}/line_items/", response_model=List[LineItemOutput])
+async def get_patient_encounter_line_items(patient_id: PatientId, encounter_id: EncounterId, page: Page = Depends()):
+    # Line item cursors hold the ID of the last line item
+    after = page.cursor(int)
     try:
-        # Check if the patient exists and retrieve
-        patient = Patient.get_or_none(Patient.id == patient_id)
-        if not patient:
+        # Check that the patient and encounter exist in one query
+        found = await run_db(model.find_patient_encounter, patient_id, encounter_id)
+        if not found:
             log.info("patient not found", patient_id=patient_id)
             raise HTTPException(status_code=404, detail="patient not found")
-        
-        # Check if the encounter exists and retrieve
-        encounter = Encounter.get_or_none(Encounter.id == encounter_id, Encounter.patient == patient_id)
-        if not encounter:
+
+        found_encounter_id, _ = found
+        if not found_encounter_id:
             log.info("encounter not found", patient_id=patient_id, encounter_id=encounter_id)
             raise HTTPException(status_code=404, detail="encounter not found")
-        
-        # Retrieve line items with CPT code descriptions
-        # This might also be a bit inefficient because an encounter might have
-        # a lot of line items, but for the purposes of a demo, we'll let it go.
-        line_items = model.get_line_items_for_encounter(encounter)
-        return [ LineItemOutput.from_line_item(line_item) for line_item in line_items ]
+
+        # Retrieve a page of line items with CPT code descriptions
+        def fetch(after, limit):
+            return model.get_line_items_for_encounter(found_encounter_id, after, limit)
+        line_items = await run_db(fetch, after, page.fetch_size)
+        return page.respond(line_items,
+            key=lambda row: (row[0],), serialize=LineItemOutput.from_rows, fetch=fetch)
 
     except IntegrityError:
         log.error("failure retrieving line items", patient_id=patient_id, encounter_id=encounter_id)
@@ -0,0 +1,106 @@
+import base64
+import json
+from fastapi import HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from typing import Callable, List, Optional, Sequence
+
+from .api_output import dump_json, dump_ndjson
+from config import log, settings
+from db_executor import run_db
+
+# Keyset pagination for the list endpoints. Rows are returned in a stable order
+# and a page ends at some row; the opaque cursor encodes that row's sort key so
+# the next page starts right after it with an indexed range condition instead
+# of an OFFSET. The next page's cursor is sent in the X-Next-Cursor header and
+# a Link header, leaving the body a plain JSON list.
+#
+# Sending "Accept: application/x-ndjson" streams every row from the cursor on
+# as newline-delimited JSON instead, fetching STREAM_BATCH_SIZE rows at a time
+# so a full export runs in constant memory.
+#
+# Rows are turned into plain dicts and encoded with dump_json() into a raw
+# Response, so list endpoints never build a Pydantic model per row. Endpoints
+# still declare response_model for the OpenAPI schema; FastAPI doesn't
+# validate Response objects against it.
+
+NDJSON = "application/x-ndjson"
+
+default_limit = int(settings.PAGE_DEFAULT_LIMIT)
+max_limit = int(settings.PAGE_MAX_LIMIT)
+stream_batch_size = int(settings.STREAM_BATCH_SIZE)
+
+def encode_cursor(key: Sequence) -> str:
+    data = json.dumps([ str(value) for value in key ], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> List[str]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        key = None
+    if not isinstance(key, list) or not all(isinstance(value, str) for value in key):
+        log.info("invalid cursor", cursor=cursor)
+        raise HTTPException(status_code=400, detail="invalid cursor")
+    return key
+
+# Query parameters of a paginated list endpoint, used as a dependency
+class Page:
+    def __init__(
+        self,
+        request: Request,
+        limit: int = Query(default_limit, ge=1, le=max_limit, description="maximum number of items to return"),
+        cursor: Optional[str] = Query(None, description="X-Next-Cursor value of the previous page"),
+    ):
+        self.request = request
+        self.limit = limit
+        self.after = decode_cursor(cursor) if cursor else None
+        self.stream = NDJSON in request.headers.get("accept", "")
+
+    # The cursor's sort key, each value parsed by the endpoint's parser for
+    # its column, e.g. page.cursor(date.fromisoformat, uuid.UUID), or None
+    # without a cursor. A cursor with the wrong number of values, or a value
+    # that doesn't parse, is rejected with a 400 rather than reaching the query.
+    def cursor(self, *parsers: Callable[[str], object]) -> Optional[list]:
+        if self.after is None:
+            return None
+        try:
+            if len(self.after) != len(parsers):
+                raise ValueError("wrong number of values")
+            return [ parse(value) for parse, value in zip(parsers, self.after) ]
+        except ValueError:
+            log.info("invalid cursor", cursor=self.after)
+            raise HTTPException(status_code=400, detail="invalid cursor")
+
+    # Number of rows to fetch for the first query: one extra row tells whether
+    # there is a next page
+    @property
+    def fetch_size(self) -> int:
+        return stream_batch_size if self.stream else self.limit + 1
+
+    # Build the response for the first fetched rows. fetch(after, limit) gets
+    # more rows when streaming, key(row) gives a row's sort key and
+    # serialize(rows) turns rows into output dicts.
+    def respond(self, rows: list, key: Callable, serialize: Callable,
+                fetch: Callable[..., list] = None) -> Response:
+        if self.stream:
+            return ndjson_response(rows, fetch, key, serialize)
+        headers = {}
+        if len(rows) > self.limit:
+            rows = rows[:self.limit]
+            cursor = encode_cursor(key(rows[-1]))
+            next_url = self.request.url.include_query_params(cursor=cursor, limit=self.limit)
+            headers["X-Next-Cursor"] = cursor
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        return Response(dump_json(serialize(rows)), media_type="application/json", headers=headers)
+
+# Stream rows as NDJSON, starting with the rows already fetched and fetching
+# the rest in batches on the database executor
+def ndjson_response(rows: list, fetch: Callable[..., list], key: Callable, serialize: Callable) -> StreamingResponse:
+    async def lines():
+        batch = rows
+        while batch:
+            yield dump_ndjson(serialize(batch))
+            if len(batch) < stream_batch_size:
+                break
+            batch = await run_db(fetch, key(batch[-1]), stream_batch_size) or []
+    return StreamingResponse(lines(), media_type=NDJSON)
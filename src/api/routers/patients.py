@@ -1,9 +1,15 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from peewee import IntegrityError
+from typing import List, Optional
+import uuid
 
-from .api_input import PatientInput
-from .api_output import PatientOutput
+from .api_input import PatientInput, PatientId
+from .api_output import PatientOutput, PatientRecordOutput, dump_json
+from .pagination import Page
 from config import log
+from db_executor import run_db
+import idempotency
+import model
 from model import Patient
 from .routers import routers
 
@@ -12,23 +18,42 @@ router = APIRouter()
 # Patients API endpoints
 
 @router.post("/patients/")
-async def add_patient(patient: PatientInput):
+async def add_patient(request: Request, patient: PatientInput):
+    def write():
+        return PatientOutput.from_patient(Patient.create(first_name=patient.first_name, last_name=patient.last_name))
     try:
-        patient = Patient.create(first_name=patient.first_name, last_name=patient.last_name)
-        return PatientOutput.from_patient(patient)
+        return await idempotency.run_write(request, write)
     except IntegrityError:
         log.error("failure creating patient")
         raise HTTPException(status_code=400, detail="failure creating patient")
 
-@router.get("/patients/")
-async def get_patients():
-    patients = Patient.select()
-    return [ PatientOutput.from_patient(patient) for patient in patients ]
-    
+@router.get("/patients/", response_model=List[PatientOutput])
+async def get_patients(page: Page = Depends()):
+    patients = await run_db(model.get_patients, page.cursor(uuid.UUID), page.fetch_size)
+    return page.respond(patients,
+        key=lambda row: (row[0],), serialize=PatientOutput.from_rows, fetch=model.get_patients)
+
+
+# Patients whose names start with the words of `q`, best matches first. Comes
+# before /patients/{patient_id} so "search" isn't taken for an ID.
+@router.get("/patients/search", response_model=List[PatientOutput])
+async def search_patients(q: str = Query(..., max_length=200, description="words the first or last name start with"),
+                          page: Page = Depends()):
+    terms = model.patient_search_terms(q)
+    if not terms:
+        log.info("invalid patient search", q=q)
+        raise HTTPException(status_code=400, detail="invalid search")
+    def fetch(after, limit):
+        return model.search_patients(terms, after, limit)
+    patients = await run_db(fetch, page.cursor(int, str, str, uuid.UUID), page.fetch_size)
+    return page.respond(patients,
+        key=lambda row: (row[3], row[4], row[5], row[0]),
+        serialize=lambda rows: PatientOutput.from_rows(row[:3] for row in rows), fetch=fetch)
+
 @router.get("/patients/{patient_id}")
-async def get_patient(patient_id: str):
+async def get_patient(patient_id: PatientId):
     try:
-        patient = Patient.get_or_none(Patient.id == patient_id)
+        patient = await run_db(Patient.get_or_none, Patient.id == patient_id)
         if not patient:
             log.info("patient not found", patient_id=patient_id)
             raise HTTPException(status_code=404, detail="patient not found")
@@ -37,4 +62,24 @@ async def get_patient(patient_id: str):
         log.error("failure retrieving patient", patient_id=patient_id)
         raise HTTPException(status_code=400, detail="failure retrieving patient")
 
+# The patient with all its encounters and line items, nested, in one query.
+# `fields` picks the fields to return, see PatientRecordOutput.
+@router.get("/patients/{patient_id}/record", response_model=PatientRecordOutput)
+async def get_patient_record(patient_id: PatientId,
+                             fields: Optional[str] = Query(None, description="comma separated fields to return")):
+    try:
+        selected = PatientRecordOutput.select_fields(fields)
+    except ValueError as e:
+        log.info("invalid record field", field=str(e))
+        raise HTTPException(status_code=400, detail=f"invalid field: {e}")
+    try:
+        rows = await run_db(model.get_patient_record, patient_id, PatientRecordOutput.depth(selected))
+        if not rows:
+            log.info("patient not found", patient_id=patient_id)
+            raise HTTPException(status_code=404, detail="patient not found")
+        return Response(dump_json(PatientRecordOutput.from_rows(rows, selected)), media_type="application/json")
+    except IntegrityError:
+        log.error("failure retrieving patient record", patient_id=patient_id)
+        raise HTTPException(status_code=400, detail="failure retrieving patient record")
+
 routers.append(router)
@@ -0,0 +1,36 @@
+from fastapi import APIRouter
+from fastapi.responses import Response
+
+from admission import admission
+
+from config import log_pipeline
+from cpt_cache import cpt_code_cache
+from db_config import pool_stats, replica_stats
+import metrics
+from response_cache import response_cache
+import startup
+from .routers import routers
+
+router = APIRouter()
+
+# Runtime statistics endpoint
+
+@router.get("/stats/")
+async def stats():
+    return {
+        "database_pool": pool_stats(),
+        "database_replicas": replica_stats(),
+        "cpt_code_cache": cpt_code_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "logs": log_pipeline.stats(),
+        "admission": admission.stats(),
+        "startup_seconds": startup.phases,
+    }
+
+# Prometheus metrics endpoint
+@router.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    metrics.collect(pool_stats(), cpt_code_cache.stats(), response_cache.stats(), log_pipeline.stats(), admission.stats())
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+routers.append(router)
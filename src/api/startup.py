@@ -0,0 +1,26 @@
+import time
+from contextlib import contextmanager
+
+# Startup timing report. Importing this module first starts the clock; the
+# app's startup phases are timed with phase() and report() logs them all at
+# boot, so cold start regressions show up in the logs. The phases are also
+# shown by GET /stats/.
+started = time.perf_counter()
+phases = {}
+
+@contextmanager
+def phase(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = round(time.perf_counter() - start, 4)
+
+# Record a phase that started at `since`, by default when this module was imported
+def mark(name: str, since: float = started):
+    phases[name] = round(time.perf_counter() - since, 4)
+
+def report():
+    from config import log
+    mark("total")
+    log.info("startup timing", **{ f"{name}_seconds": seconds for name, seconds in phases.items() })
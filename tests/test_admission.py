@@ -0,0 +1,103 @@
+import asyncio
+from fastapi import FastAPI
+from httpx import AsyncClient, ASGITransport
+import pytest
+
+from admission import admission, Admission, AdmissionMiddleware, Limiter, LatencyController
+from api import app
+from model import Patient
+
+# Requests over the limit wait in the queue, and are rejected when it's full
+# or their wait runs out
+@pytest.mark.asyncio
+async def test_limiter_queue():
+    limiter = Limiter(limit=1, queue_size=1, queue_timeout=1)
+    assert await limiter.acquire()
+    waiting = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    assert not await limiter.acquire()
+    limiter.release()
+    assert await waiting
+    assert limiter.stats() == { "limit": 1, "active": 1, "waiting": 0, "admitted": 2, "queued": 1, "rejected": 1, "timed_out": 0 }
+
+    limiter.queue_timeout = 0.01
+    assert not await limiter.acquire()
+    limiter.release()
+    assert limiter.stats()["timed_out"] == 1
+    assert limiter.active == 0
+
+# Slow database statements lower every limit, and fast ones bring them back
+def test_limits_adapt_to_db_latency():
+    admission = Admission(default_limit=20, limits={"GET /export/line_items": 2}, latency_target=0.05)
+    route, export = admission.limiter("GET /patients/"), admission.limiter("GET /export/line_items")
+    for _ in range(3):
+        admission.controller.observe("SELECT 1", 0.5)
+        admission.adjust()
+    assert (route.limit, export.limit) == (8, 1)
+    for _ in range(10):
+        admission.controller.observe("SELECT 1", 0.01)
+        admission.adjust()
+    assert (route.limit, export.limit) == (20, 2)
+    # a target of 0 keeps the limits fixed
+    fixed = LatencyController(0)
+    fixed.observe("SELECT 1", 0.5)
+    assert fixed.adjust() == 1.0
+
+# A request over a full route gets a fast 503 with Retry-After, while health
+# checks and other routes go through
+@pytest.mark.asyncio
+async def test_admission_middleware():
+    release = asyncio.Event()
+    test_app = FastAPI()
+    test_app.add_middleware(AdmissionMiddleware, routes=test_app.routes,
+        admission=Admission(default_limit=1, limits={}, queue_size=0, retry_after=3, latency_target=0))
+
+    @test_app.get("/slow/")
+    async def slow():
+        await release.wait()
+        return {}
+
+    @test_app.get("/fast/")
+    async def fast():
+        return {}
+
+    @test_app.get("/health/")
+    async def health():
+        return {}
+
+    async with AsyncClient(transport=ASGITransport(app=test_app), base_url="http://test") as ac:
+        first = asyncio.create_task(ac.get("/slow/"))
+        await asyncio.sleep(0.01)
+        response = await ac.get("/slow/")
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "3"
+        assert response.json() == {"detail": "server busy"}
+        assert (await ac.get("/fast/")).status_code == 200
+        assert (await ac.get("/health/")).status_code == 200
+        release.set()
+        assert (await first).status_code == 200
+        assert (await ac.get("/slow/")).status_code == 200
+
+# Admission statistics are exposed by the stats endpoint
+@pytest.mark.asyncio
+async def test_admission_stats():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        await ac.get("/patients/")
+        response = await ac.get("/stats/")
+    stats = response.json()["admission"]
+    assert stats["scale"] == 1.0
+    assert stats["routes"]["GET /patients/"]["admitted"] >= 1
+    assert "GET /health/" not in stats["routes"]
+
+# Reads the response cache would answer are shed before its version lookup
+@pytest.mark.asyncio
+async def test_admission_before_response_cache(monkeypatch, assert_num_queries):
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    limiter = admission.limiter("GET /patients/{patient_id}")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        assert (await ac.get(f"/patients/{patient.id}")).status_code == 200
+        monkeypatch.setattr(limiter, "limit", 0)
+        monkeypatch.setattr(limiter, "queue_size", 0)
+        with assert_num_queries(0):
+            response = await ac.get(f"/patients/{patient.id}")
+        assert response.status_code == 503
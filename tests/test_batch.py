@@ -0,0 +1,92 @@
+from httpx import AsyncClient, ASGITransport
+import json
+import pytest
+
+from api import app
+from model import Patient, Encounter, LineItem
+from routers import batch
+
+@pytest.fixture(scope='function', autouse=True)
+def test_setup_db():
+    Patient.delete().execute()
+    Encounter.delete().execute()
+    LineItem.delete().execute()
+
+# Add patients from a JSON array, reporting invalid items
+@pytest.mark.asyncio
+async def test_batch_patients():
+    items = [
+        {"first_name": "Pat", "last_name": "Doe"},
+        {"first_name": "Skylar"},
+        {"first_name": "Alex", "last_name": "Johnson"},
+    ]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.post("/batch/patients/", json=items)
+        assert response.status_code == 200
+        body = response.json()
+        assert (body["succeeded"], body["failed"]) == (2, 1)
+        assert [ result["status"] for result in body["results"] ] == [200, 422, 200]
+        assert body["results"][1]["detail"] == "last_name: Field required"
+        response = await ac.get(f"/patients/{body['results'][2]['id']}")
+        assert response.json()["last_name"] == "Johnson"
+
+# Add encounters from NDJSON with the single-record endpoint's errors
+@pytest.mark.asyncio
+async def test_batch_encounters_ndjson():
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    items = [
+        {"patient_id": str(patient.id), "date": "2021-01-01"},
+        {"patient_id": "123", "date": "2021-01-01"},
+        {"patient_id": str(patient.id), "date": "not-a-date"},
+        {"patient_id": str(patient.id), "date": "2021-01-02"},
+    ]
+    body = "\n".join(json.dumps(item) for item in items)
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.post("/batch/encounters/", content=body, headers={"Content-Type": "application/x-ndjson"})
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [ (result["status"], result["detail"]) for result in results ] == [
+            (200, None), (404, "patient not found"), (400, "invalid date format"), (200, None),
+        ]
+        response = await ac.get(f"/patients/{patient.id}/encounters/")
+        assert [ encounter["id"] for encounter in response.json() ] == [results[0]["id"], results[3]["id"]]
+
+# Line items are checked for patient, encounter ownership and CPT code with a
+# fixed number of queries per chunk, whatever the number of items
+@pytest.mark.asyncio
+async def test_batch_line_items(assert_num_queries, monkeypatch):
+    monkeypatch.setattr(batch, "chunk_size", 100)
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    other = Patient.create(first_name="Skylar", last_name="Smith")
+    encounter = Encounter.create(patient=patient, date="2021-01-01")
+    other_encounter = Encounter.create(patient=other, date="2021-01-01")
+    valid = {"patient_id": str(patient.id), "encounter_id": str(encounter.id), "cpt_code": "99213", "units": 1}
+    items = [ valid ] * 150 + [
+        { **valid, "patient_id": "123" },
+        { **valid, "encounter_id": str(other_encounter.id) },
+        { **valid, "cpt_code": "99999" },
+    ]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        # per chunk: BEGIN, patients, encounters, the insert and the patient
+        # version bump, plus one CPT code query in the second chunk for the
+        # code the cache misses
+        with assert_num_queries(11):
+            response = await ac.post("/batch/line_items/", json=items)
+        body = response.json()
+        assert (body["succeeded"], body["failed"]) == (150, 3)
+        assert [ result["detail"] for result in body["results"][150:] ] == [
+            "patient not found", "encounter not found", "CPT code not found",
+        ]
+    assert LineItem.select().where(LineItem.encounter == encounter).count() == 150
+
+# Reject bodies that aren't a list of items
+@pytest.mark.asyncio
+async def test_batch_bad_body(monkeypatch):
+    monkeypatch.setattr(batch, "max_items", 2)
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.post("/batch/patients/", content="{", headers={"Content-Type": "application/json"})
+        assert (response.status_code, response.json()) == (400, {"detail": "invalid JSON"})
+        response = await ac.post("/batch/patients/", json={"first_name": "Pat", "last_name": "Doe"})
+        assert (response.status_code, response.json()) == (400, {"detail": "expected a list of items"})
+        response = await ac.post("/batch/patients/", json=[{}] * 3)
+        assert response.status_code == 413
@@ -0,0 +1,123 @@
+import json
+from httpx import AsyncClient, ASGITransport
+import pytest
+
+from api import app
+from model import Patient, Encounter, LineItem, CPTCode
+from routers.pagination import encode_cursor
+
+@pytest.fixture(scope='function', autouse=True)
+def test_setup_db():
+    Patient.delete().execute()
+    Encounter.delete().execute()
+    LineItem.delete().execute()
+
+def cpt_code(code: str) -> CPTCode:
+    return CPTCode.get(CPTCode.code == code)
+
+# Two patients with line items on two dates
+@pytest.fixture
+def line_items():
+    pat = Patient.create(first_name="Pat", last_name="Doe")
+    sam = Patient.create(first_name="Sam", last_name="Doe")
+    first = Encounter.create(patient=pat, date="2021-01-01")
+    second = Encounter.create(patient=pat, date="2021-02-01")
+    other = Encounter.create(patient=sam, date="2021-01-01")
+    LineItem.create(encounter=first, cpt_code=cpt_code("99213"), units=1)
+    LineItem.create(encounter=first, cpt_code=cpt_code("81001"), units=2)
+    LineItem.create(encounter=second, cpt_code=cpt_code("99213"), units=3)
+    LineItem.create(encounter=other, cpt_code=cpt_code("99213"), units=4)
+    return pat, sam
+
+def totals(response) -> list:
+    return [ (row["cpt_code"], row["units"], row["line_items"]) for row in response.json() ]
+
+# Units per CPT code for one patient, in one query
+@pytest.mark.asyncio
+async def test_patient_billing(line_items, assert_num_queries):
+    pat, sam = line_items
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        with assert_num_queries(1):
+            response = await ac.get(f"/patients/{pat.id}/billing/")
+        assert response.status_code == 200
+        assert totals(response) == [("81001", 2, 1), ("99213", 4, 2)]
+        assert response.json()[1]["cpt_code_description"] == cpt_code("99213").description
+        response = await ac.get(f"/patients/{sam.id}/billing/", params={"end": "2020-12-31"})
+        assert response.status_code == 200
+        assert response.json() == []
+
+# Encounter dates are filtered to the range, inclusive
+@pytest.mark.asyncio
+async def test_patient_billing_date_range(line_items):
+    pat, _ = line_items
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get(f"/patients/{pat.id}/billing/", params={"start": "2021-02-01"})
+        assert totals(response) == [("99213", 3, 1)]
+        response = await ac.get(f"/patients/{pat.id}/billing/", params={"end": "2021-01-01"})
+        assert totals(response) == [("81001", 2, 1), ("99213", 1, 1)]
+        response = await ac.get(f"/patients/{pat.id}/billing/", params={"start": "2021-02-01", "end": "2021-01-01"})
+        assert response.status_code == 400
+
+# Billing totals of a patient that doesn't exist
+@pytest.mark.asyncio
+async def test_patient_billing_nonexistent_patient():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/patients/5d0e7ca5-6bb5-4b62-8a77-3e0a2d3bd0f1/billing/")
+        assert response.status_code == 404
+        assert response.json() == { "detail": "patient not found" }
+
+# Patient billing totals are paged by CPT code
+@pytest.mark.asyncio
+async def test_patient_billing_pages(line_items):
+    pat, _ = line_items
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        first = await ac.get(f"/patients/{pat.id}/billing/", params={"limit": 1})
+        assert totals(first) == [("81001", 2, 1)]
+        second = await ac.get(f"/patients/{pat.id}/billing/",
+            params={"limit": 1, "cursor": first.headers["x-next-cursor"]})
+        assert totals(second) == [("99213", 4, 2)]
+        assert "x-next-cursor" not in second.headers
+
+# Units per CPT code across all patients
+@pytest.mark.asyncio
+async def test_cpt_code_billing(line_items):
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/billing/cpt_codes/")
+        assert totals(response) == [("81001", 2, 1), ("99213", 8, 3)]
+        response = await ac.get("/billing/cpt_codes/", params={"start": "2021-01-01", "end": "2021-01-31"})
+        assert totals(response) == [("81001", 2, 1), ("99213", 5, 2)]
+
+# Units per encounter date and CPT code, paged and streamed
+@pytest.mark.asyncio
+async def test_daily_billing(line_items):
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/billing/daily/")
+        assert [ (row["date"], row["cpt_code"], row["units"]) for row in response.json() ] == [
+            ("2021-01-01", "81001", 2),
+            ("2021-01-01", "99213", 5),
+            ("2021-02-01", "99213", 3),
+        ]
+        first = await ac.get("/billing/daily/", params={"limit": 2})
+        second = await ac.get("/billing/daily/", params={"limit": 2, "cursor": first.headers["x-next-cursor"]})
+        assert first.json() + second.json() == response.json()
+        streamed = await ac.get("/billing/daily/", headers={"Accept": "application/x-ndjson"})
+        assert streamed.headers["content-type"] == "application/x-ndjson"
+        assert [ json.loads(line) for line in streamed.text.splitlines() ] == response.json()
+
+# Cursors that don't hold the endpoint's sort key are rejected
+@pytest.mark.asyncio
+async def test_billing_bad_cursor(line_items):
+    patient, _ = line_items
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        for url, key in [
+            ("/billing/daily/", ["x"]),
+            ("/billing/daily/", ["x", "99213"]),
+            ("/billing/daily/", ["2021-01-01", "99213", "x"]),
+            ("/billing/cpt_codes/", ["99213", "x"]),
+            (f"/patients/{patient.id}/billing/", []),
+        ]:
+            response = await ac.get(url, params={"cursor": encode_cursor(key)})
+            assert response.status_code == 400, (url, key)
+            assert response.json() == {"detail": "invalid cursor"}
+        response = await ac.get("/billing/daily/", params={"cursor": encode_cursor(["2021-01-01", "99213"])})
+        assert [ row["date"] for row in response.json() ] == ["2021-02-01"]
@@ -0,0 +1,64 @@
+from httpx import AsyncClient, ASGITransport
+import pytest
+
+from api import app
+from cpt_cache import CPTCodeCache, cpt_code_cache
+from model import Patient, Encounter, LineItem, CPTCode
+
+@pytest.fixture(scope='function', autouse=True)
+def test_setup_db():
+    Patient.delete().execute()
+    Encounter.delete().execute()
+    LineItem.delete().execute()
+    yield
+    LineItem.delete().execute()
+    CPTCode.delete().where(CPTCode.code == "00000").execute()
+    cpt_code_cache.load()
+
+# The whole table is loaded and lookups are counted as hits or misses
+def test_cache_load_and_lookup():
+    cache = CPTCodeCache()
+    cache.load()
+    cpt = CPTCode.get(CPTCode.code == "99213")
+    assert cache.get("99213") == (cpt.id, cpt.description)
+    assert cache.get("99999") is None
+    stats = cache.stats()
+    assert stats["size"] == CPTCode.select().count()
+    assert (stats["hits"], stats["misses"], stats["reloads"]) == (1, 1, 1)
+
+# Refresh only reloads when the table changed
+def test_cache_refresh():
+    cache = CPTCodeCache()
+    cache.load()
+    assert not cache.refresh()
+    CPTCode.create(code="00000", description="Test code")
+    assert cache.refresh()
+    assert cache.get("00000")[1] == "Test code"
+    assert cache.stats()["reloads"] == 2
+
+# Adding a line item skips the CPT code lookup on a hit and reads the code
+# through and caches it on a miss
+@pytest.mark.asyncio
+async def test_line_item_read_through(assert_num_queries):
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    encounter = Encounter.create(patient=patient, date="2021-01-01")
+    CPTCode.create(code="00000", description="Test code")
+    url = f"/patients/{patient.id}/encounters/{encounter.id}/line_items/"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        for _ in range(2):
+            misses = cpt_code_cache.misses
+            with assert_num_queries(4) as queries:
+                response = await ac.post(url, json={"cpt_code": "00000", "units": 1})
+            assert response.status_code == 200
+            assert response.json() == {"cpt_code": "00000", "cpt_code_description": "Test code", "units": 1}
+        # the first request missed and joined the CPT code table, the second hit
+        assert cpt_code_cache.misses == misses
+        assert "cptcode" not in queries[1].lower()
+
+# Cache statistics are exposed by the stats endpoint
+@pytest.mark.asyncio
+async def test_cache_stats_endpoint():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/stats/")
+        assert response.status_code == 200
+        assert response.json()["cpt_code_cache"]["size"] == CPTCode.select().count()
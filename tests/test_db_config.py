@@ -0,0 +1,306 @@
+import asyncio
+from fastapi import FastAPI
+from httpx import AsyncClient, ASGITransport
+import pytest
+import threading
+import time
+from playhouse.pool import MaxConnectionsExceeded
+
+from api import app
+from db_config import background_connection, create_database, pool_stats, replica_reads, replica_stats, reset_after_fork, write_transaction, PooledSqlite
+from db_executor import run_db
+from db_middleware import DatabaseConnectionMiddleware, ReplicaRoutingMiddleware
+
+@pytest.fixture
+def pooled_db(tmp_path):
+    database = create_database({
+        "DATABASE_DRIVER": "sqlite",
+        "DATABASE_NAME": str(tmp_path / "pool.db"),
+        "DATABASE_POOL": True,
+        "DATABASE_POOL_MAX_CONNECTIONS": 2,
+        "DATABASE_POOL_IDLE_TIMEOUT": 60,
+        "DATABASE_POOL_STALE_TIMEOUT": 3600,
+        "DATABASE_POOL_WAIT_TIMEOUT": 10,
+    })
+    yield database
+    database.close_all()
+
+# Pooled settings build a pooled database
+def test_create_pooled_database(pooled_db):
+    assert isinstance(pooled_db, PooledSqlite)
+    assert pool_stats(pooled_db) == {
+        "max_connections": 2,
+        "in_use": 0,
+        "idle": 0,
+        "checkouts": 0,
+        "created": 0,
+        "recycled": 0,
+        "exhausted": 0,
+    }
+
+# A closed connection goes back to the pool and is reused by the next checkout
+def test_pool_reuses_connections(pooled_db):
+    pooled_db.connect()
+    assert pool_stats(pooled_db)["in_use"] == 1
+    pooled_db.close()
+    pooled_db.connect()
+    pooled_db.close()
+    stats = pool_stats(pooled_db)
+    assert (stats["in_use"], stats["idle"], stats["checkouts"], stats["created"]) == (0, 1, 2, 1)
+
+# Connections that sat idle past the idle timeout are recycled on checkout
+def test_pool_recycles_idle_connections(pooled_db):
+    pooled_db.connect()
+    pooled_db.close()
+    for key in pooled_db._returned_at:
+        pooled_db._returned_at[key] -= 120
+    pooled_db.connect()
+    pooled_db.close()
+    stats = pool_stats(pooled_db)
+    assert (stats["recycled"], stats["created"], stats["idle"]) == (1, 2, 1)
+
+# Each context gets its own connection and a full pool is counted as exhausted
+def test_pool_exhaustion(tmp_path):
+    database = PooledSqlite(str(tmp_path / "pool.db"), max_connections=1, check_same_thread=False)
+    token = database._state.begin()
+    database.connect()
+    inner = database._state.begin()
+    with pytest.raises(MaxConnectionsExceeded):
+        database.connect()
+    database._state.end(inner)
+    database.close()
+    database._state.end(token)
+    assert pool_stats(database)["exhausted"] == 1
+    database.close_all()
+
+# A checkout that waits for a connection and gives up is counted once, however
+# often the pool retried meanwhile
+def test_pool_exhaustion_counted_once(tmp_path):
+    database = PooledSqlite(str(tmp_path / "pool.db"), max_connections=1, timeout=0.5, check_same_thread=False)
+    token = database._state.begin()
+    database.connect()
+    inner = database._state.begin()
+    with pytest.raises(MaxConnectionsExceeded):
+        database.connect()
+    database._state.end(inner)
+    database.close()
+    database._state.end(token)
+    assert pool_stats(database)["exhausted"] == 1
+    database.close_all()
+
+# The middleware gives each request its own connections, checked out for
+# each database call and returned straight after it
+@pytest.mark.asyncio
+async def test_connection_middleware(pooled_db):
+    test_app = FastAPI()
+    test_app.add_middleware(DatabaseConnectionMiddleware, database=pooled_db)
+
+    @test_app.get("/")
+    async def query():
+        in_use = await run_db(lambda: pooled_db.execute_sql("SELECT 1") and pool_stats(pooled_db)["in_use"])
+        await run_db(pooled_db.execute_sql, "SELECT 2")
+        return {"in_use": in_use, "after": pool_stats(pooled_db)["in_use"]}
+
+    async with AsyncClient(transport=ASGITransport(app=test_app), base_url="http://test") as ac:
+        for _ in range(3):
+            response = await ac.get("/")
+            assert response.status_code == 200
+            assert response.json() == {"in_use": 1, "after": 0}
+
+    stats = pool_stats(pooled_db)
+    assert (stats["in_use"], stats["checkouts"], stats["created"]) == (0, 6, 1)
+
+# More requests than pooled connections, each awaiting between queries, all
+# get through instead of waiting out the pool timeout on the executor threads
+@pytest.mark.asyncio
+async def test_connection_middleware_under_load(pooled_db):
+    pooled_db._wait_timeout = 1
+    test_app = FastAPI()
+    test_app.add_middleware(DatabaseConnectionMiddleware, database=pooled_db)
+
+    @test_app.get("/")
+    async def query():
+        await run_db(pooled_db.execute_sql, "SELECT 1")
+        await asyncio.sleep(0.05)
+        await run_db(pooled_db.execute_sql, "SELECT 2")
+        return {}
+
+    async with AsyncClient(transport=ASGITransport(app=test_app), base_url="http://test") as ac:
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[ ac.get("/") for _ in range(8) ])
+    assert [ response.status_code for response in responses ] == [200] * 8
+    assert time.perf_counter() - start < 1
+    assert pool_stats(pooled_db)["exhausted"] == 0
+
+# An exhausted pool is a 503 with Retry-After, not a 500
+@pytest.mark.asyncio
+async def test_connection_middleware_pool_exhausted(pooled_db):
+    test_app = FastAPI()
+    test_app.add_middleware(DatabaseConnectionMiddleware, database=pooled_db)
+
+    @test_app.get("/")
+    async def query():
+        raise MaxConnectionsExceeded("Exceeded maximum connections.")
+
+    async with AsyncClient(transport=ASGITransport(app=test_app), base_url="http://test") as ac:
+        response = await ac.get("/")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+
+# The stats endpoint reports no pool for the unpooled test database
+@pytest.mark.asyncio
+async def test_stats_unpooled():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/stats/")
+        assert response.status_code == 200
+        assert response.json()["database_pool"] is None
+
+# Concurrent transactions that read before writing, like the POST handlers'
+# check and insert, wait for each other instead of failing with "database is
+# locked"
+def test_concurrent_write_transactions(tmp_path):
+    database = create_database({ "DATABASE_DRIVER": "sqlite", "DATABASE_NAME": str(tmp_path / "writes.db") })
+    database.execute_sql("CREATE TABLE item (n INTEGER)")
+    barrier, errors = threading.Barrier(8), []
+    def write():
+        barrier.wait()
+        try:
+            with write_transaction(database):
+                count, = database.execute_sql("SELECT count(*) FROM item").fetchone()
+                time.sleep(0.005)
+                database.execute_sql("INSERT INTO item (n) VALUES (?)", (count,))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            database.close()
+    threads = [ threading.Thread(target=write) for _ in range(8) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert database.execute_sql("SELECT n FROM item ORDER BY n").fetchall() == [ (n,) for n in range(8) ]
+    database.close()
+
+# Background work running at once on two threads gets a connection each, and
+# one finishing doesn't close the other's
+def test_background_connections(pooled_db):
+    entered, finished, errors = threading.Barrier(2), threading.Barrier(2), []
+    in_use = []
+    def work(first):
+        try:
+            with background_connection(pooled_db):
+                pooled_db.execute_sql("SELECT 1")
+                entered.wait()
+                in_use.append(pool_stats(pooled_db)["in_use"])
+                entered.wait()
+                if first:
+                    return
+                finished.wait()
+                pooled_db.execute_sql("SELECT 1")
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if first:
+                finished.wait()
+    threads = [ threading.Thread(target=work, args=(first,)) for first in (True, False) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert in_use == [2, 2]
+    assert pool_stats(pooled_db)["in_use"] == 0
+
+# A forked child forgets the parent's connections and opens its own
+def test_reset_after_fork(pooled_db):
+    pooled_db.connect()
+    parent_connection = pooled_db.connection()
+    reset_after_fork(pooled_db)
+    assert pooled_db.is_closed()
+    assert pool_stats(pooled_db)["in_use"] == 0
+    pooled_db.connect()
+    assert pooled_db.connection() is not parent_connection
+    pooled_db.close()
+
+# A primary and two replica stand-ins, SQLite files each holding their own name
+@pytest.fixture
+def replicated_db(tmp_path):
+    names = ["primary", "replica1", "replica2"]
+    database = create_database({
+        "DATABASE_DRIVER": "sqlite",
+        "DATABASE_NAME": str(tmp_path / "primary.db"),
+        "DATABASE_REPLICA_HOSTS": f"{tmp_path / 'replica1.db'}, {tmp_path / 'replica2.db'}",
+        "DATABASE_REPLICA_MAX_LAG": 5,
+        "DATABASE_REPLICA_RETRY_SECONDS": 30,
+    })
+    for name, target in zip(names, [database, *database.replicas.databases]):
+        target.execute_sql("CREATE TABLE source (name TEXT)")
+        target.execute_sql("INSERT INTO source VALUES (?)", (name,))
+    yield database
+    for target in [database, *database.replicas.databases]:
+        target.close()
+
+def read_source(database) -> str:
+    return database.execute_sql("SELECT name FROM source").fetchone()[0]
+
+# Reads go to the replicas in turn only while replica reads are on
+def test_replica_reads(replicated_db):
+    assert read_source(replicated_db) == "primary"
+    with replica_reads():
+        assert { read_source(replicated_db) for _ in range(4) } == {"replica1", "replica2"}
+        with replicated_db.atomic():
+            assert read_source(replicated_db) == "primary"
+    assert replica_stats(replicated_db)["replica_reads"] == 4
+
+# Once a context has written to the primary it reads from the primary
+def test_read_your_writes(replicated_db):
+    with replica_reads():
+        assert read_source(replicated_db) != "primary"
+        replicated_db.execute_sql("UPDATE source SET name = ?", ("written",))
+        assert read_source(replicated_db) == "written"
+    with replica_reads():
+        assert read_source(replicated_db) != "written"
+
+# A failing replica is skipped, and the primary is read when none is left
+def test_replica_failure(replicated_db, tmp_path):
+    first, second = replicated_db.replicas.databases
+    first.database = str(tmp_path)
+    first.close()
+    with replica_reads():
+        assert [ read_source(replicated_db) for _ in range(3) ] == ["replica2"] * 3
+        second.database = str(tmp_path)
+        second.close()
+        assert read_source(replicated_db) == "primary"
+    stats = replica_stats(replicated_db)
+    assert (stats["available"], stats["failures"], stats["primary_reads"]) == (0, 2, 1)
+
+# Replicas lagging more than the maximum aren't read until they catch up
+def test_replica_lag(replicated_db, monkeypatch):
+    replicas = replicated_db.replicas
+    first, second = replicas.databases
+    monkeypatch.setattr(replicas, "measure_lag", lambda database: 60.0 if database is first else 0.0)
+    replicas.check()
+    with replica_reads():
+        assert [ read_source(replicated_db) for _ in range(3) ] == ["replica2"] * 3
+    monkeypatch.setattr(replicas, "measure_lag", lambda database: 0.0)
+    replicas.check()
+    assert replica_stats(replicated_db)["available"] == 2
+
+# GET requests read from the replicas and other methods from the primary
+@pytest.mark.asyncio
+async def test_replica_routing_middleware(replicated_db):
+    test_app = FastAPI()
+    test_app.add_middleware(ReplicaRoutingMiddleware)
+
+    @test_app.get("/")
+    async def get():
+        return await run_db(read_source, replicated_db)
+
+    @test_app.post("/")
+    async def post():
+        return await run_db(read_source, replicated_db)
+
+    async with AsyncClient(transport=ASGITransport(app=test_app), base_url="http://test") as ac:
+        assert (await ac.get("/")).json() in ("replica1", "replica2")
+        assert (await ac.post("/")).json() == "primary"
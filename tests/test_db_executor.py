@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import time
+
+from httpx import AsyncClient, ASGITransport
+import pytest
+
+from api import app
+import db_executor
+from db_executor import run_db
+from model import Patient
+from response_cache import response_cache
+
+SLOW_QUERY_SECONDS = 0.2
+
+@pytest.fixture(scope='function', autouse=True)
+def test_setup_db():
+    Patient.delete().execute()
+
+def p99(samples):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+# Make every patient lookup take SLOW_QUERY_SECONDS, like a slow Postgres query
+@pytest.fixture
+def slow_patient_lookup(monkeypatch):
+    get_or_none = Patient.get_or_none
+    def slow_get_or_none(cls, *query):
+        time.sleep(SLOW_QUERY_SECONDS)
+        return get_or_none(*query)
+    monkeypatch.setattr(Patient, "get_or_none", classmethod(slow_get_or_none))
+
+# Fire slow patient lookups and fast health checks at the same time and
+# return the health check latencies, measured from when the load was issued
+async def run_mixed_load(patient_id, slow_requests=5, fast_requests=50):
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        start = time.perf_counter()
+        async def timed(path):
+            response = await ac.get(path)
+            assert response.status_code == 200
+            return time.perf_counter() - start
+
+        slow = [ timed(f"/patients/{patient_id}") for _ in range(slow_requests) ]
+        fast = [ timed("/health/") for _ in range(fast_requests) ]
+        results = await asyncio.gather(*slow, *fast)
+        return results[slow_requests:]
+
+# Database calls run on an executor thread, not the event loop thread
+@pytest.mark.asyncio
+async def test_run_db_uses_executor_thread():
+    thread = await run_db(threading.current_thread)
+    assert thread is not threading.current_thread()
+    assert thread.name.startswith("db")
+
+# Exceptions raised by the database call reach the caller
+@pytest.mark.asyncio
+async def test_run_db_propagates_exceptions():
+    def fail():
+        raise ValueError("boom")
+    with pytest.raises(ValueError):
+        await run_db(fail)
+
+# Inline mode keeps queries on the event loop thread
+@pytest.mark.asyncio
+async def test_run_db_inline(monkeypatch):
+    monkeypatch.setattr(db_executor, "executor_mode", "inline")
+    assert await run_db(threading.current_thread) is threading.current_thread()
+
+# Benchmark: slow queries must not hold up requests that don't need the database.
+# Prints p99 health check latency with the executor and with inline queries.
+@pytest.mark.asyncio
+async def test_mixed_load_p99_latency(monkeypatch, slow_patient_lookup):
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+
+    threaded = p99(await run_mixed_load(patient.id))
+    monkeypatch.setattr(db_executor, "executor_mode", "inline")
+    response_cache.clear()
+    inline = p99(await run_mixed_load(patient.id))
+
+    print(f"health p99 under mixed load: thread={threaded * 1000:.1f}ms inline={inline * 1000:.1f}ms")
+    assert threaded < SLOW_QUERY_SECONDS
+    assert inline >= SLOW_QUERY_SECONDS
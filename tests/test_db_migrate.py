@@ -0,0 +1,175 @@
+import datetime
+import pytest
+import uuid
+
+from cpt_cache import cpt_code_cache
+from db_config import db, db_driver
+from db_migrate import main, preload_cpt_codes, file_checksum, run_migrations, applied_migrations, latest_schema_version, pending_migrations, startup_migration_mode, wait_for_schema, store_uuids_as_binary, MIGRATIONS
+from model import CPTCode, DataImport, Encounter, LineItem, Patient, SchemaMigration, CPT_CODES_IMPORT, get_encounters_for_patient, get_line_items_for_encounter, get_daily_cpt_code_totals, search_patients
+
+@pytest.fixture
+def cpt_csv(tmp_path):
+    path = tmp_path / "cpt_codes.csv"
+    path.write_text('T0001,"First test code"\nT0002,"Second test code"\nT0003,"Third, with a comma"\n')
+    yield path
+    # put the real CPT codes back
+    CPTCode.delete().where(CPTCode.code.startswith("T")).execute()
+    preload_cpt_codes(force=True)
+    cpt_code_cache.load()
+
+# A migration that hasn't been applied, for testing verification
+@pytest.fixture
+def unapplied_migration(monkeypatch):
+    monkeypatch.setattr("db_migrate.MIGRATIONS", MIGRATIONS + [(latest_schema_version() + 1, "test", lambda: None)])
+
+# The CSV is loaded and its checksum recorded
+def test_preload_cpt_codes(cpt_csv):
+    assert preload_cpt_codes(str(cpt_csv)) == 3
+    assert CPTCode.get(CPTCode.code == "T0003").description == "Third, with a comma"
+    last_import = DataImport.get(DataImport.name == CPT_CODES_IMPORT)
+    assert (last_import.checksum, last_import.rows) == (file_checksum(cpt_csv), 3)
+
+# An unchanged file is skipped with a single query
+def test_preload_cpt_codes_unchanged(cpt_csv, assert_num_queries):
+    preload_cpt_codes(str(cpt_csv))
+    with assert_num_queries(1):
+        assert preload_cpt_codes(str(cpt_csv)) is None
+    assert preload_cpt_codes(str(cpt_csv), force=True) == 3
+
+# Changed descriptions are updated in place, keeping the code IDs
+def test_preload_cpt_codes_upsert(cpt_csv):
+    preload_cpt_codes(str(cpt_csv))
+    id = CPTCode.get(CPTCode.code == "T0001").id
+    cpt_csv.write_text('T0001,"Updated test code"\n')
+    assert preload_cpt_codes(str(cpt_csv)) == 1
+    cpt = CPTCode.get(CPTCode.code == "T0001")
+    assert (cpt.id, cpt.description) == (id, "Updated test code")
+    assert CPTCode.select().where(CPTCode.code.startswith("T")).count() == 3
+
+# The load can be run from the command line
+def test_load_cpt_codes_cli(cpt_csv):
+    main(["load-cpt-codes", "--csv", str(cpt_csv)])
+    assert CPTCode.select().where(CPTCode.code.startswith("T")).count() == 3
+
+# Migrations are all recorded and running them again does nothing
+def test_run_migrations_idempotent():
+    assert applied_migrations() == { version for version, _, _ in MIGRATIONS }
+    assert run_migrations() == []
+    assert SchemaMigration.select().count() == latest_schema_version()
+
+# The SQL and parameters of the statements run by func
+def captured_queries(func):
+    queries = []
+    execute_sql = db.execute_sql
+    def capturing_execute_sql(sql, params=None, *args, **kwargs):
+        queries.append((sql, params))
+        return execute_sql(sql, params, *args, **kwargs)
+    db.execute_sql = capturing_execute_sql
+    try:
+        func()
+    finally:
+        del db.execute_sql
+    return queries
+
+# The query plan of the only statement run by func
+def query_plan(func) -> str:
+    [(sql, params)] = captured_queries(func)
+    if db_driver == "postgresql":
+        with db.atomic() as transaction:
+            db.execute_sql("SET LOCAL enable_seqscan = off")
+            plan = db.execute_sql("EXPLAIN " + sql, params).fetchall()
+            transaction.rollback()
+        return "\n".join(row[0] for row in plan)
+    return "\n".join(row[-1] for row in db.execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall())
+
+# The list endpoints' queries use the composite indexes for both the filter
+# and the keyset ordering, without a separate sort step
+@pytest.mark.parametrize("query, index", [
+    (lambda: get_encounters_for_patient(uuid.uuid4(), ["2021-01-01", str(uuid.uuid4())], 101), "encounter_patient_id_date_id"),
+    (lambda: get_line_items_for_encounter(uuid.uuid4(), ["1"], 101), "lineitem_encounter_id_id"),
+])
+def test_list_query_plans(query, index):
+    plan = query_plan(query)
+    assert index in plan
+    assert "TEMP B-TREE" not in plan
+    assert "Sort" not in plan
+
+# Billing totals over a date range only read encounters in the range
+def test_billing_date_range_query_plan():
+    plan = query_plan(lambda: get_daily_cpt_code_totals("2021-01-01", "2021-01-31", limit=101))
+    assert "encounter_date_id" in plan
+
+# Patient search reads the name index rather than every patient
+def test_patient_search_query_plan():
+    plan = query_plan(lambda: search_patients(["doe"], limit=21))
+    assert ("patient_search" if db_driver == "sqlite" else "patient_last_name_") in plan
+
+# The search index follows renames and deletes, and still finds patients
+# after VACUUM renumbers rowids
+@pytest.mark.skipif(db_driver != "sqlite", reason="Postgres searches the patient table's own indexes")
+def test_patient_search_index_sync():
+    patient = Patient.create(first_name="Quinn", last_name="Zeller")
+    other = Patient.create(first_name="Quinn", last_name="Zeller")
+    try:
+        found = lambda *terms: { row[0] for row in search_patients(list(terms), limit=10) }
+        assert found("quinn", "zel") == {patient.id, other.id}
+        Patient.update(last_name="Yates").where(Patient.id == patient.id).execute()
+        assert found("zel") == {other.id}
+        assert found("yat") == {patient.id}
+        Patient.delete().where(Patient.id == other.id).execute()
+        assert found("quinn") == {patient.id}
+        assert db.execute_sql('SELECT count(*) FROM "patient_search"').fetchone()[0] == Patient.select().count()
+        # names without any word in them are removed by ID all the same
+        nameless = [ Patient.create(first_name="", last_name="!!") for _ in range(4) ]
+        Patient.delete().where(Patient.id.in_([ p.id for p in nameless ])).execute()
+        for table in ("patient_search", "patient_search_key"):
+            assert db.execute_sql(f'SELECT count(*) FROM "{table}"').fetchone()[0] == Patient.select().count()
+        db.execute_sql("VACUUM")
+        assert found("yat") == {patient.id}
+    finally:
+        Patient.delete().where(Patient.id.in_([patient.id, other.id])).execute()
+
+# UUIDs stored as text by older versions are rewritten as blobs and still
+# join and look up the same
+@pytest.mark.skipif(db_driver != "sqlite", reason="Postgres stores native UUIDs")
+def test_store_uuids_as_binary():
+    patient_id, encounter_id = uuid.uuid4(), uuid.uuid4()
+    db.execute_sql('INSERT INTO "patient" ("id", "first_name", "last_name", "version") VALUES (?, ?, ?, 0)',
+        (patient_id.hex, "Pat", "Doe"))
+    db.execute_sql('INSERT INTO "encounter" ("id", "patient_id", "date") VALUES (?, ?, ?)',
+        (str(encounter_id), patient_id.hex, "2021-01-01"))
+    cpt_code_id = CPTCode.get(CPTCode.code == "99213").id
+    db.execute_sql('INSERT INTO "lineitem" ("encounter_id", "cpt_code_id", "units") VALUES (?, ?, ?)',
+        (encounter_id.hex, cpt_code_id, 2))
+    try:
+        with db.atomic():
+            store_uuids_as_binary()
+        assert db.execute_sql('SELECT typeof("id"), length("id") FROM "patient" WHERE "id" = ?', (patient_id.bytes,)).fetchall() == [("blob", 16)]
+        assert get_encounters_for_patient(str(patient_id)) == [(encounter_id, datetime.date(2021, 1, 1))]
+        assert [ row[1:] for row in get_line_items_for_encounter(encounter_id) ] == [("99213", CPTCode.get_by_id(cpt_code_id).description, 2)]
+    finally:
+        LineItem.delete().where(LineItem.encounter == encounter_id).execute()
+        Encounter.delete().where(Encounter.id == encounter_id).execute()
+        Patient.delete().where(Patient.id == patient_id).execute()
+
+# Startup modes, including the old boolean settings
+def test_startup_migration_mode():
+    assert [ startup_migration_mode(value) for value in ("run", "VERIFY", "skip", True, False) ] == [
+        "run", "verify", "skip", "run", "skip",
+    ]
+    with pytest.raises(ValueError):
+        startup_migration_mode("sometimes")
+
+# Verification passes on an up to date schema and fails once the timeout
+# passes with migrations pending
+def test_wait_for_schema(unapplied_migration):
+    assert pending_migrations() == [latest_schema_version()]
+    with pytest.raises(RuntimeError):
+        wait_for_schema(timeout=0.05, interval=0.01)
+    with pytest.raises(SystemExit):
+        main(["verify"])
+
+def test_wait_for_schema_up_to_date():
+    assert pending_migrations() == []
+    wait_for_schema(timeout=0)
+    main(["verify"])
@@ -3,6 +3,7 @@ import pytest
 
 from api import app
 from model import Patient, Encounter
+from routers.pagination import encode_cursor
 
 @pytest.fixture(scope='function', autouse=True)
 def test_setup_db():
@@ -57,3 +58,70 @@ async def test_get_patient_encounters_invalid_patient_id():
         response = await ac.get("/patients/123/encounters/")
         assert response.status_code == 404
         assert response.json() == {"detail": "patient not found"}
+
+# Each encounter endpoint makes a single round trip, plus the patient version
+# bump on writes and the version lookup on uncached reads. Cached reads don't
+# touch the database.
+@pytest.mark.asyncio
+async def test_encounter_round_trips(assert_num_queries):
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        with assert_num_queries(3):
+            response = await ac.post(f"/patients/{patient.id}/encounters/", json={"date": "2021-01-01"})
+            assert response.status_code == 200
+        encounter = response.json()
+        assert encounter["date"] == "2021-01-01"
+        with assert_num_queries(2):
+            response = await ac.get(f"/patients/{patient.id}/encounters/")
+            assert response.json() == [encounter]
+        with assert_num_queries(2):
+            response = await ac.get(f"/patients/{patient.id}/encounters/{encounter['id']}")
+            assert response.json() == encounter
+        with assert_num_queries(1):
+            response = await ac.get(f"/patients/{patient.id}/encounters/{encounter['id']}")
+            assert response.json() == encounter
+
+# Test get patient encounter that doesn't belong to the patient
+@pytest.mark.asyncio
+async def test_get_patient_encounter_other_patient():
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    other = Patient.create(first_name="Skylar", last_name="Smith")
+    encounter = Encounter.create(patient=other, date="2021-01-01")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get(f"/patients/{patient.id}/encounters/{encounter.id}")
+        assert response.status_code == 404
+        assert response.json() == {"detail": "encounter not found"}
+        response = await ac.get(f"/patients/123/encounters/{encounter.id}")
+        assert response.status_code == 404
+        assert response.json() == {"detail": "patient not found"}
+
+# Encounters are listed by date and paged with the next cursor
+@pytest.mark.asyncio
+async def test_get_patient_encounters_pages():
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    dates = ["2021-03-01", "2021-01-01", "2021-02-01", "2021-01-01"]
+    for date in dates:
+        Encounter.create(patient=patient, date=date)
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get(f"/patients/{patient.id}/encounters/", params={"limit": 3})
+        first = response.json()
+        cursor = response.headers["X-Next-Cursor"]
+        response = await ac.get(f"/patients/{patient.id}/encounters/", params={"limit": 3, "cursor": cursor})
+        second = response.json()
+        assert "X-Next-Cursor" not in response.headers
+        assert [ encounter["date"] for encounter in first + second ] == sorted(dates)
+        assert len({ encounter["id"] for encounter in first + second }) == len(dates)
+
+# Cursors that don't hold an encounter date and ID are rejected
+@pytest.mark.asyncio
+async def test_get_patient_encounters_bad_cursor():
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    encounter = Encounter.create(patient=patient, date="2021-01-01")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        for key in (["x"], ["2021-01-01", "x"], ["x", str(encounter.id)], ["2021-01-01", str(encounter.id), "x"]):
+            response = await ac.get(f"/patients/{patient.id}/encounters/", params={"cursor": encode_cursor(key)})
+            assert response.status_code == 400
+            assert response.json() == {"detail": "invalid cursor"}
+        response = await ac.get(f"/patients/{patient.id}/encounters/",
+            params={"cursor": encode_cursor(["2020-12-31", str(encounter.id)])})
+        assert [ row["id"] for row in response.json() ] == [str(encounter.id)]
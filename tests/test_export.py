@@ -0,0 +1,95 @@
+import csv
+import gzip
+import io
+from httpx import AsyncClient, ASGITransport
+import pytest
+
+from api import app
+import export
+from model import Patient, Encounter, LineItem, CPTCode
+
+@pytest.fixture(scope='function', autouse=True)
+def test_setup_db():
+    Patient.delete().execute()
+    Encounter.delete().execute()
+    LineItem.delete().execute()
+
+# Two patients with a line item on each of three dates
+@pytest.fixture
+def line_items():
+    code = CPTCode.get(CPTCode.code == "99213")
+    patients = [ Patient.create(first_name="Pat", last_name="Doe"), Patient.create(first_name="Sam", last_name="Doe") ]
+    for patient in patients:
+        for day in (1, 2, 3):
+            encounter = Encounter.create(patient=patient, date=f"2021-01-0{day}")
+            LineItem.create(encounter=encounter, cpt_code=code, units=day)
+    return patients
+
+def read_csv(data: bytes) -> list:
+    return list(csv.DictReader(io.StringIO(gzip.decompress(data).decode())))
+
+# Without pyarrow the export is gzip compressed CSV
+@pytest.mark.asyncio
+async def test_export_csv(line_items, monkeypatch):
+    monkeypatch.setattr(export, "pyarrow", None)
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/export/line_items")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/gzip"
+        assert 'filename="line_items.csv.gz"' in response.headers["content-disposition"]
+    rows = read_csv(response.content)
+    assert len(rows) == 6
+    assert list(rows[0]) == list(export.COLUMNS)
+    assert rows[0]["cpt_code"] == "99213"
+    assert { row["patient_id"] for row in rows } == { str(patient.id) for patient in line_items }
+
+# Date and patient filters
+@pytest.mark.asyncio
+async def test_export_filters(line_items, monkeypatch):
+    monkeypatch.setattr(export, "pyarrow", None)
+    patient = line_items[0]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/export/line_items",
+            params={"format": "csv", "start": "2021-01-02", "end": "2021-01-03", "patient_id": str(patient.id)})
+    rows = read_csv(response.content)
+    assert [ (row["patient_id"], row["date"], row["units"]) for row in rows ] == [
+        (str(patient.id), "2021-01-02", "2"),
+        (str(patient.id), "2021-01-03", "3"),
+    ]
+
+# Formats that need pyarrow are refused without it
+@pytest.mark.asyncio
+async def test_export_unavailable_format(monkeypatch):
+    monkeypatch.setattr(export, "pyarrow", None)
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/export/line_items", params={"format": "parquet"})
+        assert response.status_code == 400
+        assert response.json() == { "detail": "export format not available" }
+        response = await ac.get("/export/line_items", params={"format": "xml"})
+        assert response.json() == { "detail": "invalid export format" }
+
+# Rows are read in keyset batches of the batch size, one query each
+def test_line_item_batches(line_items, assert_num_queries):
+    with assert_num_queries(4):
+        batches = list(export.line_item_batches(batch_size=2))
+    assert [ len(batch) for batch in batches ] == [2, 2, 2]
+    ids = [ row[0] for batch in batches for row in batch ]
+    assert ids == sorted(ids)
+
+# The command line export writes a file
+def test_export_cli(line_items, monkeypatch, tmp_path):
+    monkeypatch.setattr(export, "pyarrow", None)
+    path = tmp_path / "line_items.csv.gz"
+    export.main(["line-items", "--output", str(path), "--end", "2021-01-01", "--batch-size", "1"])
+    rows = read_csv(path.read_bytes())
+    assert [ row["date"] for row in rows ] == ["2021-01-01", "2021-01-01"]
+
+# With pyarrow, Parquet files have one row group per batch
+def test_export_parquet(line_items, tmp_path):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    path = tmp_path / "line_items.parquet"
+    export.main(["line-items", "--output", str(path), "--format", "parquet", "--batch-size", "4"])
+    table = parquet.ParquetFile(path)
+    assert table.metadata.num_row_groups == 2
+    assert table.read().column_names == list(export.COLUMNS)
+    assert table.metadata.num_rows == 6
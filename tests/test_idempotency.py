@@ -0,0 +1,77 @@
+from httpx import AsyncClient, ASGITransport
+import pytest
+import time
+
+from api import app
+from model import Patient, Encounter, LineItem, IdempotencyKey
+import model
+
+@pytest.fixture(scope='function', autouse=True)
+def test_setup_db():
+    Patient.delete().execute()
+    Encounter.delete().execute()
+    LineItem.delete().execute()
+    IdempotencyKey.delete().execute()
+
+# A retry with the same key replays the stored response without writing again
+@pytest.mark.asyncio
+async def test_replay(assert_num_queries):
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    url = f"/patients/{patient.id}/encounters/"
+    headers = {"Idempotency-Key": "encounter-1"}
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        first = await ac.post(url, json={"date": "2021-01-01"}, headers=headers)
+        assert first.status_code == 200
+        assert "idempotent-replayed" not in first.headers
+        with assert_num_queries(2):
+            retry = await ac.post(url, json={"date": "2021-01-01"}, headers=headers)
+        assert retry.status_code == 200
+        assert retry.headers["idempotent-replayed"] == "true"
+        assert retry.json() == first.json()
+        # keys are scoped to the path
+        other = await ac.post("/patients/", json={"first_name": "Sam", "last_name": "Roe"}, headers=headers)
+        assert other.status_code == 200
+    assert Encounter.select().count() == 1
+    assert Patient.get_by_id(patient.id).version == 1
+
+# Reusing a key with a different body is rejected, and an invalid key too
+@pytest.mark.asyncio
+async def test_key_reused():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        headers = {"Idempotency-Key": "patient-1"}
+        response = await ac.post("/patients/", json={"first_name": "Pat", "last_name": "Doe"}, headers=headers)
+        assert response.status_code == 200
+        response = await ac.post("/patients/", json={"first_name": "Sam", "last_name": "Roe"}, headers=headers)
+        assert response.status_code == 422
+        response = await ac.post("/patients/", json={"first_name": "Sam", "last_name": "Roe"}, headers={"Idempotency-Key": "x" * 256})
+        assert response.status_code == 400
+    assert Patient.select().count() == 1
+
+# Failed requests leave nothing behind, so the key can be retried
+@pytest.mark.asyncio
+async def test_failure_not_stored():
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    encounter = Encounter.create(patient=patient, date="2021-01-01")
+    url = f"/patients/{patient.id}/encounters/{encounter.id}/line_items/"
+    headers = {"Idempotency-Key": "line-item-1"}
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.post(url, json={"cpt_code": "99999", "units": 1}, headers=headers)
+        assert response.status_code == 404
+        assert IdempotencyKey.select().count() == 0
+        response = await ac.post(url, json={"cpt_code": "99213", "units": 1}, headers=headers)
+        assert response.status_code == 200
+    assert LineItem.select().count() == 1
+
+# Expired keys are no longer replayed, can be taken again and are deleted
+def test_expired_keys(monkeypatch):
+    assert model.store_idempotency_key(b"k" * 16, b"f" * 16, 200, b"{}", 60)
+    assert not model.store_idempotency_key(b"k" * 16, b"g" * 16, 200, b"[]", 60)
+    assert model.find_idempotency_key(b"k" * 16) == (b"f" * 16, 200, b"{}")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert model.find_idempotency_key(b"k" * 16) is None
+    assert model.store_idempotency_key(b"k" * 16, b"g" * 16, 200, b"[]", 60)
+    assert model.find_idempotency_key(b"k" * 16) == (b"g" * 16, 200, b"[]")
+    monkeypatch.setattr(time, "time", lambda: now + 122)
+    assert model.delete_expired_idempotency_keys() == 1
+    assert IdempotencyKey.select().count() == 0
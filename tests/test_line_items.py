@@ -1,8 +1,12 @@
 from httpx import AsyncClient, ASGITransport
+import json
+from peewee import chunked
 import pytest
+import time
 
 from api import app
 from model import Patient, Encounter, LineItem, CPTCode
+from routers import pagination
 
 @pytest.fixture(scope='function', autouse=True)
 def test_setup_db():
@@ -44,48 +48,114 @@ async def test_get_patient_encounter_line_items_multiple():
         for data in line_item_data:
             assert data in response.json()
 
+# Listing looks up the patient version for the ETag, checks the patient and
+# encounter in one query and lists. Adding a line item checks the patient,
+# encounter and CPT code in one query, inserts and bumps the patient version.
+@pytest.mark.asyncio
+async def test_line_item_round_trips(assert_num_queries):
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    encounter = Encounter.create(patient=patient, date="2021-01-01")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        with assert_num_queries(3):
+            response = await ac.get(f"/patients/{patient.id}/encounters/{encounter.id}/line_items/")
+            assert response.status_code == 200
+            assert response.json() == []
+        with assert_num_queries(4):
+            response = await ac.post(f"/patients/{patient.id}/encounters/{encounter.id}/line_items/", json={"cpt_code": "99213", "units": 1})
+            assert response.status_code == 200
+
+# Benchmark: listing line items takes one query per batch of rows, never one
+# per line item. Streams the full list and prints the request time per size.
+@pytest.mark.asyncio
+@pytest.mark.parametrize("num_line_items", [10, 1_000, 10_000])
+async def test_get_line_items_benchmark(assert_num_queries, num_line_items):
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    encounter = Encounter.create(patient=patient, date="2021-01-01")
+    cpt_codes = [ cpt.id for cpt in CPTCode.select(CPTCode.id) ]
+    rows = [ (encounter.id, cpt_codes[i % len(cpt_codes)], i) for i in range(num_line_items) ]
+    for batch in chunked(rows, 500):
+        LineItem.insert_many(batch, fields=[LineItem.encounter, LineItem.cpt_code, LineItem.units]).execute()
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        # the existence check, then full batches plus the final partial batch
+        with assert_num_queries(2 + num_line_items // pagination.stream_batch_size):
+            start = time.perf_counter()
+            response = await ac.get(f"/patients/{patient.id}/encounters/{encounter.id}/line_items/",
+                headers={"Accept": "application/x-ndjson"})
+            elapsed = time.perf_counter() - start
+        assert response.status_code == 200
+        line_items = [ json.loads(line) for line in response.text.splitlines() ]
+        assert [ item["units"] for item in line_items ] == list(range(num_line_items))
+    print(f"GET {num_line_items} line items: {elapsed * 1000:.1f}ms")
+
 # Test adding line item to encounter for non-existent patient
 @pytest.mark.asyncio
-async def test_add_line_item_nonexistent_patient():
+async def test_add_line_item_nonexistent_patient(assert_num_queries):
     async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
-        response = await ac.post("/patients/123/encounters/123/line_items/", json={"cpt_code": "99213", "units": 0})
+        # malformed IDs are rejected without a query
+        with assert_num_queries(0):
+            response = await ac.post("/patients/123/encounters/123/line_items/", json={"cpt_code": "99213", "units": 0})
         assert response.status_code == 404
         assert response.json() == {"detail": "patient not found"}
 
 
 # Test adding line item to encounter for non-existent encounter
 @pytest.mark.asyncio
-async def test_add_line_item_nonexistent_encounter():
+async def test_add_line_item_nonexistent_encounter(assert_num_queries):
     patient = Patient.create(first_name="Pat", last_name="Doe")
     async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
-        response = await ac.post(f"/patients/{patient.id}/encounters/123/line_items/", json={"cpt_code": "99213", "units": 0})
+        with assert_num_queries(0):
+            response = await ac.post(f"/patients/{patient.id}/encounters/123/line_items/", json={"cpt_code": "99213", "units": 0})
         assert response.status_code == 404
         assert response.json() == {"detail": "encounter not found"}
 
 
 # Test adding line item with invalid CPT code
 @pytest.mark.asyncio
-async def test_add_line_item_invalid_cpt_code():
+async def test_add_line_item_invalid_cpt_code(assert_num_queries):
     patient = Patient.create(first_name="Pat", last_name="Doe")
     encounter = Encounter.create(patient=patient, date="2021-01-01")
     async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
-        response = await ac.post(f"/patients/{patient.id}/encounters/{encounter.id}/line_items/", json={"cpt_code": "99999", "units": 0})
+        with assert_num_queries(2):
+            response = await ac.post(f"/patients/{patient.id}/encounters/{encounter.id}/line_items/", json={"cpt_code": "99999", "units": 0})
         assert response.status_code == 404
         assert response.json() == {"detail": "CPT code not found"}
 
 # Test getting line items for invalid patient ID
 @pytest.mark.asyncio
-async def test_get_line_items_invalid_patient_id():
+async def test_get_line_items_invalid_patient_id(assert_num_queries):
     async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
-        response = await ac.get("/patients/123/encounters/123/line_items/")
+        with assert_num_queries(0):
+            response = await ac.get("/patients/123/encounters/123/line_items/")
         assert response.status_code == 404
         assert response.json() == {"detail": "patient not found"}
 
 # Test getting line items for invalid encounter ID but valid patient ID
 @pytest.mark.asyncio
-async def test_get_line_items_invalid_encounter_id():
+async def test_get_line_items_invalid_encounter_id(assert_num_queries):
     patient = Patient.create(first_name="Pat", last_name="Doe")
     async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
-        response = await ac.get(f"/patients/{patient.id}/encounters/123/line_items/")
+        # the malformed encounter ID is rejected without a query
+        with assert_num_queries(0):
+            response = await ac.get(f"/patients/{patient.id}/encounters/123/line_items/")
         assert response.status_code == 404
         assert response.json() == {"detail": "encounter not found"}
+
+# Line items are paged in the order they were added
+@pytest.mark.asyncio
+async def test_get_line_items_pages():
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    encounter = Encounter.create(patient=patient, date="2021-01-01")
+    cpt = CPTCode.get(CPTCode.code == "99213")
+    for units in range(5):
+        LineItem.create(encounter=encounter, cpt_code=cpt, units=units)
+    url = f"/patients/{patient.id}/encounters/{encounter.id}/line_items/"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        units = []
+        params = {"limit": 2}
+        while True:
+            response = await ac.get(url, params=params)
+            units += [ item["units"] for item in response.json() ]
+            if "X-Next-Cursor" not in response.headers:
+                break
+            params["cursor"] = response.headers["X-Next-Cursor"]
+        assert units == list(range(5))
@@ -0,0 +1,77 @@
+import io
+import json
+import structlog
+import pytest
+
+import log_pipeline
+from log_pipeline import LogPipeline
+
+# Pipeline writing to a StringIO, with a structlog logger bound to it
+@pytest.fixture
+def pipeline(monkeypatch):
+    pipeline = LogPipeline(queue_size=100, batch_size=10, sample_rates={"noisy": 0.0})
+    output = io.StringIO()
+    monkeypatch.setattr(pipeline, "file", lambda: output)
+    pipeline.output = output
+    pipeline.log = structlog.wrap_logger(log_pipeline.QueueLogger(pipeline),
+        processors=[pipeline.sample, structlog.stdlib.add_log_level, log_pipeline.add_timestamp])
+    yield pipeline
+    pipeline.stop()
+
+def lines(pipeline) -> list:
+    return [ json.loads(line) for line in pipeline.output.getvalue().splitlines() ]
+
+# Records are written as JSON lines in order by the writer thread, and
+# everything queued is written when the pipeline stops
+def test_pipeline_writes_in_order(pipeline):
+    pipeline.start()
+    for index in range(25):
+        pipeline.log.info("event", index=index)
+    pipeline.stop()
+    records = lines(pipeline)
+    assert [ record["index"] for record in records ] == list(range(25))
+    assert records[0]["event"] == "event"
+    assert records[0]["level"] == "info"
+    assert records[0]["timestamp"].endswith("Z")
+    assert pipeline.stats()["written"] == 25
+    assert pipeline.batches >= 3
+
+# A full queue drops records instead of blocking, and counts them
+def test_pipeline_drops_when_full(pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, "queue", log_pipeline.queue.Queue(2))
+    for index in range(5):
+        pipeline.log.info("event", index=index)
+    assert pipeline.stats()["dropped"] == 3
+    pipeline.start()
+    pipeline.stop()
+    assert [ record["index"] for record in lines(pipeline) ] == [0, 1]
+
+# Stopping with a full queue the writer isn't taking from writes the queued
+# records instead of failing
+def test_pipeline_stop_when_full(pipeline, monkeypatch):
+    monkeypatch.setattr(pipeline, "queue", log_pipeline.queue.Queue(2))
+    for index in range(2):
+        pipeline.log.info("event", index=index)
+    stuck = log_pipeline.threading.Thread(target=lambda: None)
+    stuck.start()
+    pipeline._thread = stuck
+    pipeline.stop(timeout=0.01)
+    pipeline.log.info("event", index=2)
+    assert [ record["index"] for record in lines(pipeline) ] == [0, 1, 2]
+
+# Sampled info events are dropped, other levels and events are kept
+def test_pipeline_sampling(pipeline):
+    pipeline.start()
+    pipeline.log.info("noisy")
+    pipeline.log.error("noisy")
+    pipeline.log.info("quiet")
+    pipeline.stop()
+    assert [ (record["event"], record["level"]) for record in lines(pipeline) ] == [("noisy", "error"), ("quiet", "info")]
+    assert pipeline.sampled_out == 1
+
+# Records logged after shutdown are written straight away
+def test_pipeline_after_stop(pipeline):
+    pipeline.start()
+    pipeline.stop()
+    pipeline.log.info("late")
+    assert [ record["event"] for record in lines(pipeline) ] == ["late"]
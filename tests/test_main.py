@@ -0,0 +1,33 @@
+import pytest
+
+import main
+from config import settings
+
+# Zero workers means one per CPU
+def test_worker_count(monkeypatch):
+    monkeypatch.setitem(settings, "WORKERS", 3)
+    assert main.worker_count() == 3
+    monkeypatch.setitem(settings, "WORKERS", 0)
+    monkeypatch.setattr(main.os, "cpu_count", lambda: 4)
+    assert main.worker_count() == 4
+
+# Workers can't share an in-memory database
+def test_multiple_workers_in_memory(monkeypatch):
+    monkeypatch.setitem(settings, "WORKERS", 2)
+    monkeypatch.setattr(main.uvicorn, "run", lambda *args, **kwargs: pytest.fail("server started"))
+    with pytest.raises(SystemExit):
+        main.main()
+
+# Multiple workers get the app as an import string so each imports its own,
+# after the migrations ran once in the parent
+def test_multiple_workers(monkeypatch):
+    calls = []
+    monkeypatch.setitem(settings, "WORKERS", 2)
+    monkeypatch.setitem(settings, "DATABASE_NAME", "demo.db")
+    monkeypatch.setitem(settings, "MIGRATE_ON_STARTUP", False)
+    monkeypatch.setattr(main.uvicorn, "run", lambda *args, **kwargs: calls.append((args, kwargs)))
+    main.main()
+    (args, kwargs), = calls
+    assert args == ("api:app",)
+    assert kwargs["workers"] == 2
+    assert kwargs["timeout_graceful_shutdown"] == int(settings.SHUTDOWN_TIMEOUT)
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from httpx import AsyncClient, ASGITransport
+import pytest
+
+from api import app
+import metrics
+from model import Patient
+
+@pytest.fixture(scope='function', autouse=True)
+def test_setup_db():
+    Patient.delete().execute()
+
+# Requests are timed and their queries counted under the route template
+@pytest.mark.asyncio
+async def test_request_metrics():
+    route = "/patients/"
+    requests = metrics.request_duration.count("GET", route, "200")
+    queries = metrics.request_queries._histograms.get(("GET", route), [0.0])[-1]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get(route)
+        assert response.status_code == 200
+    assert metrics.request_duration.count("GET", route, "200") == requests + 1
+    assert metrics.request_queries._histograms[("GET", route)][-1] == queries + 1
+    assert metrics.requests_in_flight.get() == 0
+
+# Paths that match no route share one label
+@pytest.mark.asyncio
+async def test_unmatched_route_metrics():
+    requests = metrics.request_duration.count("GET", "unmatched", "404")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/no/such/path")
+        assert response.status_code == 404
+    assert metrics.request_duration.count("GET", "unmatched", "404") == requests + 1
+
+# The metrics endpoint serves the Prometheus text format
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        await ac.get("/health/")
+        response = await ac.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = response.text
+    assert "# TYPE http_request_duration_seconds histogram" in body
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/health/",status="200",le="+Inf"}' in body
+    assert 'http_request_db_queries_count{method="GET",route="/health/"}' in body
+    assert "db_query_duration_seconds_count" in body
+    assert "cpt_code_cache_size" in body
+
+# Histogram buckets are cumulative and end with +Inf
+def test_histogram_render():
+    histogram = metrics.Histogram("test_seconds", "test", ("kind",), buckets=(0.1, 1.0))
+    try:
+        histogram.observe(0.05, "a")
+        histogram.observe(0.5, "a")
+        histogram.observe(5, "a")
+        assert histogram.samples() == [
+            'test_seconds_bucket{kind="a",le="0.1"} 1',
+            'test_seconds_bucket{kind="a",le="1.0"} 2',
+            'test_seconds_bucket{kind="a",le="+Inf"} 3',
+            'test_seconds_sum{kind="a"} 5.55',
+            'test_seconds_count{kind="a"} 3',
+        ]
+    finally:
+        metrics.registry.remove(histogram)
+
+# A blocked event loop shows up as lag
+@pytest.mark.asyncio
+async def test_event_loop_lag():
+    observed = metrics.event_loop_lag.count()
+    monitor = asyncio.create_task(metrics.monitor_event_loop_lag(0.01))
+    await asyncio.sleep(0)
+    time.sleep(0.05)
+    await asyncio.sleep(0.02)
+    monitor.cancel()
+    assert metrics.event_loop_lag.count() > observed
+    assert metrics.event_loop_lag._histograms[()][-1] >= 0.03
@@ -0,0 +1,91 @@
+from httpx import AsyncClient, ASGITransport
+import pytest
+
+from api import app
+from model import Patient, Encounter, LineItem, CPTCode
+
+@pytest.fixture(scope='function', autouse=True)
+def test_setup_db():
+    Patient.delete().execute()
+    Encounter.delete().execute()
+    LineItem.delete().execute()
+
+# Patient with `encounters` encounters of two line items each
+def create_patient(encounters: int) -> Patient:
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    codes = [ CPTCode.get(CPTCode.code == code) for code in ("81001", "99213") ]
+    for day in range(1, encounters + 1):
+        encounter = Encounter.create(patient=patient, date=f"2021-01-{day:02}")
+        for units, code in enumerate(codes, 1):
+            LineItem.create(encounter=encounter, cpt_code=code, units=units)
+    return patient
+
+# The whole record comes back nested
+@pytest.mark.asyncio
+async def test_get_patient_record():
+    patient = create_patient(2)
+    encounters = list(Encounter.select().order_by(Encounter.date))
+    description = CPTCode.get(CPTCode.code == "81001").description
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get(f"/patients/{patient.id}/record")
+        assert response.status_code == 200
+        record = response.json()
+    assert record["id"] == str(patient.id)
+    assert record["first_name"] == "Pat"
+    assert [ (encounter["id"], encounter["date"]) for encounter in record["encounters"] ] == [
+        (str(encounters[0].id), "2021-01-01"),
+        (str(encounters[1].id), "2021-01-02"),
+    ]
+    assert record["encounters"][0]["line_items"][0] == {
+        "cpt_code": "81001", "cpt_code_description": description, "units": 1,
+    }
+    assert [ item["cpt_code"] for item in record["encounters"][1]["line_items"] ] == ["81001", "99213"]
+
+# The record is read with the same number of queries however many encounters
+# there are: the version lookup for the ETag and the record itself
+@pytest.mark.parametrize("encounters", [0, 1, 10])
+@pytest.mark.asyncio
+async def test_patient_record_queries(encounters, assert_num_queries):
+    patient = create_patient(encounters)
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        with assert_num_queries(2):
+            response = await ac.get(f"/patients/{patient.id}/record")
+        assert len(response.json()["encounters"]) == encounters
+
+# Field selection drops what isn't asked for
+@pytest.mark.asyncio
+async def test_patient_record_fields():
+    patient = create_patient(1)
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get(f"/patients/{patient.id}/record",
+            params={"fields": "id,encounters.date,encounters.line_items.cpt_code,encounters.line_items.units"})
+        assert response.json() == {
+            "id": str(patient.id),
+            "encounters": [ { "date": "2021-01-01", "line_items": [
+                { "cpt_code": "81001", "units": 1 },
+                { "cpt_code": "99213", "units": 2 },
+            ] } ],
+        }
+        response = await ac.get(f"/patients/{patient.id}/record", params={"fields": "last_name,encounters"})
+        assert list(response.json()) == ["last_name", "encounters"]
+        assert len(response.json()["encounters"][0]["line_items"]) == 2
+        response = await ac.get(f"/patients/{patient.id}/record", params={"fields": "first_name"})
+        assert response.json() == { "first_name": "Pat" }
+
+# Unknown fields are rejected
+@pytest.mark.asyncio
+async def test_patient_record_invalid_field():
+    patient = create_patient(0)
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        for fields in ("age", "encounters.age", "first_name.length"):
+            response = await ac.get(f"/patients/{patient.id}/record", params={"fields": fields})
+            assert response.status_code == 400
+            assert response.json() == { "detail": f"invalid field: {fields}" }
+
+# Record of a patient that doesn't exist
+@pytest.mark.asyncio
+async def test_patient_record_not_found():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/patients/5d0e7ca5-6bb5-4b62-8a77-3e0a2d3bd0f1/record")
+        assert response.status_code == 404
+        assert response.json() == { "detail": "patient not found" }
@@ -1,8 +1,16 @@
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from httpx import AsyncClient, ASGITransport
+import json
 import pytest
+import time
+import uuid
 
 from api import app
+import model
 from model import Patient
+from routers import api_output, pagination
+from routers.api_output import PatientOutput
 
 @pytest.fixture(scope='function', autouse=True)
 def test_setup_db():
@@ -76,3 +84,127 @@ async def test_get_patient_not_found():
         response = await ac.get("/patients/123")
         assert response.status_code == 404
         assert response.json() == {"detail": "patient not found"}
+
+# Page through patients with limit and the next cursor
+@pytest.mark.asyncio
+async def test_get_patients_pages():
+    patients = sorted(str(Patient.create(first_name="Pat", last_name=f"Doe {i}").id) for i in range(5))
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        seen = []
+        params = {"limit": 2}
+        while True:
+            response = await ac.get("/patients/", params=params)
+            assert response.status_code == 200
+            assert len(response.json()) <= 2
+            seen += [ patient["id"] for patient in response.json() ]
+            if "X-Next-Cursor" not in response.headers:
+                break
+            assert 'rel="next"' in response.headers["Link"]
+            params["cursor"] = response.headers["X-Next-Cursor"]
+        assert seen == patients
+
+# Reject malformed cursors and out of range limits
+@pytest.mark.asyncio
+async def test_get_patients_bad_page():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/patients/", params={"cursor": "not-a-cursor"})
+        assert response.status_code == 400
+        assert response.json() == {"detail": "invalid cursor"}
+        # well formed cursors holding the wrong sort key
+        for key in (["abc"], [], [str(uuid.uuid4()), "x"]):
+            response = await ac.get("/patients/", params={"cursor": pagination.encode_cursor(key)})
+            assert response.status_code == 400
+            assert response.json() == {"detail": "invalid cursor"}
+        response = await ac.get("/patients/", params={"limit": 0})
+        assert response.status_code == 422
+
+# Search matches name prefixes in any case, exact name matches first, and
+# pages through the rest in name order
+@pytest.mark.asyncio
+async def test_search_patients():
+    for first_name, last_name in [("Pat", "Doe"), ("Patricia", "Smith"), ("Sam", "Patel"), ("Ann", "Doe"), ("Pam", "Pattison")]:
+        Patient.create(first_name=first_name, last_name=last_name)
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        names, params = [], {"q": "PAT", "limit": 2}
+        while True:
+            response = await ac.get("/patients/search", params=params)
+            assert response.status_code == 200
+            names += [ (patient["first_name"], patient["last_name"]) for patient in response.json() ]
+            if "X-Next-Cursor" not in response.headers:
+                break
+            params["cursor"] = response.headers["X-Next-Cursor"]
+        assert names == [("Pat", "Doe"), ("Sam", "Patel"), ("Pam", "Pattison"), ("Patricia", "Smith")]
+        response = await ac.get("/patients/search", params={"q": "doe a"})
+        assert [ patient["first_name"] for patient in response.json() ] == ["Ann"]
+
+# Words match the start of a name, not later words in it, the same on every
+# database
+@pytest.mark.asyncio
+async def test_search_patients_name_start():
+    Patient.create(first_name="Mary Ann", last_name="O'Brien")
+    Patient.create(first_name="José", last_name="Anders")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        async def search(q):
+            response = await ac.get("/patients/search", params={"q": q})
+            return [ patient["first_name"] for patient in response.json() ]
+        assert await search("ann") == []
+        assert await search("brien") == []
+        assert await search("mary o") == ["Mary Ann"]
+        assert await search("an") == ["José"]
+        assert await search("josé") == ["José"]
+        assert await search("jose") == []
+
+# Searches without words are rejected, as are bad cursors
+@pytest.mark.asyncio
+async def test_search_patients_invalid():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/patients/search", params={"q": "%_*"})
+        assert response.status_code == 400
+        assert response.json() == {"detail": "invalid search"}
+        response = await ac.get("/patients/search", params={"q": "pat", "cursor": pagination.encode_cursor(["x", "", "", ""])})
+        assert response.status_code == 400
+        assert (await ac.get("/patients/search")).status_code == 422
+
+# Stream all patients as NDJSON
+@pytest.mark.asyncio
+async def test_get_patients_ndjson(monkeypatch):
+    monkeypatch.setattr(pagination, "stream_batch_size", 2)
+    patients = sorted(str(Patient.create(first_name="Pat", last_name=f"Doe {i}").id) for i in range(5))
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        response = await ac.get("/patients/", headers={"Accept": "application/x-ndjson"})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        assert [ json.loads(line)["id"] for line in response.text.splitlines() ] == patients
+
+# The stdlib fallback encodes the same JSON as orjson
+def test_dump_json_fallback(monkeypatch):
+    rows = [ (uuid.uuid4(), "Pat", "Doe"), (uuid.uuid4(), "Sam", "Roe") ]
+    fast = json.loads(api_output.dump_json(PatientOutput.from_rows(rows)))
+    monkeypatch.setattr(api_output, "orjson", None)
+    assert json.loads(api_output.dump_json(PatientOutput.from_rows(rows))) == fast
+    assert [ json.loads(line) for line in api_output.dump_ndjson(PatientOutput.from_rows(rows)).splitlines() ] == fast
+
+# Benchmark: encoding rows straight to JSON bytes against building a model per
+# row and running it through jsonable_encoder, as FastAPI does with returned
+# values. Prints the time of each for a full page of patients.
+def test_serialize_patients_benchmark():
+    Patient.insert_many([ (f"First{i}", f"Last{i}") for i in range(pagination.max_limit) ],
+        fields=[Patient.first_name, Patient.last_name]).execute()
+    rows = model.get_patients(None, pagination.max_limit)
+    patients = list(Patient.select().order_by(Patient.id))
+
+    def timed(serialize, repeat=5):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            body = serialize()
+            best = min(best, time.perf_counter() - start)
+        return best, json.loads(body)
+
+    models, expected = timed(lambda: JSONResponse(jsonable_encoder([ PatientOutput.from_patient(p) for p in patients ])).body)
+    dicts, from_dicts = timed(lambda: JSONResponse(jsonable_encoder(PatientOutput.from_rows(rows))).body)
+    fast, from_fast = timed(lambda: api_output.dump_json(PatientOutput.from_rows(rows)))
+    assert from_fast == from_dicts == expected
+    assert fast < dicts and fast < models
+    print(f"serialize {len(rows)} patients: models {models * 1000:.1f}ms, "
+          f"dicts + jsonable_encoder {dicts * 1000:.1f}ms, dump_json {fast * 1000:.1f}ms")
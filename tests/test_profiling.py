@@ -0,0 +1,56 @@
+from fastapi import FastAPI
+from httpx import AsyncClient, ASGITransport
+import pytest
+
+from api import app
+from db_config import db
+from db_executor import run_db
+from profiling import ProfilingMiddleware
+
+SLOW_SQL = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 500000) SELECT count(*) FROM c"
+
+slow_app = FastAPI()
+
+@slow_app.get("/slow/")
+async def slow():
+    count, = (await run_db(db.execute_sql, SLOW_SQL)).fetchone()
+    return { "count": count }
+
+# Profiling is off by default and adds no middleware
+def test_profiling_disabled():
+    assert not any(middleware.cls is ProfilingMiddleware for middleware in app.user_middleware)
+
+# Requests without the header are passed through untouched
+@pytest.mark.asyncio
+async def test_unprofiled_request(tmp_path):
+    profiled = ProfilingMiddleware(slow_app, directory=str(tmp_path))
+    async with AsyncClient(transport=ASGITransport(app=profiled), base_url="http://test") as ac:
+        response = await ac.get("/slow/")
+        assert response.status_code == 200
+        assert "x-profile-file" not in response.headers
+    assert list(tmp_path.iterdir()) == []
+
+# A stored profile is written to the profile directory and named in a header
+@pytest.mark.asyncio
+async def test_stored_profile(tmp_path):
+    profiled = ProfilingMiddleware(slow_app, directory=str(tmp_path))
+    async with AsyncClient(transport=ASGITransport(app=profiled), base_url="http://test") as ac:
+        response = await ac.get("/slow/", headers={"X-Profile": "store"})
+        assert response.status_code == 200
+        assert response.json() == { "count": 500000 }
+    profile = (tmp_path / response.headers["x-profile-file"]).read_text()
+    assert profile
+    for line in profile.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+
+# An inline profile replaces the response and shows the SQL being executed
+@pytest.mark.asyncio
+async def test_inline_profile(tmp_path):
+    profiled = ProfilingMiddleware(slow_app, directory=str(tmp_path))
+    async with AsyncClient(transport=ASGITransport(app=profiled), base_url="http://test") as ac:
+        response = await ac.get("/slow/", headers={"X-Profile": "inline"})
+        assert response.status_code == 200
+        assert response.headers["x-profile-status"] == "200"
+    assert "db_config.QueryHookMixin.execute_sql;SQL: WITH RECURSIVE" in response.text
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,198 @@
+from httpx import AsyncClient, ASGITransport
+import pytest
+import time
+
+from api import app
+from cpt_cache import cpt_code_cache
+import metrics
+from model import CPTCode, DataImport, Patient, Encounter, LineItem, CPT_CODES_IMPORT
+import response_cache as response_cache_module
+from response_cache import response_cache, ResponseCache, MemoryBackend
+
+@pytest.fixture(scope='function', autouse=True)
+def test_setup_db():
+    Patient.delete().execute()
+    Encounter.delete().execute()
+    LineItem.delete().execute()
+
+# Reads carry an ETag and are served from the cache on repeat, after only
+# looking up the patient version
+@pytest.mark.asyncio
+async def test_cached_read(assert_num_queries):
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        with assert_num_queries(2):
+            response = await ac.get(f"/patients/{patient.id}")
+        assert response.status_code == 200
+        assert response.headers["x-cache"] == "miss"
+        etag = response.headers["etag"]
+        assert etag == f'"{patient.id}.0.{cpt_code_cache.stamp}"'
+        with assert_num_queries(1):
+            cached = await ac.get(f"/patients/{patient.id}")
+        assert cached.headers["x-cache"] == "hit"
+        assert cached.headers["etag"] == etag
+        assert cached.json() == response.json()
+
+# A matching If-None-Match gets a 304 without a body after only looking up the
+# patient version, whether the response is cached or not
+@pytest.mark.asyncio
+async def test_not_modified(assert_num_queries):
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    url = f"/patients/{patient.id}/encounters/"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        etag = (await ac.get(url)).headers["etag"]
+        with assert_num_queries(1):
+            response = await ac.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        response_cache.clear()
+        with assert_num_queries(1):
+            response = await ac.get(url, headers={"If-None-Match": f'"other", {etag}'})
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+
+# Adding an encounter or line item changes the ETag and drops cached responses
+@pytest.mark.asyncio
+async def test_post_invalidates():
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    url = f"/patients/{patient.id}/encounters/"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        first = await ac.get(url)
+        assert first.json() == []
+        encounter = (await ac.post(url, json={"date": "2021-01-01"})).json()
+        response = await ac.get(url, headers={"If-None-Match": first.headers["etag"]})
+        assert response.status_code == 200
+        assert response.json() == [encounter]
+        assert response.headers["etag"] != first.headers["etag"]
+
+        line_items_url = f"{url}{encounter['id']}/line_items/"
+        etag = (await ac.get(line_items_url)).headers["etag"]
+        await ac.post(line_items_url, json={"cpt_code": "99213", "units": 1})
+        response = await ac.get(line_items_url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert [ item["cpt_code"] for item in response.json() ] == ["99213"]
+
+# Batch writes invalidate every patient they wrote to
+@pytest.mark.asyncio
+async def test_batch_invalidates():
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    url = f"/patients/{patient.id}/encounters/"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        assert (await ac.get(url)).json() == []
+        response = await ac.post("/batch/encounters/", json=[{"patient_id": str(patient.id), "date": "2021-01-01"}])
+        assert response.json()["succeeded"] == 1
+        assert len((await ac.get(url)).json()) == 1
+    assert Patient.get_by_id(patient.id).version == 1
+
+# A write through another worker changes the version, so this worker's cached
+# response isn't served again
+@pytest.mark.asyncio
+async def test_write_elsewhere_retires_entry(assert_num_queries):
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    url = f"/patients/{patient.id}/encounters/"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        assert (await ac.get(url)).json() == []
+        assert (await ac.get(url)).headers["x-cache"] == "hit"
+        # as another worker would, without invalidating this worker's cache
+        Encounter.create(patient=patient, date="2021-01-01")
+        Patient.update(version=Patient.version + 1).where(Patient.id == patient.id).execute()
+        with assert_num_queries(2):
+            response = await ac.get(url)
+        assert response.headers["x-cache"] == "miss"
+        assert response.headers["etag"] == f'"{patient.id}.1.{cpt_code_cache.stamp}"'
+        assert len(response.json()) == 1
+
+# Entries are only returned for the ETag they were stored under, and
+# invalidating a patient drops its entries
+def test_get_checks_etag():
+    cache = ResponseCache(max_entries=10, ttl=60)
+    patient_id = "7b7e8c9e-2d2c-4c38-9d39-8a0e6b1d2a11"
+    cache.put("/a", patient_id, '"e.0"', (200, [], b"{}"))
+    assert cache.get("/a", '"e.0"') == (200, [], b"{}")
+    assert cache.get("/a", '"e.1"') is None
+    assert cache.get("/a", '"e.0"') is None
+    cache.put("/a", patient_id, '"e.1"', (200, [], b"{}"))
+    cache.invalidate(patient_id)
+    assert cache.get("/a", '"e.1"') is None
+    assert cache.stats()["size"] == 0
+
+# The cache holds at most max_entries, evicting the least recently used, and
+# entries expire after the TTL
+def test_lru_and_ttl(monkeypatch):
+    cache = ResponseCache(max_entries=2, ttl=60)
+    for key in ("/a", "/b"):
+        cache.put(key, "p", '"e"', (200, [], key.encode()))
+    cache.get("/a", '"e"')
+    cache.put("/c", "p", '"e"', (200, [], b"/c"))
+    assert cache.get("/b", '"e"') is None
+    assert cache.get("/a", '"e"') and cache.get("/c", '"e"')
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    assert cache.get("/a", '"e"') is None
+    assert cache.stats()["size"] == 1
+
+# Responses over the size limit are sent but not kept
+@pytest.mark.asyncio
+async def test_large_response_not_cached(monkeypatch):
+    monkeypatch.setattr(response_cache_module, "MAX_BODY_SIZE", 10)
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        first = await ac.get(f"/patients/{patient.id}")
+        assert first.json()["first_name"] == "Pat"
+        response = await ac.get(f"/patients/{patient.id}")
+        assert response.headers["x-cache"] == "miss"
+    assert response_cache.stats()["size"] == 0
+
+# With a shared backend, a response cached by another replica is found after
+# the version lookup when the local cache misses
+@pytest.mark.asyncio
+async def test_shared_backend(monkeypatch, assert_num_queries):
+    monkeypatch.setattr(response_cache, "backend", MemoryBackend())
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        first = await ac.get(f"/patients/{patient.id}")
+        response_cache.clear()
+        hits = response_cache.hits
+        with assert_num_queries(1):
+            response = await ac.get(f"/patients/{patient.id}")
+        assert response.headers["x-cache"] == "shared"
+        assert response.json() == first.json()
+        assert response_cache.hits == hits + 1
+
+# Reloading changed CPT code descriptions changes the ETags, so line items
+# aren't answered from the cache or with a 304 with the old descriptions
+@pytest.mark.asyncio
+async def test_cpt_code_reload_changes_etag():
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    encounter = Encounter.create(patient=patient, date="2021-01-01")
+    cpt = CPTCode.get(CPTCode.code == "99213")
+    LineItem.create(encounter=encounter, cpt_code=cpt, units=1)
+    url = f"/patients/{patient.id}/encounters/{encounter.id}/line_items/"
+    checksum = DataImport.get(DataImport.name == CPT_CODES_IMPORT).checksum
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        etag = (await ac.get(url)).headers["etag"]
+        try:
+            # as a new import of the CSV would
+            CPTCode.update(description="Updated").where(CPTCode.id == cpt.id).execute()
+            DataImport.update(checksum="updated").where(DataImport.name == CPT_CODES_IMPORT).execute()
+            assert cpt_code_cache.refresh()
+            response = await ac.get(url, headers={"If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.headers["etag"] != etag
+            assert response.json()[0]["cpt_code_description"] == "Updated"
+        finally:
+            CPTCode.update(description=cpt.description).where(CPTCode.id == cpt.id).execute()
+            DataImport.update(checksum=checksum).where(DataImport.name == CPT_CODES_IMPORT).execute()
+            cpt_code_cache.load()
+
+# Cache hits are still counted under their route in metrics
+@pytest.mark.asyncio
+async def test_cache_hit_route_label():
+    patient = Patient.create(first_name="Pat", last_name="Doe")
+    route = "/patients/{patient_id}"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+        await ac.get(f"/patients/{patient.id}")
+        requests = metrics.request_duration.count("GET", route, "200")
+        response = await ac.get(f"/patients/{patient.id}")
+        assert response.headers["x-cache"] == "hit"
+    assert metrics.request_duration.count("GET", route, "200") == requests + 1
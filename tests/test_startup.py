@@ -0,0 +1,45 @@
+import asyncio
+import pytest
+import time
+
+import api
+from api import app, lifespan
+from config import settings
+import startup
+
+# The lifespan verifies the schema instead of migrating in verify mode and
+# reports how long each startup phase took
+@pytest.mark.asyncio
+async def test_startup_report(monkeypatch):
+    monkeypatch.setitem(settings, "MIGRATE_ON_STARTUP", "verify")
+    monkeypatch.setattr(startup, "phases", {})
+    async with lifespan(app):
+        assert set(startup.phases) == {"db_connect", "verify_schema", "cpt_cache", "total"}
+
+# Skipping migrations leaves the schema alone
+@pytest.mark.asyncio
+async def test_startup_skip_migrations(monkeypatch):
+    monkeypatch.setitem(settings, "MIGRATE_ON_STARTUP", "skip")
+    monkeypatch.setattr(startup, "phases", {})
+    async with lifespan(app):
+        assert "migrate" not in startup.phases and "verify_schema" not in startup.phases
+
+# Waiting for the schema in verify mode doesn't block the event loop
+@pytest.mark.asyncio
+async def test_startup_verify_waits_off_loop(monkeypatch):
+    monkeypatch.setitem(settings, "MIGRATE_ON_STARTUP", "verify")
+    monkeypatch.setattr(startup, "phases", {})
+    monkeypatch.setattr(api, "wait_for_schema", lambda: time.sleep(0.2))
+    ticks = 0
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+    ticker = asyncio.create_task(tick())
+    try:
+        async with lifespan(app):
+            pass
+    finally:
+        ticker.cancel()
+    assert ticks >= 5